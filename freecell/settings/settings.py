@@ -1,6 +1,11 @@
 import os
 FREECELL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 MATLAB_PATH = r'guess'
+# Bytes of anonymous memory Freecell may use before cached data is evicted.
+# None picks a budget that fits the process (see src/memorygovernor.py).
+MEMORY_BUDGET = None
+# Save large outputs of chain modules on disk (see src/chainstore.py).
+SPILL_CHAIN_OUTPUTS = True
 EXPERIMENTS = {
     'AML with T-Sne data' : (
         os.path.join(os.path.join(os.path.dirname(FREECELL_DIR)), 'data', 'aml_tsne', 'aml_tsne.index'),
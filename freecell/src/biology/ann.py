@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+""" Approximate nearest neighbors for high dimensional marker spaces.
+
+With 30-45 markers a kd-tree prunes almost nothing and is no faster than
+brute force. AnnIndex instead combines:
+  - a forest of random projection trees: every tree splits the events by
+    random hyperplanes until the leaves are small, and events that share a
+    leaf are likely to be close.
+  - nearest neighbor descent (Dong, Moses and Li 2011): a neighbor of a
+    neighbor is likely to be a neighbor, so the k nearest neighbors graph
+    started from the forest candidates is refined by looking at the
+    neighbors of every event's neighbors.
+New points are searched the same way: forest leaves first, then the graph.
+
+Recall goes up with num_trees, leaf_size, max_iters and search_iters (and
+so does the run time). Everything runs on chunks of events on a thread pool.
+"""
+import logging
+import numpy as np
+from biology.chunked import map_chunks
+from biology.kmeans import as_points
+from biology.kmeans import as_random_state
+from biology.kdtree import expand_ranges
+
+DEFAULT_NUM_TREES = 8
+DEFAULT_LEAF_SIZE = 32
+DEFAULT_NUM_NEIGHBORS = 15
+DEFAULT_MAX_ITERS = 10
+DEFAULT_SEARCH_ITERS = 2
+# descent stops when fewer than this fraction of the graph entries change.
+DEFAULT_DELTA = 0.001
+# Below this many dims the kd-tree is exact and fast, see nearest_neighbors.
+ANN_MIN_DIMS = 16
+# Upper bound on the number of candidate pairs whose distances are computed
+# at once.
+MAX_PAIRS = 1000000
+
+def _squared_distances(points, rows, cols):
+  """ Squared distances between points[rows[i]] and points[cols[i, j]],
+  cols is (len(rows), m) and negative entries get infinite distances.
+  """
+  diff = points[np.maximum(cols, 0)]
+  diff -= points[rows][:, np.newaxis, :]
+  dist = np.einsum('ijk,ijk->ij', diff, diff)
+  dist[cols < 0] = np.inf
+  return dist
+
+def _merge_neighbors(dist, indices, new_dist, new_indices, k, exclude=None):
+  """ Merges candidate neighbors into neighbor lists, row by row, keeping
+  the k nearest distinct candidates sorted by distance.
+  exclude -- optional index per row that is never a neighbor (the event
+      itself).
+  Returns the merged (dist, indices).
+  """
+  all_indices = np.hstack((indices, new_indices))
+  all_dist = np.hstack((dist, new_dist))
+  if exclude is not None:
+    all_dist[all_indices == exclude[:, np.newaxis]] = np.inf
+  rows = np.arange(len(all_indices))[:, np.newaxis]
+  # a candidate can show up several times, keep its first copy.
+  order = np.argsort(all_indices, axis=1, kind='mergesort')
+  all_indices = all_indices[rows, order]
+  all_dist = all_dist[rows, order]
+  repeated = np.zeros(all_indices.shape, dtype=bool)
+  repeated[:, 1:] = all_indices[:, 1:] == all_indices[:, :-1]
+  all_dist[repeated] = np.inf
+  order = np.argsort(all_dist, axis=1, kind='mergesort')[:, :k]
+  return all_dist[rows, order], all_indices[rows, order]
+
+def _partition(indices, starts, ends, less):
+  """ Stable partition of the ranges starts[i]..ends[i]-1 of indices: the
+  entries whose less flag is set go first. less holds one flag per entry
+  of the ranges, in order. Returns the number of lesser entries per range.
+  """
+  owner, position = expand_ranges(starts, ends)
+  sizes = ends - starts
+  num_less = np.bincount(owner, weights=less, minlength=len(starts)).astype(np.int64)
+  first = np.cumsum(sizes) - sizes
+  less_count = np.cumsum(less)
+  less_before = (less_count[first] - less[first])[owner]
+  greater_count = np.arange(1, len(less) + 1) - less_count
+  greater_before = (greater_count[first] - ~less[first])[owner]
+  destination = np.where(
+      less,
+      less_count - 1 - less_before,
+      num_less[owner] + greater_count - 1 - greater_before)
+  indices[starts[owner] + destination] = indices[position]
+  return num_less
+
+class _RandomProjectionTree(object):
+  """ A tree that splits every node by the hyperplane half way between two
+  random events of the node, stored level by level in flat arrays like
+  biology.kdtree.KDTree.
+  """
+  def __init__(self, points, leaf_size, random_state):
+    n, d = points.shape
+    indices = np.arange(n)
+    node_start = [np.zeros(1, dtype=np.int64)]
+    node_end = [np.array([n], dtype=np.int64)]
+    normals = []
+    offsets = []
+    lesser = []
+    greater = []
+    num_nodes = 1
+    level_start = node_start[0]
+    level_end = node_end[0]
+    while len(level_start):
+      size = len(level_start)
+      level_normals = np.zeros((size, d))
+      level_offsets = np.zeros(size)
+      level_lesser = -np.ones(size, dtype=np.int64)
+      level_greater = -np.ones(size, dtype=np.int64)
+      to_split = np.flatnonzero(level_end - level_start > leaf_size)
+      child_start = np.zeros(2 * len(to_split), dtype=np.int64)
+      child_end = np.zeros(2 * len(to_split), dtype=np.int64)
+      if len(to_split):
+        starts = level_start[to_split]
+        ends = level_end[to_split]
+        sizes = ends - starts
+        # two different random events of every node
+        first = (random_state.random_sample(len(sizes)) * sizes).astype(np.int64)
+        second = (first + 1 + (random_state.random_sample(len(sizes)) * (sizes - 1)).astype(np.int64)) % sizes
+        a = points[indices[starts + first]]
+        b = points[indices[starts + second]]
+        normal = a - b
+        offset = np.sum(normal * (a + b) / 2., axis=1)
+        owner, position = expand_ranges(starts, ends)
+        margin = np.einsum('ij,ij->i', points[indices[position]], normal[owner]) - offset[owner]
+        less = margin < 0
+        num_less = np.bincount(owner, weights=less, minlength=len(sizes))
+        # identical events give no hyperplane, split such nodes in half.
+        degenerate = (num_less == 0) | (num_less == sizes)
+        if np.any(degenerate):
+          halves = (position - starts[owner]) < sizes[owner] // 2
+          less = np.where(degenerate[owner], halves, less)
+          # queries go to the greater half, the halves are alike.
+          normal[degenerate] = 0
+          offset[degenerate] = 0
+        num_less = _partition(indices, starts, ends, less)
+        level_normals[to_split] = normal
+        level_offsets[to_split] = offset
+        level_lesser[to_split] = num_nodes + 2 * np.arange(len(to_split))
+        level_greater[to_split] = level_lesser[to_split] + 1
+        num_nodes += 2 * len(to_split)
+        child_start[0::2] = starts
+        child_end[0::2] = starts + num_less
+        child_start[1::2] = child_end[0::2]
+        child_end[1::2] = ends
+      normals.append(level_normals)
+      offsets.append(level_offsets)
+      lesser.append(level_lesser)
+      greater.append(level_greater)
+      node_start.append(child_start)
+      node_end.append(child_end)
+      level_start = child_start
+      level_end = child_end
+    self.normals = np.concatenate(normals)
+    self.offsets = np.concatenate(offsets)
+    self.lesser = np.concatenate(lesser)
+    self.greater = np.concatenate(greater)
+    node_start = np.concatenate(node_start)
+    node_end = np.concatenate(node_end)
+    leaves = np.flatnonzero(self.lesser < 0)
+    # leaf number of every node (-1 for inner nodes)
+    self.leaf_number = -np.ones(len(self.lesser), dtype=np.int64)
+    self.leaf_number[leaves] = np.arange(len(leaves))
+    # members[i] holds the events of leaf i, padded with -1.
+    max_size = max(1, np.max(node_end[leaves] - node_start[leaves]))
+    self.members = -np.ones((len(leaves), max_size), dtype=np.int64)
+    owner, position = expand_ranges(node_start[leaves], node_end[leaves])
+    self.members[owner, position - node_start[leaves][owner]] = indices[position]
+    self.point_leaf = np.empty(n, dtype=np.int64)
+    self.point_leaf[indices[position]] = owner
+
+  def leaves_of(self, x):
+    """ The leaf number of every row of x.
+    """
+    nodes = np.zeros(len(x), dtype=np.int64)
+    active = np.flatnonzero(self.lesser[nodes] >= 0)
+    while len(active):
+      n = nodes[active]
+      margin = np.einsum('ij,ij->i', x[active], self.normals[n]) - self.offsets[n]
+      nodes[active] = np.where(margin < 0, self.lesser[n], self.greater[n])
+      active = active[self.lesser[nodes[active]] >= 0]
+    return self.leaf_number[nodes]
+
+class AnnIndex(object):
+  """ Approximate k nearest neighbors index over an (n, m) array of points.
+
+  num_neighbors -- the k of the neighbors graph that is refined by descent.
+  num_trees, leaf_size -- the random projection forest. More and larger
+      trees give better initial candidates.
+  max_iters, delta -- descent stops after max_iters rounds, or once fewer
+      than delta * n * num_neighbors graph entries change in a round.
+
+  Candidate distances are computed in float32 (half the memory traffic),
+  the distances that are returned are exact.
+  """
+  def __init__(self, data, num_neighbors=DEFAULT_NUM_NEIGHBORS, num_trees=DEFAULT_NUM_TREES,
+               leaf_size=DEFAULT_LEAF_SIZE, max_iters=DEFAULT_MAX_ITERS, delta=DEFAULT_DELTA,
+               random_state=0, num_threads=None):
+    self.data = as_points(data, np.float64)
+    self._data32 = self.data.astype(np.float32)
+    self.n, self.m = self.data.shape
+    self.num_neighbors = max(1, min(num_neighbors, self.n - 1))
+    self.num_threads = num_threads
+    random_state = as_random_state(random_state)
+    seeds = random_state.randint(0, 2 ** 31 - 1, num_trees)
+    def build_tree(start, end):
+      return _RandomProjectionTree(self.data, leaf_size, np.random.RandomState(seeds[start]))
+    self.trees = map_chunks(build_tree, num_trees, 1, num_threads)
+    self._build_graph(random_state, max_iters, delta)
+
+  def _rows_per_chunk(self, candidates_per_row):
+    return max(1, MAX_PAIRS // max(1, candidates_per_row))
+
+  def _build_graph(self, random_state, max_iters, delta):
+    n = self.n
+    k = self.num_neighbors
+    self.graph_dist = np.empty((n, k))
+    self.graph_dist.fill(np.inf)
+    self.graph_indices = -np.ones((n, k), dtype=np.int64)
+    if n < 2:
+      return
+    # random neighbors make sure every list is full, even for events that
+    # end up in tiny leaves.
+    initial = random_state.randint(0, n, (n, k))
+    # candidates from the forest: the events that share a leaf.
+    def init_chunk(start, end):
+      rows = np.arange(start, end)
+      candidates = [initial[start:end]]
+      for tree in self.trees:
+        candidates.append(tree.members[tree.point_leaf[start:end]])
+      candidates = np.hstack(candidates)
+      dist = _squared_distances(self._data32, rows, candidates)
+      self.graph_dist[start:end], self.graph_indices[start:end] = _merge_neighbors(
+          self.graph_dist[start:end], self.graph_indices[start:end], dist, candidates, k, rows)
+    width = k + sum(tree.members.shape[1] for tree in self.trees)
+    map_chunks(init_chunk, n, self._rows_per_chunk(width), self.num_threads)
+    is_new = np.ones((n, k), dtype=bool)
+    for iteration in xrange(max_iters):
+      changes = self._descent_round(is_new)
+      logging.info('Neighbor descent round %d: %d changes' % (iteration, changes))
+      if changes < delta * n * k:
+        break
+    def exact_chunk(start, end):
+      rows = np.arange(start, end)
+      self.graph_dist[start:end], self.graph_indices[start:end] = self._exact(
+          self.data[start:end], self.graph_indices[start:end])
+    map_chunks(exact_chunk, n, self._rows_per_chunk(k), self.num_threads)
+
+  def _exact(self, x, neighbors):
+    """ Exact squared distances from the rows of x to their neighbors, the
+    neighbors are reordered by them.
+    """
+    diff = self.data[np.maximum(neighbors, 0)]
+    diff -= x[:, np.newaxis, :]
+    dist = np.einsum('ijk,ijk->ij', diff, diff)
+    dist[neighbors < 0] = np.inf
+    order = np.argsort(dist, axis=1, kind='mergesort')
+    rows = np.arange(len(x))[:, np.newaxis]
+    return dist[rows, order], neighbors[rows, order]
+
+  def _descent_round(self, is_new):
+    """ Merges the neighbors of the neighbors of every event into its list.
+    Only pairs that involve a list entry that is new since the last round
+    are tried, older pairs were tried before. is_new is updated.
+    Returns the number of list entries that changed.
+    """
+    k = self.num_neighbors
+    old_indices = self.graph_indices.copy()
+    was_new = is_new.copy()
+    def descent_chunk(start, end):
+      size = end - start
+      neighbors = old_indices[start:end]
+      valid = neighbors >= 0
+      neighbors = np.maximum(neighbors, 0)
+      second = old_indices[neighbors]
+      # the pair (event, neighbor of neighbor j) is new if j is new to the
+      # event or the neighbor is new to j.
+      useful = (was_new[start:end] & valid)[:, :, np.newaxis] | was_new[neighbors]
+      useful &= valid[:, :, np.newaxis] & (second >= 0)
+      candidates = np.where(useful, second, -1).reshape(size, k * k)
+      useful = useful.reshape(size, k * k)
+      dist = np.empty((size, k * k), dtype=np.float32)
+      dist.fill(np.inf)
+      rows = np.repeat(np.arange(start, end), k * k).reshape(size, k * k)[useful]
+      diff = self._data32[candidates[useful]] - self._data32[rows]
+      dist[useful] = np.einsum('ij,ij->i', diff, diff)
+      new_dist, new_indices = _merge_neighbors(
+          self.graph_dist[start:end], old_indices[start:end], dist, candidates, k,
+          np.arange(start, end))
+      self.graph_indices[start:end] = new_indices
+      self.graph_dist[start:end] = new_dist
+      is_new[start:end] = ~np.any(new_indices[:, :, np.newaxis] == old_indices[start:end, np.newaxis, :], axis=2)
+      return np.sum(is_new[start:end])
+    return sum(map_chunks(descent_chunk, self.n, self._rows_per_chunk(k * k), self.num_threads))
+
+  def knn_graph(self, k=None):
+    """ Returns (distances, indices) arrays of shape (n, k) with the k
+    nearest neighbors of every event, not including the event itself. k can
+    not be more than num_neighbors. Missing neighbors have an infinite
+    distance and the index n.
+    """
+    if k == None:
+      k = self.num_neighbors
+    if k > self.num_neighbors:
+      raise ValueError('The index only has %d neighbors per event' % self.num_neighbors)
+    return self._finish(self.graph_dist[:, :k], self.graph_indices[:, :k])
+
+  def _finish(self, dist_sq, indices):
+    indices = indices.copy()
+    indices[np.isinf(dist_sq)] = self.n
+    return np.sqrt(dist_sq), indices
+
+  def query(self, x, k=1, search_iters=DEFAULT_SEARCH_ITERS, chunk_size=10000):
+    """ Finds the approximate k nearest events of every query point.
+    search_iters -- rounds of graph search after the forest lookup, more
+        rounds give better recall.
+
+    Returns (distances, indices), both of shape (len(x), k), like
+    KDTree.query.
+    """
+    x = as_points(x, np.float64)
+    k = int(k)
+    width = max(k, self.num_neighbors)
+    distances = np.empty((len(x), k))
+    indices = np.empty((len(x), k), dtype=np.int64)
+    def distances_to(chunk_x, candidates):
+      diff = self._data32[np.maximum(candidates, 0)]
+      diff -= chunk_x.astype(np.float32)[:, np.newaxis, :]
+      dist = np.einsum('ijk,ijk->ij', diff, diff)
+      dist[candidates < 0] = np.inf
+      return dist
+    def query_chunk(start, end):
+      chunk_x = x[start:end]
+      candidates = np.hstack([tree.members[tree.leaves_of(chunk_x)] for tree in self.trees])
+      empty_dist = np.empty((end - start, 0))
+      empty_indices = np.empty((end - start, 0), dtype=np.int64)
+      dist, neighbors = _merge_neighbors(
+          empty_dist, empty_indices, distances_to(chunk_x, candidates), candidates, width)
+      for i in xrange(search_iters):
+        candidates = self.graph_indices[np.maximum(neighbors, 0)].reshape(end - start, -1)
+        candidates[np.repeat(neighbors < 0, self.num_neighbors, axis=1)] = -1
+        dist, neighbors = _merge_neighbors(
+            dist, neighbors, distances_to(chunk_x, candidates), candidates, width)
+      dist, neighbors = self._exact(chunk_x, neighbors[:, :k])
+      distances[start:end], indices[start:end] = self._finish(dist, neighbors)
+    chunk_size = min(chunk_size, self._rows_per_chunk(width * self.num_neighbors))
+    map_chunks(query_chunk, len(x), chunk_size, self.num_threads)
+    return distances, indices
+
+def nearest_neighbors(points, k, num_threads=None, **kargs):
+  """ Returns (distances, indices) arrays of shape (n, k) with the k
+  nearest neighbors of every point, not including the point itself.
+  Uses the exact kd-tree in low dimensions and AnnIndex (extra arguments
+  are passed to it) from ANN_MIN_DIMS dimensions on.
+  """
+  from biology.kdtree import KDTree
+  points = as_points(points, np.float64)
+  n = len(points)
+  k = max(0, min(k, n - 1))
+  if points.shape[1] >= ANN_MIN_DIMS and k:
+    return AnnIndex(points, k, num_threads=num_threads, **kargs).knn_graph(k)
+  dist, indices = KDTree(points).query(points, k + 1, num_threads=num_threads)
+  # every event is its own nearest neighbor, unless it has duplicates, so
+  # drop the event itself rather than the first column.
+  is_self = indices == np.arange(n)[:, np.newaxis]
+  has_self = np.any(is_self, axis=1)
+  is_self[~has_self, k] = True
+  keep = ~is_self
+  return dist[keep].reshape(n, k), indices[keep].reshape(n, k)
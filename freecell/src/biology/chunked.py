@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+""" Helpers for running numpy computations over large event tables in chunks.
+
+Most heavy numpy operations (dot products, sorting, elementwise math on big
+arrays) release the GIL, so running chunks on a thread pool gives real
+multi-core speedups without copying the data to worker processes.
+"""
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+DEFAULT_CHUNK_SIZE = 100000
+
+def default_num_threads():
+  try:
+    return multiprocessing.cpu_count()
+  except NotImplementedError:
+    return 1
+
+def chunk_ranges(num_items, chunk_size=DEFAULT_CHUNK_SIZE):
+  """ Returns a list of (start, end) tuples covering xrange(num_items).
+  """
+  chunk_size = max(1, int(chunk_size))
+  return [(start, min(start + chunk_size, num_items))
+          for start in xrange(0, num_items, chunk_size)]
+
+def map_chunks(func, num_items, chunk_size=DEFAULT_CHUNK_SIZE, num_threads=None):
+  """ Calls func(start, end) for every chunk of xrange(num_items) and returns
+  the results in chunk order.
+
+  num_threads -- number of threads to use. None means one thread per core,
+  1 runs everything on the calling thread.
+  """
+  ranges = chunk_ranges(num_items, chunk_size)
+  if num_threads == None:
+    num_threads = default_num_threads()
+  num_threads = min(num_threads, len(ranges))
+  if num_threads <= 1:
+    return [func(start, end) for start, end in ranges]
+  pool = ThreadPool(num_threads)
+  try:
+    return pool.map(lambda r: func(r[0], r[1]), ranges)
+  finally:
+    pool.close()
+    pool.join()
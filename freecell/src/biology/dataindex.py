@@ -148,10 +148,31 @@ class DataIndex(object):
     """
     return self._count_load_table(False, criteria, arcsin_factor)
 
+  def files(self, criteria):
+    """Returns the paths of the files of the items matching the criteria
+    dictionary (see load_table)."""
+    predicate = self._criteria_predicate(criteria)
+    return [os.path.join(self.path, e.filename) for e in self.entries if predicate(e.tags)]
+
   def count_cells(self, criteria):
     return self._count_load_table(True, criteria)
 
-  def _count_load_table(self, count, criteria, arcsin_factor):
+  def summarize(self, criteria, spec, arcsin_factor):
+    """Computes per group statistics without creating a table per group.
+    The items are chosen with a criteria dictionary (see load_table), and
+    grouped by the values of the tags in it. spec is passed to
+    biology.groupby.GroupBy.agg.
+    Returns a DataTable with a row per group, or None if nothing matched.
+    """
+    predicate = self._criteria_predicate(criteria)
+    tables = [self.table_from_entry(e, arcsin_factor) for e in self.entries if predicate(e.tags)]
+    if not tables:
+      return None
+    return combine_tables(tables).groupby(criteria.keys()).agg(spec)
+
+  def _criteria_predicate(self, criteria):
+    """Returns a predicate for load_table_predicate that picks the items
+    matching the criteria dictionary (see load_table)."""
     def predicate(tags):
       if not criteria:
         return False
@@ -169,6 +190,10 @@ class DataIndex(object):
       for key in criteria.iterkeys():
         ret.append((key, tags[key]))
       return tuple(ret)
+    return predicate
+
+  def _count_load_table(self, count, criteria, arcsin_factor):
+    predicate = self._criteria_predicate(criteria)
     if count:
       return self.count_cells_predicate(predicate)
     else:
@@ -4,7 +4,6 @@ from copy import copy
 from odict import OrderedDict
 import sys
 from StringIO import StringIO
-import random
 import struct
 import os
 from collections import namedtuple
@@ -131,9 +130,12 @@ class DataTable(AutoReloader):
       self.tags['name'] = name
 
   def hash_table(self):
-    if not 'hash_cache' in dir(self):
+    """ Returns the fingerprint of the table (a digest of its data and
+    dims), used in cache keys. It is computed once per table.
+    """
+    if getattr(self, 'hash_cache', None) == None:
       h = hashlib.sha1()
-      h.update(self.data.flatten())
+      h.update(np.ascontiguousarray(self.data))
       h.update(repr(self.dims))
       self.hash_cache = h.hexdigest()    
     return self.hash_cache
@@ -226,58 +228,81 @@ class DataTable(AutoReloader):
     diff = np.abs(gaussian_histogram - data_histogram)
     return sum(diff)
 
-  def emgm(self, dims, k, auto_centers=False):
-    """ runs emgm clustering on the datatable, result is k datatables
-    with the rows for each cluster.
+  def emgm_labels(self, dims, k, auto_centers=False, **kargs):
+    """ Fits a gaussian mixture with k components over the given dims.
+    Returns a label (component index) for every row and the model's
+    average log likelihood. Extra arguments are passed to
+    biology.gmm.gaussian_mixture_em.
     """
+    from biology.gmm import gaussian_mixture_em
     if auto_centers and len(dims)>1:
       raise Exception('k too big')
-    
     points = self.get_points(*dims)
-    from mlabwrap import mlab
+    init_means = None
     if auto_centers:
-      centers = [np.r_[np.min(points) : np.max(points) : k*1j]]
-      print centers
-      idx, model, llh = mlab.emgm(points.T, centers, nout=3)
-    else:
-      idx, model, llh = mlab.emgm(points.T, k, nout=3)
-    # we need to convert the index array from matlab to python (and remember
-    # that python is 0-based and not 1-based)
-    idx = idx.astype('int')[0]
-    new_data = self.data[idx]
-    tables = [DataTable(
-        self.data[idx==(i+1)],
-        self.dims,
-        self.legends,
-        self.tags,
-        self.sub_name('emgm cluster %d' % i)) for i in xrange(k)]
+      init_means = np.linspace(np.min(points), np.max(points), k)
+    labels, model, llh = gaussian_mixture_em(points, k, init_means=init_means, **kargs)
+    return labels, llh[-1]
+
+  def emgm(self, dims, k, auto_centers=False, **kargs):
+    """ runs emgm clustering on the datatable, result is k datatables
+    with the rows for each cluster.
+    """
+    labels, llh = self.emgm_labels(dims, k, auto_centers, **kargs)
+    tables = self.split_by_labels(labels, k, 'emgm cluster %d')
     for t in tables:
       t.tags['original_table'] = self
-    #print llh
-    return tables, llh[0][-1]
+    return tables, llh
+
+  def kmeans_labels(self, dims, k, **kargs):
+    """ Runs mini-batch k-means over the given dims and returns a label
+    (cluster index) for every row. Extra arguments are passed to
+    biology.kmeans.minibatch_kmeans.
+    """
+    from biology.kmeans import minibatch_kmeans
+    centers, labels = minibatch_kmeans(self.get_points(*dims), k, **kargs)
+    return labels
 
-  def kmeans(self, dims, k):
+  def kmeans(self, dims, k, **kargs):
     """ runs kmeans on the datatable, result is k datatables
     with the rows for each cluster.
     """
-    points = self.get_points(*dims)
-    from mlabwrap import mlab
-    idx = mlab.kmeans(points, k, nout=1)
-    
-    # we need to convert the index array from matlab to python (and remember
-    # that python is 0-based and not 1-based)
-    idx = idx.astype('int')
-    
-    new_data = self.data[idx]
-    tables = [DataTable(
-        self.data[idx==(i+1)],
+    return self.split_by_labels(self.kmeans_labels(dims, k, **kargs), k, 'kmeans cluster %d')
+
+  def dbscan_labels(self, dims, distance, min_points, **kargs):
+    """ Runs DBSCAN over the events (see dbscan.DBSCAN_points) and returns
+    a cluster index for every row, -1 for noise. Extra arguments are passed
+    to DBSCAN_points.
+    """
+    from dbscan import DBSCAN_points
+    return DBSCAN_points(
+        self.get_points(*dims), distance, min_points, tree=self.kd_tree(dims), **kargs)
+
+  def split_by_labels(self, labels, num_labels=None, name_format='cluster %d'):
+    """ Splits the table according to an integer label per row. Table number
+    i contains the rows with label i. Negative labels are dropped.
+    The rows are reordered once, the returned tables hold views into that
+    single copy, so splitting into k tables does not cost k copies.
+    """
+    labels = np.asarray(labels)
+    if num_labels == None:
+      num_labels = int(np.max(labels)) + 1 if len(labels) else 0
+    order = np.argsort(labels, kind='mergesort')
+    sorted_labels = labels[order]
+    bounds = np.searchsorted(sorted_labels, np.arange(num_labels + 1))
+    sorted_data = self.data[order]
+    return [DataTable(
+        sorted_data[bounds[i]:bounds[i+1]],
         self.dims,
         self.legends,
         self.tags,
-        self.sub_name('kmeans cluster %d' % i)) for i in xrange(k)]
-    #for t in tables:
-    #  t.properties['original_table'] = self
-    return tables
+        self.sub_name(name_format % i)) for i in xrange(num_labels)]
+
+  def add_dim(self, dim, values, legend=None):
+    """ Returns a new table with an extra column.
+    """
+    new_data = np.concatenate((self.data, np.asarray(values, dtype=self.data.dtype)[:, np.newaxis]), axis=1)
+    return DataTable(new_data, list(self.dims) + [dim], list(self.legends) + [legend], self.tags.copy())
 
   def get_stats_multi_dim(self, *dims):
     tables = [self.get_stats(dim, dim+'_') for dim in dims]
@@ -308,6 +333,15 @@ class DataTable(AutoReloader):
   def get_std(self, dim):
     p = self.get_points(dim)
     return np.std(p)
+
+  def groupby(self, tag_dims):
+    """ Groups the rows by the values of the given tag dims (a dim name or a
+    list). Returns a biology.groupby.GroupBy, call its agg method to get a
+    table with statistics for every group, for example:
+    table.groupby(['stim']).agg({'CD3': ['mean', 'std', 'median', 'count']})
+    """
+    from biology.groupby import GroupBy
+    return GroupBy.from_table(self, tag_dims)
     
   def get_stats(self, dim, prefix=''):
     """Get various 1d statistics for the datatable.
@@ -369,18 +403,30 @@ class DataTable(AutoReloader):
   def get_subtable(self, rows):
     return DataTable(self.data[rows,:], self.dims, self.legends, self.tags.copy())  
   
+  def kd_tree(self, dims):
+    """ Returns a kd-tree (biology.kdtree.KDTree) over the given dims. The
+    tree is cached in memory and on disk per table fingerprint and dims, a
+    tree saved by an earlier run (or another process) is memory mapped.
+    """
+    from biology.kdtree import table_kd_tree
+    return table_kd_tree(self, dims)
+
+  def knn_graph(self, dims, k, **kargs):
+    """ Returns the k nearest neighbors graph over the given dims (a
+    biology.knngraph.KnnGraph). The graph is computed once per table
+    fingerprint and dims and cached in memory and on disk.
+    Extra arguments are passed to biology.knngraph.table_knn_graph.
+    """
+    from biology.knngraph import table_knn_graph
+    return table_knn_graph(self, dims, k, **kargs)
+
   def gate2(self, *dim_ranges):
     """ Gating using kd-tree, deprecated do not use
     """
-    def kd_tree_cache(data):
-      points = self.get_points(*[r.dim for r in dim_ranges])
-      data.tree = KDTree(points)
-    global services
-    data = services.cache((self, [r.dim for r in dim_ranges]), kd_tree_cache)
-    rect = Rectangle(
+    tree = self.kd_tree([r.dim for r in dim_ranges])
+    new_indices = tree.query_range(
         [r.min for r in dim_ranges],
         [r.max for r in dim_ranges])
-    new_indices = data.tree.query_range(rect)
     return DataTable(self.data[new_indices], self.dims)
     
   def gate(self, *dim_ranges):
@@ -562,19 +608,30 @@ class DataTable(AutoReloader):
       dims_to_use = self.dims
     points = self.get_points(*dims_to_use)
     if method == 'tsne':
-      extra_points = calc_tsne(points)
+      from biology.tsne import tsne
+      from biology.tsne import needed_neighbors
+      perplexity = kargs.get('perplexity', 30)
+      if len(dims_to_use) <= kargs.get('initial_dims', 30) and not 'knn' in kargs:
+        # The PCA inside tsne only rotates the points, the neighbors stay
+        # the same.
+        kargs['knn'] = self.knn_graph(dims_to_use, needed_neighbors(len(points), perplexity)).arrays()
+      extra_points = tsne(points, no_dims, *args, **kargs)
+    elif method.lower() == 'pca':
+      from biology.embedding import pca
+      coeffs, extra_points, variances = pca(points, no_dims)
+    elif method.lower() == 'isomap':
+      from biology.manifold import isomap
+      k = kargs.pop('k', 12)
+      graph = self.knn_graph(dims_to_use, k).to_csr(symmetric=True)
+      extra_points = isomap(points, no_dims, k, *args, graph=graph, **kargs)
+    elif method.lower() == 'lle':
+      from biology.manifold import lle
+      extra_points = lle(points, no_dims, *args, **kargs)
     else:
       from mlabwrap import mlab
       extra_points, mapping = mlab.compute_mapping(
           points, method, no_dims, *args, nout=2, **kargs)
-    if method.lower() in ['isomap', 'lle']:
-      # we need to convert the index array from matlab to python (and remember
-      # that python is 0-based and not 1-based)
-      indices = np.subtract(mapping.conn_comp.T[0].astype('int'), 1)
-      old_data = self.data[indices,:]
-    else:
-      old_data = self.data
-    new_data = np.concatenate((old_data, extra_points), axis=1)
+    new_data = np.concatenate((self.data, extra_points), axis=1)
     extra_dims = ['%s%d' % (method, i) for i in xrange(no_dims)]
     new_dims = self.dims + extra_dims
     return DataTable(new_data, new_dims, self.legends, self.tags.copy())
@@ -585,15 +642,38 @@ class DataTable(AutoReloader):
     ranges = [DimRange(d, 0, np.inf) for d in dims]
     return self.gate(*ranges)
 
-  @cache('not_so_random_samples')
-  def random_sample(self, n):
+  def random_sample(self, n, random_state=0):
     """ Returns a random sample of n rows from the table. 
-    Note that this is cached in memory, so multiple runs will result 
-    in the same sample.
+    The sample is seeded, so multiple runs will result in the same sample.
     """
-    indices = random.sample(xrange(np.shape(self.data)[0]), n)
-    table = DataTable(self.data[indices], self.dims, self.legends, self.tags.copy())
-    return table
+    return self.sample(n, 'uniform', random_state=random_state)
+
+  @cache('sample_indices')
+  def sample_indices(self, n, mode='uniform', dims=None, tag_dim=None, balanced=False, random_state=0):
+    """ Returns the sorted indices of n rows sampled with one of the modes in
+    biology.sampling (uniform, stratified, density, spread). Only the
+    indices are cached.
+    dims -- the dims used by the density and spread modes (all by default).
+    tag_dim -- the dim whose values define the groups of the stratified mode.
+    balanced -- take the same number of rows from every group.
+    """
+    from biology.sampling import sample_indices
+    if dims:
+      points = self.get_points(*dims)
+    elif mode in ('density', 'spread'):
+      points = self.data
+    else:
+      points = np.empty((self.data.shape[0], 0))
+    labels = None
+    if tag_dim:
+      labels = self.get_cols(tag_dim)[0]
+    return sample_indices(points, n, mode, labels, balanced, random_state)
+
+  def sample(self, n, mode='uniform', dims=None, tag_dim=None, balanced=False, random_state=0):
+    """ Returns a table with n rows sampled using sample_indices.
+    """
+    return self.get_subtable(
+        self.sample_indices(n, mode, dims, tag_dim, balanced, random_state))
   
   @cache('mutual_information_tables')
   def get_mutual_information_table(self, dims_to_use=None, ignore_negative_values=True, use_correlation=False):
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+""" In-process linear embeddings: PCA and classical multidimensional scaling.
+
+These replace the matlab princomp and cmdscale calls. The return values
+follow the matlab layout so callers can use them the same way.
+"""
+import numpy as np
+from biology.kmeans import as_random_state
+
+# Below this size (of the smaller side of the matrix) the exact
+# decompositions are cheap enough.
+EXACT_SIZE = 500
+
+def _fix_signs(components):
+  """ Flips every column so that its largest absolute element is positive,
+  like matlab's princomp. Makes the results deterministic.
+  """
+  largest = np.argmax(np.abs(components), axis=0)
+  signs = np.sign(components[largest, np.arange(components.shape[1])])
+  signs[signs == 0] = 1
+  return components * signs
+
+def randomized_svd(a, k, n_oversamples=10, n_iter=7, random_state=None):
+  """ Truncated SVD of the matrix a with the randomized range finder of
+  Halko, Martinsson and Tropp (2011).
+  Returns u (m, k), s (k,), vt (k, n).
+  """
+  random_state = as_random_state(random_state)
+  m, n = a.shape
+  sketch_size = min(k + n_oversamples, m, n)
+  q = np.dot(a, random_state.normal(size=(n, sketch_size)))
+  q, unused = np.linalg.qr(q)
+  for i in xrange(n_iter):
+    q, unused = np.linalg.qr(np.dot(a.T, q))
+    q, unused = np.linalg.qr(np.dot(a, q))
+  u, s, vt = np.linalg.svd(np.dot(q.T, a), full_matrices=False)
+  return np.dot(q, u)[:, :k], s[:k], vt[:k]
+
+def pca(points, n_components=2, random_state=0):
+  """ Principal component analysis of points (rows are observations).
+
+  Uses an exact SVD for small inputs and a randomized truncated SVD
+  otherwise, so it works both on a few hundred table averages and on
+  millions of raw events.
+
+  Returns (coeffs, scores, variances) like matlab's princomp:
+    coeffs -- (num_dims, n_components), column i is the i'th component.
+    scores -- (num_points, n_components), the points in component space.
+    variances -- the variance along every component.
+  """
+  points = np.asarray(points, dtype=np.float64)
+  if points.ndim == 1:
+    points = points[:, np.newaxis]
+  n, p = points.shape
+  n_components = min(n_components, p)
+  centered = points - np.mean(points, axis=0)
+  if min(n, p) <= EXACT_SIZE:
+    u, s, vt = np.linalg.svd(centered, full_matrices=False)
+    vt = vt[:n_components]
+    s = s[:n_components]
+  else:
+    u, s, vt = randomized_svd(centered, n_components, random_state=random_state)
+  coeffs = _fix_signs(vt.T)
+  # pad when there are fewer points than components
+  if coeffs.shape[1] < n_components:
+    coeffs = np.hstack((coeffs, np.zeros((p, n_components - coeffs.shape[1]))))
+    s = np.concatenate((s, np.zeros(n_components - len(s))))
+  scores = np.dot(centered, coeffs)
+  variances = s ** 2 / max(n - 1, 1)
+  return coeffs, scores, variances
+
+def cmdscale(distances, n_components=2, num_eigenvalues=4):
+  """ Classical (Torgerson) multidimensional scaling.
+
+  distances -- a symmetric (n, n) distance matrix.
+  Returns (coords, eig) like matlab's cmdscale: coords is (n, n_components)
+  and eig holds the largest max(n_components, num_eigenvalues) eigenvalues
+  of the double centered matrix, in descending order. Components with a
+  non positive eigenvalue get zero coordinates.
+
+  Only the top eigenvectors are computed (with ARPACK) for large matrices.
+  """
+  distances = np.asarray(distances, dtype=np.float64)
+  n = len(distances)
+  b = distances ** 2
+  b -= np.mean(b, axis=0)[np.newaxis, :]
+  b -= np.mean(b, axis=1)[:, np.newaxis]
+  b *= -0.5
+  b = (b + b.T) / 2
+  num_eig = min(max(n_components, num_eigenvalues), n)
+  if n <= EXACT_SIZE or num_eig >= n - 1:
+    values, vectors = np.linalg.eigh(b)
+  else:
+    from scipy.sparse.linalg import eigsh
+    values, vectors = eigsh(b, k=num_eig, which='LA')
+  order = np.argsort(values)[::-1][:num_eig]
+  values = values[order]
+  vectors = _fix_signs(vectors[:, order])
+  coords = np.zeros((n, n_components))
+  used = min(n_components, num_eig)
+  coords[:, :used] = vectors[:, :used] * np.sqrt(np.maximum(values[:used], 0))
+  return coords, values
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+""" In-process Gaussian mixture model fitting (EM with full covariances).
+
+The E-step is vectorized over events and is computed in chunks, every chunk
+contributes sufficient statistics to the M-step, so memory usage does not
+grow with the number of events. Like the matlab emgm it replaces, the
+log likelihood is reported as the average per event.
+"""
+import logging
+import numpy as np
+from scipy.linalg import cholesky
+from scipy.linalg import solve_triangular
+from biology.chunked import map_chunks
+from biology.chunked import DEFAULT_CHUNK_SIZE
+from biology.kmeans import kmeans_plus_plus
+from biology.kmeans import as_points
+from biology.kmeans import as_random_state
+
+def _log_sum_exp(a):
+  a_max = np.max(a, axis=1)
+  ret = np.log(np.sum(np.exp(a - a_max[:, np.newaxis]), axis=1))
+  ret += a_max
+  return ret
+
+def _component_log_prob(points, model):
+  """ Returns a (len(points), k) array with log(weight_j * N(x | mean_j, cov_j)).
+  """
+  num_dims = points.shape[1]
+  k = len(model['weights'])
+  log_prob = np.empty((len(points), k))
+  for j in xrange(k):
+    chol = model['cholesky'][j]
+    centered = (points - model['means'][j]).T
+    solved = solve_triangular(chol, centered, lower=True)
+    mahalanobis = np.sum(solved * solved, axis=0)
+    log_det = 2 * np.sum(np.log(np.diag(chol)))
+    log_prob[:, j] = -0.5 * (num_dims * np.log(2 * np.pi) + log_det + mahalanobis)
+  log_prob += np.log(model['weights'])[np.newaxis, :]
+  return log_prob
+
+def _make_model(weights, means, covariances):
+  return {
+      'weights' : weights,
+      'means' : means,
+      'covariances' : covariances,
+      'cholesky' : [cholesky(c, lower=True) for c in covariances]}
+
+def _e_step_stats(points, model, chunk_size, num_threads):
+  """ Runs the E-step over all points and returns the sufficient statistics
+  for the M-step: (total log likelihood, N_k, sum_k, outer_k).
+  """
+  k = len(model['weights'])
+  num_dims = points.shape[1]
+  def chunk_stats(start, end):
+    chunk = np.asarray(points[start:end], dtype=np.float64)
+    log_prob = _component_log_prob(chunk, model)
+    log_norm = _log_sum_exp(log_prob)
+    resp = np.exp(log_prob - log_norm[:, np.newaxis])
+    outer = np.empty((k, num_dims, num_dims))
+    for j in xrange(k):
+      outer[j] = np.dot((chunk * resp[:, j:j+1]).T, chunk)
+    return np.sum(log_norm), np.sum(resp, axis=0), np.dot(resp.T, chunk), outer
+  stats = map_chunks(chunk_stats, len(points), chunk_size, num_threads)
+  return [sum(s) for s in zip(*stats)]
+
+def predict_labels(points, model, chunk_size=DEFAULT_CHUNK_SIZE, num_threads=None):
+  """ Returns the most likely component for every point (int32 array).
+  """
+  points = as_points(points, None)
+  labels = np.empty(len(points), dtype=np.int32)
+  def label_chunk(start, end):
+    chunk = np.asarray(points[start:end], dtype=np.float64)
+    labels[start:end] = np.argmax(_component_log_prob(chunk, model), axis=1)
+  map_chunks(label_chunk, len(points), chunk_size, num_threads)
+  return labels
+
+def gaussian_mixture_em(points, k, max_iter=100, tol=1e-6, init_means=None,
+                        fit_sample_size=None, reg_covar=1e-6, random_state=None,
+                        chunk_size=DEFAULT_CHUNK_SIZE, num_threads=None, dtype=np.float32):
+  """ Fits a mixture of k gaussians with EM.
+
+  points -- array of shape (num_events, num_dims).
+  init_means -- optional (k, num_dims) initial means, otherwise k-means++
+      seeding is used.
+  fit_sample_size -- if given, the model is fitted on a random sample of this
+      size and then all the points are labeled.
+  reg_covar -- added to the covariance diagonals to keep them invertible.
+
+  Returns labels (int32 array), model (a dict with weights, means and
+  covariances) and a list with the average log likelihood per iteration.
+  """
+  random_state = as_random_state(random_state)
+  points = as_points(points, dtype)
+  n, num_dims = points.shape
+  if fit_sample_size and fit_sample_size < n:
+    fit_points = points[np.sort(random_state.permutation(n)[:fit_sample_size])]
+  else:
+    fit_points = points
+  if init_means is None:
+    means = kmeans_plus_plus(fit_points, k, random_state).astype(np.float64)
+  else:
+    means = np.asarray(as_points(init_means, np.float64)).reshape(k, num_dims)
+  regularization = reg_covar * np.eye(num_dims)
+  data_cov = np.atleast_2d(np.cov(np.asarray(fit_points, dtype=np.float64), rowvar=0))
+  model = _make_model(
+      np.ones(k) / k,
+      means,
+      [data_cov + regularization for i in xrange(k)])
+  llh = []
+  for iteration in xrange(max_iter):
+    total_llh, n_k, sum_k, outer_k = _e_step_stats(fit_points, model, chunk_size, num_threads)
+    llh.append(total_llh / len(fit_points))
+    if len(llh) > 1 and abs(llh[-1] - llh[-2]) < tol * abs(llh[-1]):
+      break
+    n_k = np.maximum(n_k, 10 * np.finfo(np.float64).eps)
+    means = sum_k / n_k[:, np.newaxis]
+    covariances = [
+        outer_k[j] / n_k[j] - np.outer(means[j], means[j]) + regularization for j in xrange(k)]
+    model = _make_model(n_k / np.sum(n_k), means, covariances)
+  logging.info('EM converged after %d iterations' % len(llh))
+  labels = predict_labels(points, model, chunk_size, num_threads)
+  return labels, model, llh
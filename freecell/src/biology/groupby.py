@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+""" Per group statistics over tag columns.
+
+Tag columns (like the ones created by dataindex.py) hold numeric codes, so
+grouping a table by them needs one sort of the codes. All the statistics of
+all the groups are then computed with bincount and reduceat over the whole
+columns, without creating a table per group:
+
+  summary = table.groupby(['stim', 'time']).agg({'CD3': ['mean', 'std', 'median', 'count']})
+
+The summary is a DataTable with a row per group: the tag columns first and
+then a '<dim> <stat>' column per requested statistic.
+"""
+import numpy as np
+
+STAT_NAMES = ['count', 'sum', 'mean', 'std', 'var', 'median', 'min', 'max']
+# Names of functions that can be passed instead of the stat names.
+STAT_ALIASES = {'average': 'mean', 'len': 'count', 'amin': 'min', 'amax': 'max', 'size': 'count'}
+
+def _stat_name(stat):
+  if callable(stat):
+    stat = stat.__name__
+  stat = STAT_ALIASES.get(stat, stat)
+  if not stat in STAT_NAMES:
+    raise ValueError('Unknown statistic %s, use one of %s' % (stat, ', '.join(STAT_NAMES)))
+  return stat
+
+class GroupBy(object):
+  """ Rows split to groups. labels holds the group of every row, and
+  get_column(dim) returns a column over all the rows.
+  """
+  def __init__(self, labels, num_groups, get_column):
+    self.labels = labels
+    self.num_groups = num_groups
+    self.get_column = get_column
+    self.sizes = np.bincount(labels, minlength=num_groups)
+    # rows sorted by group, group g is order[starts[g]:starts[g] + sizes[g]]
+    self.order = np.argsort(labels, kind='mergesort')
+    self.starts = np.cumsum(self.sizes) - self.sizes
+    self.keys = None
+    self.key_dims = []
+    self.key_legends = []
+
+  @staticmethod
+  def from_table(table, tag_dims):
+    """ Groups the rows of table by the values of tag_dims.
+    """
+    if type(tag_dims) in (str, unicode):
+      tag_dims = [tag_dims]
+    codes = table.get_points(*tag_dims)
+    order = np.lexsort(codes.T[::-1])
+    sorted_codes = codes[order]
+    new_group = np.concatenate(([True], np.any(sorted_codes[1:] != sorted_codes[:-1], axis=1)))
+    labels = np.empty(len(codes), dtype=np.int64)
+    labels[order] = np.cumsum(new_group) - 1
+    groups = GroupBy(labels, int(np.sum(new_group)), lambda dim: table.get_points(dim)[:, 0])
+    groups.keys = sorted_codes[new_group]
+    groups.key_dims = list(tag_dims)
+    groups.key_legends = [table.legends[table.dims.index(d)] for d in tag_dims]
+    return groups
+
+  @staticmethod
+  def from_tables(tables):
+    """ Every table is a group. Only the columns used by agg are
+    concatenated.
+    """
+    sizes = [t.data.shape[0] for t in tables]
+    labels = np.repeat(np.arange(len(tables)), sizes)
+    def get_column(dim):
+      return np.concatenate([t.get_points(dim)[:, 0] for t in tables] or [np.zeros(0)])
+    return GroupBy(labels, len(tables), get_column)
+
+  def group_rows(self, group):
+    """ Returns the row indices of a group.
+    """
+    start = self.starts[group]
+    return self.order[start:start + self.sizes[group]]
+
+  def _stats(self, values, stats):
+    """ Returns a dictionary from stat name to an array with a value per
+    group.
+    """
+    ret = {}
+    count = self.sizes.astype(np.float64)
+    nonempty = self.sizes > 0
+    def per_group(sums):
+      result = np.empty(self.num_groups)
+      result.fill(np.nan)
+      result[nonempty] = sums[nonempty] / count[nonempty]
+      return result
+    if 'count' in stats:
+      ret['count'] = count
+    if set(stats) & set(['sum', 'mean', 'std', 'var']):
+      sums = np.bincount(self.labels, weights=values, minlength=self.num_groups)
+      ret['sum'] = sums
+      ret['mean'] = per_group(sums)
+    if set(stats) & set(['std', 'var']):
+      centered = values - np.nan_to_num(ret['mean'])[self.labels]
+      ret['var'] = per_group(np.bincount(self.labels, weights=centered * centered, minlength=self.num_groups))
+      ret['std'] = np.sqrt(ret['var'])
+    if set(stats) & set(['min', 'max']):
+      grouped = values[self.order]
+      for name, func in (('min', np.minimum), ('max', np.maximum)):
+        result = np.empty(self.num_groups)
+        result.fill(np.nan)
+        if len(grouped):
+          result[nonempty] = func.reduceat(grouped, self.starts[nonempty])
+        ret[name] = result
+    if 'median' in stats:
+      # sort by group and then by value, the medians are at fixed positions.
+      grouped = values[np.lexsort((values, self.labels))]
+      middle = self.starts[nonempty]
+      sizes = self.sizes[nonempty]
+      result = np.empty(self.num_groups)
+      result.fill(np.nan)
+      result[nonempty] = (grouped[middle + (sizes - 1) // 2] + grouped[middle + sizes // 2]) / 2.
+      ret['median'] = result
+    return ret
+
+  def agg(self, spec):
+    """ Computes statistics for all groups at once.
+    spec -- a dictionary from dim to a list of statistics (names from
+        STAT_NAMES or functions like np.mean and np.median). An ordered
+        dictionary or a list of (dim, stats) pairs sets the column order.
+    Returns a DataTable with a row per group.
+    """
+    from biology.datatable import DataTable
+    if hasattr(spec, 'items'):
+      spec = spec.items()
+    cols = []
+    dims = []
+    for dim, stats in spec:
+      if type(stats) in (str, unicode) or callable(stats):
+        stats = [stats]
+      stats = [_stat_name(s) for s in stats]
+      values = np.asarray(self.get_column(dim), dtype=np.float64)
+      results = self._stats(values, stats)
+      for stat in stats:
+        cols.append(results[stat])
+        dims.append('%s %s' % (dim, stat))
+    if self.keys is not None:
+      cols = list(self.keys.T) + cols
+    data = np.column_stack(cols) if cols else np.zeros((self.num_groups, 0))
+    legends = self.key_legends + [None] * len(dims)
+    return DataTable(data, self.key_dims + dims, legends)
@@ -0,0 +1,492 @@
+#!/usr/bin/env python
+""" An array backed kd-tree for event tables.
+
+The tree is stored in flat numpy arrays (one entry per node) and the points
+are kept in a single copy ordered by leaf, so a leaf is a contiguous slice.
+Queries are answered for many query points at once: the traversal keeps a
+frontier of (query, node) pairs and prunes / expands all of them with array
+operations, instead of walking the tree in python for every query.
+
+Only euclidean distances are supported.
+
+table_kd_tree keeps the trees in the freecell disk cache (namespace
+KD_TREES), where their arrays are memory mapped, so loading a tree takes
+constant time and processes that load the same tree share its pages.
+"""
+import logging
+import numpy as np
+from cache import CACHE
+from cache import MEM_CACHE
+from cache import TOTAL_MEMORY_BUDGET
+from cache import code_digest
+from cache import load_or_compute
+from biology.chunked import map_chunks
+
+DEFAULT_LEAF_SIZE = 32
+# Upper bound on the number of (query, point) pairs whose distances are
+# computed at once. Bounds the memory used by a query.
+MAX_PAIRS = 2000000
+# The namespace of the trees in the memory and disk caches (see cache.py).
+KD_TREES = 'kd_trees'
+# Memory budget for the trees that are not memory mapped, and bytes kept on
+# disk (the oldest trees are removed beyond that).
+MEMORY_BUDGET = min(256 * 2 ** 20, TOTAL_MEMORY_BUDGET // 4)
+MAX_DISK_BYTES = 5 * 2 ** 30
+
+def _box_dists(points, mins, maxes):
+  """ Returns the squared distances between every row of points and the
+  nearest and farthest points of the matching box.
+  """
+  below = mins - points
+  above = points - maxes
+  nearest = np.maximum(below, above)
+  np.maximum(nearest, 0, nearest)
+  farthest = np.minimum(below, above)
+  nearest *= nearest
+  farthest *= farthest
+  return np.sum(nearest, axis=1), np.sum(farthest, axis=1)
+
+def expand_ranges(starts, ends):
+  """ Returns (owner, position): for every range i, the positions
+  starts[i]..ends[i]-1 each tagged with i.
+  """
+  lengths = ends - starts
+  owner = np.repeat(np.arange(len(starts)), lengths)
+  offsets = np.arange(len(owner)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+  return owner, starts[owner] + offsets
+
+def _range_blocks(lengths, max_total):
+  """ Splits a list of range lengths into consecutive blocks whose total
+  length is at most max_total (unless a single range is larger).
+  """
+  cumulative = np.cumsum(lengths)
+  blocks = []
+  start = 0
+  while start < len(lengths):
+    base = cumulative[start - 1] if start else 0
+    end = np.searchsorted(cumulative, base + max_total, side='right')
+    end = max(end, start + 1)
+    blocks.append((start, end))
+    start = end
+  return blocks
+
+class KDTree(object):
+  """ kd-tree over an (n, m) array of points, built with the sliding midpoint
+  rule.
+
+  Attributes:
+    data -- the points in the original order (None in pickled trees).
+    indices -- indices[i] is the original index of the i'th point in leaf order.
+    tree_data -- data[indices], the points in leaf order.
+  """
+  def __init__(self, data, leafsize=DEFAULT_LEAF_SIZE):
+    data = np.asarray(data)
+    if data.ndim == 1:
+      data = data[:, np.newaxis]
+    self.data = data
+    self.n, self.m = data.shape
+    self.leafsize = max(1, int(leafsize))
+    self._build()
+
+  def _build(self):
+    """ Builds the tree one level at a time. All the nodes of a level are
+    split together with array operations.
+    """
+    indices = np.arange(self.n)
+    starts = [np.zeros(1, dtype=np.int64)]
+    ends = [np.array([self.n], dtype=np.int64)]
+    split_dims = []
+    splits = []
+    lesser = []
+    greater = []
+    mins = []
+    maxes = []
+    num_nodes = 1
+    level_start = np.zeros(1, dtype=np.int64)
+    level_end = np.array([self.n], dtype=np.int64)
+    while len(level_start):
+      level_size = len(level_start)
+      level_split_dim = -np.ones(level_size, dtype=np.int32)
+      level_split = np.zeros(level_size)
+      level_lesser = -np.ones(level_size, dtype=np.int64)
+      level_greater = -np.ones(level_size, dtype=np.int64)
+      level_mins = np.zeros((level_size, self.m))
+      level_maxes = np.zeros((level_size, self.m))
+      nonempty = np.flatnonzero(level_end > level_start)
+      owner, position = expand_ranges(level_start[nonempty], level_end[nonempty])
+      pts = self.data[indices[position]]
+      # offsets of the nonempty nodes inside pts, for reduceat
+      offsets = np.cumsum(level_end[nonempty] - level_start[nonempty])
+      offsets = np.concatenate(([0], offsets[:-1]))
+      if len(nonempty):
+        level_mins[nonempty] = np.minimum.reduceat(pts, offsets, axis=0)
+        level_maxes[nonempty] = np.maximum.reduceat(pts, offsets, axis=0)
+      spread = level_maxes - level_mins
+      dim = np.argmax(spread, axis=1)
+      # nodes with few points, or only identical points, are leaves.
+      to_split = np.flatnonzero(
+          (level_end - level_start > self.leafsize) & (spread[np.arange(level_size), dim] > 0))
+      if len(to_split):
+        split_owner, position = expand_ranges(level_start[to_split], level_end[to_split])
+        value = self.data[indices[position], dim[to_split][split_owner]]
+        node_min = level_mins[to_split, dim[to_split]]
+        node_max = level_maxes[to_split, dim[to_split]]
+        split = (node_min + node_max) / 2.
+        less = value < split[split_owner]
+        num_less = np.bincount(split_owner, weights=less, minlength=len(to_split))
+        # sliding midpoint: never leave a child empty.
+        num_points = level_end[to_split] - level_start[to_split]
+        all_greater = num_less == 0
+        if np.any(all_greater):
+          above_min = np.where(value > node_min[split_owner], value, np.inf)
+          lowest_above = np.minimum.reduceat(above_min, np.searchsorted(split_owner, np.arange(len(to_split))))
+          split[all_greater] = lowest_above[all_greater]
+        all_less = num_less == num_points
+        split[all_less] = node_max[all_less]
+        less = value < split[split_owner]
+        num_less = np.bincount(split_owner, weights=less, minlength=len(to_split)).astype(np.int64)
+        # stable partition of every node: lesser points first.
+        segment_offset = np.searchsorted(split_owner, np.arange(len(to_split)))
+        less_count = np.cumsum(less)
+        less_before = (less_count[segment_offset] - less[segment_offset])[split_owner]
+        greater_count = np.arange(1, len(less) + 1) - less_count
+        greater_before = (greater_count[segment_offset] - ~less[segment_offset])[split_owner]
+        destination = np.where(
+            less,
+            less_count - 1 - less_before,
+            num_less[split_owner] + greater_count - 1 - greater_before)
+        indices[level_start[to_split][split_owner] + destination] = indices[position]
+        level_split_dim[to_split] = dim[to_split]
+        level_split[to_split] = split
+        level_lesser[to_split] = num_nodes + 2 * np.arange(len(to_split))
+        level_greater[to_split] = level_lesser[to_split] + 1
+        num_nodes += 2 * len(to_split)
+        child_start = np.empty(2 * len(to_split), dtype=np.int64)
+        child_end = np.empty(2 * len(to_split), dtype=np.int64)
+        child_start[0::2] = level_start[to_split]
+        child_end[0::2] = level_start[to_split] + num_less
+        child_start[1::2] = child_end[0::2]
+        child_end[1::2] = level_end[to_split]
+      else:
+        child_start = child_end = np.zeros(0, dtype=np.int64)
+      split_dims.append(level_split_dim)
+      splits.append(level_split)
+      lesser.append(level_lesser)
+      greater.append(level_greater)
+      mins.append(level_mins)
+      maxes.append(level_maxes)
+      starts.append(child_start)
+      ends.append(child_end)
+      level_start = child_start
+      level_end = child_end
+    self.indices = indices
+    self.tree_data = self.data[indices]
+    # one contiguous array per dimension, for the per pair distance loops.
+    self._tree_columns = np.ascontiguousarray(self.tree_data.T, dtype=np.float64)
+    self.node_start = np.concatenate(starts)
+    self.node_end = np.concatenate(ends)
+    self.node_split_dim = np.concatenate(split_dims)
+    self.node_split = np.concatenate(splits)
+    self.node_lesser = np.concatenate(lesser)
+    self.node_greater = np.concatenate(greater)
+    self.node_mins = np.concatenate(mins)
+    self.node_maxes = np.concatenate(maxes)
+
+  def __getstate__(self):
+    # the points are not needed by the queries, and tree_data is a view.
+    state = self.__dict__.copy()
+    state['data'] = None
+    del state['tree_data']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.tree_data = self._tree_columns.T
+
+  @property
+  def num_nodes(self):
+    return len(self.node_start)
+
+  def _as_queries(self, x):
+    x = np.asarray(x, dtype=np.float64)
+    if x.ndim == 1:
+      x = x.reshape(-1, self.m)
+    if x.shape[1] != self.m:
+      raise ValueError('Query points have %d dims, the tree has %d' % (x.shape[1], self.m))
+    return x
+
+  def _traverse(self, x, r_sq):
+    """ Finds the nodes that may hold points within sqrt(r_sq[q]) of x[q].
+    Returns two pairs of (query, node) arrays: nodes that are completely
+    within the radius and leaves that are only partially within it.
+    """
+    q = np.arange(len(x))
+    nodes = np.zeros(len(x), dtype=np.int64)
+    inside_q = []
+    inside_nodes = []
+    leaf_q = []
+    leaf_nodes = []
+    while len(q):
+      min_dist, max_dist = _box_dists(x[q], self.node_mins[nodes], self.node_maxes[nodes])
+      query_r_sq = r_sq[q]
+      keep = min_dist <= query_r_sq
+      q = q[keep]
+      nodes = nodes[keep]
+      inside = max_dist[keep] <= query_r_sq[keep]
+      inside_q.append(q[inside])
+      inside_nodes.append(nodes[inside])
+      q = q[~inside]
+      nodes = nodes[~inside]
+      leaf = self.node_lesser[nodes] < 0
+      leaf_q.append(q[leaf])
+      leaf_nodes.append(nodes[leaf])
+      q = q[~leaf]
+      nodes = nodes[~leaf]
+      q = np.concatenate((q, q))
+      nodes = np.concatenate((self.node_lesser[nodes], self.node_greater[nodes]))
+    return (np.concatenate(inside_q), np.concatenate(inside_nodes),
+            np.concatenate(leaf_q), np.concatenate(leaf_nodes))
+
+  def _leaf_candidates(self, x, r_sq, leaf_q, leaf_nodes, func):
+    """ Computes the distances from the queries to the points of the leaves
+    they overlap (in blocks of at most MAX_PAIRS pairs), and calls
+    func(query, position, dist_sq) with the pairs within the radius.
+    position is an index into tree_data.
+    """
+    starts = self.node_start[leaf_nodes]
+    ends = self.node_end[leaf_nodes]
+    x_columns = np.ascontiguousarray(x.T)
+    for block_start, block_end in _range_blocks(ends - starts, MAX_PAIRS):
+      owner, position = expand_ranges(starts[block_start:block_end], ends[block_start:block_end])
+      query = leaf_q[block_start:block_end][owner]
+      dist_sq = np.zeros(len(query))
+      for d in xrange(self.m):
+        diff = x_columns[d].take(query)
+        diff -= self._tree_columns[d].take(position)
+        diff *= diff
+        dist_sq += diff
+      within = dist_sq <= r_sq[query]
+      func(query[within], position[within], dist_sq[within])
+
+  def _radius_array(self, x, r):
+    r = np.asarray(r, dtype=np.float64)
+    if r.ndim == 0:
+      r = np.repeat(r, len(x))
+    return r * r
+
+  def count_ball_point(self, x, r, limit=None, chunk_size=10000, num_threads=None):
+    """ Returns the number of tree points within distance r of every query
+    point (r may be a scalar or a value per query).
+
+    limit -- if given, only tells whether a count reaches limit: counts that
+        reach it may be lower than the true count (but not lower than limit).
+        Saves work when only dense points are of interest.
+    """
+    x = self._as_queries(x)
+    r_sq = self._radius_array(x, r)
+    counts = np.zeros(len(x), dtype=np.int64)
+    def count_chunk(start, end):
+      chunk_x = x[start:end]
+      chunk_r = r_sq[start:end]
+      chunk_counts = counts[start:end]
+      inside_q, inside_nodes, leaf_q, leaf_nodes = self._traverse(chunk_x, chunk_r)
+      sizes = self.node_end[inside_nodes] - self.node_start[inside_nodes]
+      chunk_counts += np.bincount(inside_q, weights=sizes, minlength=len(chunk_x)).astype(np.int64)
+      if limit != None:
+        undecided = chunk_counts[leaf_q] < limit
+        leaf_q = leaf_q[undecided]
+        leaf_nodes = leaf_nodes[undecided]
+      def add(query, position, dist_sq):
+        chunk_counts[:] += np.bincount(query, minlength=len(chunk_x))
+      self._leaf_candidates(chunk_x, chunk_r, leaf_q, leaf_nodes, add)
+    map_chunks(count_chunk, len(x), chunk_size, num_threads)
+    return counts
+
+  def query_ball_point_pairs(self, x, r, return_distance=False):
+    """ Finds all the (query, point) pairs within distance r.
+    Returns an array of query indices and an array of tree point indices
+    (indices into data), sorted by query. If return_distance is True, the
+    distances are returned as a third array.
+    """
+    x = self._as_queries(x)
+    return self._pairs(x, self._radius_array(x, r), return_distance)
+
+  def _pairs(self, x, r_sq, return_distance):
+    inside_q, inside_nodes, leaf_q, leaf_nodes = self._traverse(x, r_sq)
+    queries = []
+    positions = []
+    dists = []
+    owner, position = expand_ranges(self.node_start[inside_nodes], self.node_end[inside_nodes])
+    queries.append(inside_q[owner])
+    positions.append(position)
+    if return_distance:
+      diff = x[inside_q[owner]] - self.tree_data[position]
+      dists.append(np.sum(diff * diff, axis=1))
+    def add(query, position, dist_sq):
+      queries.append(query)
+      positions.append(position)
+      dists.append(dist_sq)
+    self._leaf_candidates(x, r_sq, leaf_q, leaf_nodes, add)
+    queries = np.concatenate(queries)
+    positions = np.concatenate(positions)
+    order = np.argsort(queries, kind='mergesort')
+    ret = (queries[order], self.indices[positions[order]])
+    if return_distance:
+      ret += (np.sqrt(np.concatenate(dists)[order]),)
+    return ret
+
+  def query_ball_point_links(self, x, r):
+    """ A compact form of query_ball_point_pairs, enough for connectivity
+    questions. A node that is completely within distance r of a query is
+    reported once, with its first point, instead of once for every point.
+    The leaf order positions of the node's points, tree_data[start:end], are
+    all neighbors of the query.
+
+    Returns (queries, indices, node_starts, node_ends), the first two are
+    the (query, neighbor) pairs and node_starts, node_ends are the ranges of
+    the reported nodes.
+    """
+    x = self._as_queries(x)
+    r_sq = self._radius_array(x, r)
+    inside_q, inside_nodes, leaf_q, leaf_nodes = self._traverse(x, r_sq)
+    queries = [inside_q]
+    positions = [self.node_start[inside_nodes]]
+    def add(query, position, dist_sq):
+      queries.append(query)
+      positions.append(position)
+    self._leaf_candidates(x, r_sq, leaf_q, leaf_nodes, add)
+    return (np.concatenate(queries), self.indices[np.concatenate(positions)],
+            self.node_start[inside_nodes], self.node_end[inside_nodes])
+
+  def query_ball_point(self, x, r, chunk_size=10000, num_threads=None):
+    """ Finds the tree points within distance r of every query point.
+    Returns (indptr, indices) in compressed sparse row layout: the
+    neighbors of query i are indices[indptr[i]:indptr[i+1]].
+    """
+    x = self._as_queries(x)
+    r_sq = self._radius_array(x, r)
+    def chunk_pairs(start, end):
+      query, index = self._pairs(x[start:end], r_sq[start:end], False)
+      return np.bincount(query, minlength=end - start), index
+    results = map_chunks(chunk_pairs, len(x), chunk_size, num_threads)
+    counts = np.concatenate([c for c, i in results] or [np.zeros(0, dtype=np.int64)])
+    indptr = np.zeros(len(x) + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    indices = np.concatenate([i for c, i in results] or [np.zeros(0, dtype=np.int64)])
+    return indptr, indices
+
+  def _leaf_of(self, x):
+    nodes = np.zeros(len(x), dtype=np.int64)
+    active = np.flatnonzero(self.node_lesser[nodes] >= 0)
+    while len(active):
+      n = nodes[active]
+      go_less = x[active, self.node_split_dim[n]] < self.node_split[n]
+      nodes[active] = np.where(go_less, self.node_lesser[n], self.node_greater[n])
+      active = active[self.node_lesser[nodes[active]] >= 0]
+    return nodes
+
+  def query(self, x, k=1, distance_upper_bound=np.inf, chunk_size=10000, num_threads=None):
+    """ Finds the k nearest tree points of every query point.
+
+    Returns (distances, indices), both of shape (len(x), k). Missing
+    neighbors (fewer than k points within distance_upper_bound) have an
+    infinite distance and the index self.n, like scipy's kd-tree.
+    """
+    x = self._as_queries(x)
+    k = int(k)
+    distances = np.empty((len(x), k))
+    distances.fill(np.inf)
+    indices = np.empty((len(x), k), dtype=np.int64)
+    indices.fill(self.n)
+    if not self.n or not k:
+      return distances, indices
+    # For every node, the smallest ancestor (or itself) with at least k points.
+    big_enough = np.arange(self.num_nodes)
+    parent = -np.ones(self.num_nodes, dtype=np.int64)
+    inner = np.flatnonzero(self.node_lesser >= 0)
+    parent[self.node_lesser[inner]] = inner
+    parent[self.node_greater[inner]] = inner
+    sizes = self.node_end - self.node_start
+    small = np.flatnonzero((sizes[big_enough] < k) & (parent[big_enough] >= 0))
+    while len(small):
+      big_enough[small] = parent[big_enough[small]]
+      small = small[(sizes[big_enough[small]] < k) & (parent[big_enough[small]] >= 0)]
+    def query_chunk(start, end):
+      chunk_x = x[start:end]
+      # The distance to the k'th nearest point of a node holding at least k
+      # points bounds the distance to the k'th neighbor.
+      node = big_enough[self._leaf_of(chunk_x)]
+      owner, position = expand_ranges(self.node_start[node], self.node_end[node])
+      diff = chunk_x[owner] - self.tree_data[position]
+      dist_sq = np.sum(diff * diff, axis=1)
+      order = np.lexsort((dist_sq, owner))
+      first = np.searchsorted(owner[order], np.arange(end - start))
+      bound = dist_sq[order][first + np.minimum(k, self.n) - 1]
+      # leave room for rounding differences between the two distance loops.
+      bound *= 1 + 1e-9
+      bound = np.minimum(bound, distance_upper_bound ** 2)
+      query, index, dist = self._pairs(chunk_x, bound, True)
+      # sort by query and then by distance with a single sort (much faster
+      # than lexsort), the distances are scaled into [0, 1).
+      scale = np.max(dist) * 1.001 if len(dist) else 1.
+      order = np.argsort(query + dist / (scale or 1.))
+      query = query[order]
+      index = index[order]
+      dist = dist[order]
+      first = np.searchsorted(query, np.arange(end - start))
+      rank = np.arange(len(query)) - first[query]
+      keep = rank < k
+      distances[start + query[keep], rank[keep]] = dist[keep]
+      indices[start + query[keep], rank[keep]] = index[keep]
+    map_chunks(query_chunk, len(x), chunk_size, num_threads)
+    return distances, indices
+
+  def query_range(self, mins, maxes):
+    """ Returns the indices of the points inside the box [mins, maxes].
+    """
+    mins = np.asarray(mins, dtype=np.float64).reshape(self.m)
+    maxes = np.asarray(maxes, dtype=np.float64).reshape(self.m)
+    nodes = np.zeros(1, dtype=np.int64)
+    found = []
+    while len(nodes):
+      overlap = np.all((self.node_maxes[nodes] >= mins) & (self.node_mins[nodes] <= maxes), axis=1)
+      nodes = nodes[overlap]
+      inside = np.all((self.node_mins[nodes] >= mins) & (self.node_maxes[nodes] <= maxes), axis=1)
+      owner, position = expand_ranges(self.node_start[nodes[inside]], self.node_end[nodes[inside]])
+      found.append(position)
+      nodes = nodes[~inside]
+      leaf = self.node_lesser[nodes] < 0
+      owner, position = expand_ranges(self.node_start[nodes[leaf]], self.node_end[nodes[leaf]])
+      pts = self.tree_data[position]
+      found.append(position[np.all((pts >= mins) & (pts <= maxes), axis=1)])
+      nodes = nodes[~leaf]
+      nodes = np.concatenate((self.node_lesser[nodes], self.node_greater[nodes]))
+    return np.sort(self.indices[np.concatenate(found)])
+
+MEM_CACHE.set_budget(KD_TREES, MEMORY_BUDGET)
+_CODE = []
+
+def _code():
+  """ Returns (function id, code digest) of the trees, see Cache.register_code.
+  """
+  if not _CODE:
+    _CODE.append(('biology.kdtree.KDTree', code_digest(KDTree)))
+    try:
+      CACHE.register_code(*_CODE[0])
+    except Exception:
+      logging.exception('Could not register the code version of the kd-tree')
+  return _CODE[0]
+
+def table_kd_tree(table, dims, disk=True):
+  """ Returns a KDTree over the table's events in the given dims. Trees are
+  kept in memory (namespace KD_TREES) and, if disk is True, in the disk
+  cache, keyed by the table fingerprint and the dims. Trees read from
+  disk are memory mapped, also in other processes.
+  """
+  key = 'kd tree <code %s>\n%s %s' % (_code()[1], table.hash_table(), repr(tuple(dims)))
+  found, tree = MEM_CACHE.lookup(key, KD_TREES)
+  if found:
+    return tree
+  return load_or_compute(
+      key, KD_TREES, lambda: KDTree(table.get_points(*dims)), _code(), disk,
+      max_disk_bytes=MAX_DISK_BYTES)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+""" In-process k-means clustering.
+
+The functions here work on a points array (rows are events, columns are
+dimensions) and return cluster labels rather than copies of the data, so
+they can be used on tables with tens of millions of events. Assignment is
+done in chunks on a thread pool (see chunked.py).
+"""
+import logging
+import numpy as np
+from biology.chunked import map_chunks
+from biology.chunked import DEFAULT_CHUNK_SIZE
+
+def as_random_state(random_state):
+  if isinstance(random_state, np.random.RandomState):
+    return random_state
+  return np.random.RandomState(random_state)
+
+def as_points(points, dtype):
+  points = np.asarray(points)
+  if points.ndim == 1:
+    points = points[:, np.newaxis]
+  if dtype != None:
+    points = np.asarray(points, dtype=dtype)
+  return points
+
+def squared_distances(points, centers):
+  """ Returns a (len(points), len(centers)) array of squared euclidean
+  distances. Uses |x|^2 - 2x.c + |c|^2 so that the heavy part is a single
+  matrix product.
+  """
+  points_sq = np.sum(points * points, axis=1)[:, np.newaxis]
+  centers_sq = np.sum(centers * centers, axis=1)[np.newaxis, :]
+  dist = np.dot(points, centers.T)
+  dist *= -2
+  dist += points_sq
+  dist += centers_sq
+  np.maximum(dist, 0, dist)
+  return dist
+
+def assign_labels(points, centers, chunk_size=DEFAULT_CHUNK_SIZE, num_threads=None):
+  """ Assigns every point to its nearest center.
+  Returns labels (int32) and the squared distance to the chosen center.
+  """
+  centers = np.asarray(centers, dtype=points.dtype)
+  labels = np.empty(len(points), dtype=np.int32)
+  min_dist = np.empty(len(points), dtype=points.dtype)
+  def assign_chunk(start, end):
+    dist = squared_distances(points[start:end], centers)
+    labels[start:end] = np.argmin(dist, axis=1)
+    min_dist[start:end] = dist[np.arange(end - start), labels[start:end]]
+  map_chunks(assign_chunk, len(points), chunk_size, num_threads)
+  return labels, min_dist
+
+def kmeans_plus_plus(points, k, random_state=None):
+  """ Chooses k initial centers using the k-means++ seeding.
+  """
+  random_state = as_random_state(random_state)
+  n = len(points)
+  if k > n:
+    raise ValueError('Cannot choose %d centers out of %d points' % (k, n))
+  centers = np.empty((k, points.shape[1]), dtype=points.dtype)
+  centers[0] = points[random_state.randint(n)]
+  closest = squared_distances(points, centers[:1])[:, 0]
+  for i in xrange(1, k):
+    total = np.sum(closest, dtype=np.float64)
+    if total <= 0:
+      # All remaining points coincide with a center.
+      centers[i] = points[random_state.randint(n)]
+    else:
+      cumulative = np.cumsum(closest, dtype=np.float64)
+      chosen = np.searchsorted(cumulative, random_state.uniform(0, total))
+      centers[i] = points[min(chosen, n - 1)]
+    np.minimum(closest, squared_distances(points, centers[i:i+1])[:, 0], closest)
+  return centers
+
+def minibatch_kmeans(points, k, batch_size=10000, max_iter=100, tol=1e-4,
+                     fit_sample_size=None, init_centers=None, random_state=None,
+                     chunk_size=DEFAULT_CHUNK_SIZE, num_threads=None, dtype=np.float32):
+  """ Mini-batch k-means (Sculley 2010).
+
+  points -- array of shape (num_events, num_dims).
+  k -- number of clusters.
+  batch_size -- number of points used for every center update.
+  max_iter -- maximal number of mini-batch iterations.
+  tol -- stop when no center moves more than tol (relative to the data scale).
+  fit_sample_size -- if given, the centers are fitted on a random sample of
+      this size and the rest of the points are only assigned.
+  init_centers -- optional (k, num_dims) array of initial centers. If None
+      k-means++ seeding over the fitting sample is used.
+  dtype -- computation dtype, float32 halves the memory traffic.
+
+  Returns centers, labels (int32 array, one label per point).
+  """
+  random_state = as_random_state(random_state)
+  points = as_points(points, dtype)
+  n = len(points)
+  if fit_sample_size and fit_sample_size < n:
+    fit_points = points[np.sort(random_state.permutation(n)[:fit_sample_size])]
+  else:
+    fit_points = points
+  if init_centers is None:
+    seed_points = fit_points
+    if len(seed_points) > 10 * batch_size:
+      seed_points = seed_points[random_state.permutation(len(seed_points))[:10 * batch_size]]
+    centers = kmeans_plus_plus(seed_points, k, random_state)
+  else:
+    centers = as_points(init_centers, points.dtype).copy()
+  counts = np.zeros(k, dtype=np.float64)
+  scale = np.max(np.std(fit_points, axis=0)) or 1.
+  for iteration in xrange(max_iter):
+    batch = fit_points[random_state.randint(0, len(fit_points), min(batch_size, len(fit_points)))]
+    labels, unused_dist = assign_labels(batch, centers, num_threads=1)
+    batch_counts = np.bincount(labels, minlength=k).astype(np.float64)
+    batch_sums = np.zeros(centers.shape, dtype=np.float64)
+    for dim in xrange(centers.shape[1]):
+      batch_sums[:, dim] = np.bincount(labels, weights=batch[:, dim], minlength=k)
+    new_counts = counts + batch_counts
+    updated = batch_counts > 0
+    new_centers = centers.astype(np.float64)
+    new_centers[updated] = (
+        new_centers[updated] * counts[updated, np.newaxis] + batch_sums[updated]) / new_counts[updated, np.newaxis]
+    shift = np.max(np.abs(new_centers - centers))
+    centers = new_centers.astype(points.dtype)
+    counts = new_counts
+    if iteration > 0 and shift < tol * scale:
+      break
+  logging.info('mini-batch k-means converged after %d iterations' % (iteration + 1))
+  labels, unused_dist = assign_labels(points, centers, chunk_size, num_threads)
+  return centers, labels
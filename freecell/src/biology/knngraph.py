@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+""" A cached k nearest neighbors graph per table and dims.
+
+Several algorithms (t-SNE, Isomap, density estimates, clustering) need the
+nearest neighbors of every event over the same dims. table_knn_graph
+computes the graph once, keeps it in the memory and disk caches (keyed by
+the table fingerprint and the dims, see cache.py), and hands it to every
+caller. A graph computed for k neighbors also serves any smaller k. Graphs
+over many dims are approximate, see biology.ann.
+"""
+import logging
+import numpy as np
+import biology.ann
+from biology.ann import nearest_neighbors
+from cache import CACHE
+from cache import MEM_CACHE
+from cache import TOTAL_MEMORY_BUDGET
+from cache import code_digest
+from cache import load_or_compute
+
+# The namespace of the graphs in the memory and disk caches.
+KNN_GRAPHS = 'knn_graphs'
+# Memory budget for the graphs that are not memory mapped, and bytes kept on
+# disk (the oldest graphs are removed beyond that).
+MEMORY_BUDGET = min(512 * 2 ** 20, TOTAL_MEMORY_BUDGET // 4)
+MAX_DISK_BYTES = 10 * 2 ** 30
+
+class KnnGraph(object):
+  """ The k nearest neighbors of every event, not including the event
+  itself, in compressed sparse row layout: the neighbors of event i are
+  indices[indptr[i]:indptr[i+1]] sorted by distance. Indices are int32 and
+  distances float32 to keep large graphs small.
+  """
+  def __init__(self, indptr, indices, distances, k):
+    self.indptr = indptr
+    self.indices = indices
+    self.distances = distances
+    self.k = k
+
+  @property
+  def num_points(self):
+    return len(self.indptr) - 1
+
+  def neighbors(self, i):
+    return self.indices[self.indptr[i]:self.indptr[i+1]]
+
+  def arrays(self, k=None):
+    """ Returns (distances, indices) arrays of shape (n, k) for the k nearest
+    neighbors (k can not be more than the graph's k).
+    """
+    if k == None:
+      k = self.k
+    if k > self.k:
+      raise ValueError('The graph only has %d neighbors per event' % self.k)
+    return (self.distances.reshape(-1, self.k)[:, :k],
+            self.indices.reshape(-1, self.k)[:, :k])
+
+  def truncated(self, k):
+    """ Returns the graph of the k nearest neighbors.
+    """
+    if k == self.k:
+      return self
+    distances, indices = self.arrays(k)
+    indptr = np.arange(0, self.num_points * k + 1, k, dtype=np.int64)
+    return KnnGraph(indptr, indices.ravel(), distances.ravel(), k)
+
+  def to_csr(self, symmetric=False):
+    """ Returns the graph as a scipy CSR matrix of distances. If symmetric
+    is True, an edge in either direction is an edge.
+    """
+    from scipy.sparse import csr_matrix
+    n = self.num_points
+    graph = csr_matrix(
+        (self.distances.astype(np.float64), self.indices, self.indptr), shape=(n, n))
+    if symmetric:
+      graph = graph.maximum(graph.T).tocsr()
+    return graph
+
+def compute_knn_graph(points, k, num_threads=None):
+  """ Computes the k nearest neighbors graph of points, exactly with the
+  kd-tree in low dimensions and approximately at full panel width (see
+  biology.ann.nearest_neighbors).
+  """
+  n = len(points)
+  dist, indices = nearest_neighbors(points, k, num_threads)
+  k = indices.shape[1]
+  indptr = np.arange(0, n * k + 1, k, dtype=np.int64) if k else np.zeros(n + 1, dtype=np.int64)
+  return KnnGraph(indptr, indices.ravel().astype(np.int32), dist.ravel().astype(np.float32), k)
+
+MEM_CACHE.set_budget(KNN_GRAPHS, MEMORY_BUDGET)
+_CODE = []
+
+def _code():
+  """ Returns (function id, code digest) of the graphs, see Cache.register_code.
+  """
+  if not _CODE:
+    _CODE.append((
+        'biology.knngraph.compute_knn_graph',
+        code_digest(compute_knn_graph, KnnGraph, biology.ann)))
+    try:
+      CACHE.register_code(*_CODE[0])
+    except Exception:
+      logging.exception('Could not register the code version of the knn graph')
+  return _CODE[0]
+
+def table_knn_graph(table, dims, k, disk=True, num_threads=None):
+  """ Returns the KnnGraph of the table's events over dims with k neighbors.
+  The graph is computed once per table fingerprint and dims, and is kept
+  in memory (namespace KNN_GRAPHS) and, if disk is True, in the disk
+  cache, where its arrays are memory mapped.
+  """
+  key = 'knn graph <code %s>\n%s %s' % (_code()[1], table.hash_table(), repr(tuple(dims)))
+  found, graph = MEM_CACHE.lookup(key, KNN_GRAPHS)
+  if not found or graph.k < k:
+    graph = load_or_compute(
+        key, KNN_GRAPHS, lambda: compute_knn_graph(table.get_points(*dims), k, num_threads),
+        _code(), disk, usable=lambda graph: graph.k >= k, max_disk_bytes=MAX_DISK_BYTES)
+  return graph.truncated(min(k, graph.k))
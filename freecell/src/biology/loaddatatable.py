@@ -5,6 +5,7 @@ from StringIO import StringIO
 import random
 import struct
 import os
+import time
 from collections import namedtuple
 import numpy as np
 from numpy import array
@@ -13,6 +14,7 @@ from biology.markers import Markers
 from biology.markers import marker_from_name
 from biology.markers import normalize_markers
 from biology.datatable import DataTable
+from memorygovernor import GOVERNOR
 
 def get_num_events(filename):
   """Extracts data from an fcs file. 
@@ -205,10 +207,27 @@ def fcsextract(filename):
   return fcs_vars,events,is_peng
 
 load_data_table_CACHE = {}
+# (last used time, load time) of every table in load_data_table_CACHE.
+load_data_table_USAGE = {}
+
+def _loaded_tables():
+  ret = []
+  for key, table in load_data_table_CACHE.items():
+    last_used, load_time = load_data_table_USAGE.get(key, (0., 0.))
+    ret.append((key, table.data.nbytes, last_used, load_time))
+  return ret
+
+def _evict_loaded_table(key):
+  load_data_table_CACHE.pop(key, None)
+  load_data_table_USAGE.pop(key, None)
+
+GOVERNOR.register('fcs tables', _loaded_tables, _evict_loaded_table)
+
 def load_data_table(filename, extra_dims=[], extra_vals=[], extra_legends=[], arcsin_factor=1):
   global load_data_table_CACHE
   if not filename:
     raise Exception('No filename was provided to load_data_table')
+  start = time.time()
   if not (filename, arcsin_factor)  in load_data_table_CACHE:
     fcs_vars, events, is_peng = fcsextract(filename)
     if not events.shape:
@@ -246,4 +265,9 @@ def load_data_table(filename, extra_dims=[], extra_vals=[], extra_legends=[], ar
     data = np.append(data, extra_vals_arr, axis=1)    
     load_data_table_CACHE[(filename, arcsin_factor)] = biology.datatable.DataTable(data, dim_names, legends)
     logging.info('Loaded %d cells from file %s' % (load_data_table_CACHE[(filename, arcsin_factor)].data.shape[0], filename[:30]))
+    load_data_table_USAGE[(filename, arcsin_factor)] = [time.time(), time.time() - start]
+    table = load_data_table_CACHE[(filename, arcsin_factor)]
+    GOVERNOR.check()
+    return table
+  load_data_table_USAGE[(filename, arcsin_factor)][0] = time.time()
   return load_data_table_CACHE[(filename, arcsin_factor)]
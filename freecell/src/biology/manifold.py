@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+""" In-process Isomap and LLE.
+
+Both methods work on a k nearest neighbors graph and use landmarks to scale:
+the expensive part (geodesic distances / the sparse eigenproblem) is done
+for a subset of the events, and every event is then embedded with a
+Nystrom style extension. Unlike the matlab versions, no events are dropped:
+the neighbors graph is connected before it is used.
+"""
+import logging
+import numpy as np
+from scipy.sparse import coo_matrix
+from biology.kdtree import KDTree
+from biology.ann import nearest_neighbors
+from biology.kmeans import as_points
+from biology.kmeans import as_random_state
+from biology.chunked import chunk_ranges
+from biology.embedding import cmdscale
+
+DEFAULT_NUM_LANDMARKS = 2000
+# dijkstra runs from at most DIJKSTRA_CHUNK_SIZE landmarks at once, and
+# on fewer if their distances would take more than MAX_CHUNK_BYTES.
+DIJKSTRA_CHUNK_SIZE = 64
+MAX_CHUNK_BYTES = 2 ** 26
+# isomap keeps the distances from all the landmarks to all the events if
+# they fit in MAX_DISTANCE_BYTES, and otherwise runs dijkstra twice.
+MAX_DISTANCE_BYTES = 2 ** 27
+
+def knn_graph(points, k, num_threads=None):
+  """ Returns the symmetric k nearest neighbors graph of points as a CSR
+  matrix whose entries are euclidean distances.
+  """
+  points = as_points(points, np.float64)
+  n = len(points)
+  dist, neighbors = nearest_neighbors(points, k, num_threads)
+  rows = np.repeat(np.arange(n), neighbors.shape[1])
+  graph = coo_matrix((dist.ravel(), (rows, neighbors.ravel())), shape=(n, n)).tocsr()
+  # an edge in either direction is an edge, keep the distance.
+  return graph.maximum(graph.T).tocsr()
+
+def connect_components(graph, points):
+  """ Adds edges so that the graph is connected: every component is linked
+  to the largest one by the shortest edge between them.
+  """
+  from scipy.sparse.csgraph import connected_components
+  num_components, labels = connected_components(graph, directed=False)
+  if num_components == 1:
+    return graph
+  logging.info('Connecting %d components of the neighbors graph' % num_components)
+  largest = np.argmax(np.bincount(labels))
+  main = np.flatnonzero(labels == largest)
+  others = np.flatnonzero(labels != largest)
+  dist, nearest = KDTree(points[main]).query(points[others], 1)
+  dist = dist[:, 0]
+  # the closest event of every other component to the main component
+  order = np.lexsort((dist, labels[others]))
+  first = np.concatenate(([True], labels[others][order][1:] != labels[others][order][:-1]))
+  chosen = order[first]
+  src = others[chosen]
+  dst = main[nearest[chosen, 0]]
+  # zero length edges would be dropped by the sparse matrix.
+  weights = np.maximum(dist[chosen], np.finfo(np.float64).tiny)
+  extra = coo_matrix(
+      (np.concatenate((weights, weights)), (np.concatenate((src, dst)), np.concatenate((dst, src)))),
+      shape=graph.shape)
+  return (graph + extra).tocsr()
+
+def choose_landmarks(n, num_landmarks, random_state=None):
+  random_state = as_random_state(random_state)
+  if n <= num_landmarks:
+    return np.arange(n)
+  return np.sort(random_state.permutation(n)[:num_landmarks])
+
+def isomap(points, no_dims=2, k=12, num_landmarks=DEFAULT_NUM_LANDMARKS,
+           random_state=0, graph=None, num_threads=None):
+  """ Landmark Isomap (de Silva and Tenenbaum 2003).
+
+  Geodesic distances are computed with dijkstra from the landmarks only,
+  the landmarks are embedded with classical MDS and all the events are
+  placed by distance-based triangulation.
+  graph -- optional precomputed neighbors graph (see knn_graph).
+
+  Returns an (n, no_dims) array.
+  """
+  from scipy.sparse.csgraph import dijkstra
+  points = as_points(points, np.float64)
+  n = len(points)
+  if graph is None:
+    graph = knn_graph(points, k, num_threads)
+  graph = connect_components(graph, points)
+  landmarks = choose_landmarks(n, num_landmarks, random_state)
+  num = len(landmarks)
+  chunk_size = max(1, min(DIJKSTRA_CHUNK_SIZE, MAX_CHUNK_BYTES // (8 * n)))
+  def squared_distances(start, end):
+    return dijkstra(graph, directed=False, indices=landmarks[start:end]) ** 2
+  # only the landmark to landmark distances are needed to embed the
+  # landmarks. The distances to all the events are kept (in float32) only
+  # if they are small, memory is otherwise num ** 2 + n * no_dims.
+  keep_all = num * n * 4 <= MAX_DISTANCE_BYTES
+  all_dist_sq = np.empty((num, n), dtype=np.float32) if keep_all else None
+  landmark_dist_sq = np.empty((num, num))
+  for start, end in chunk_ranges(num, chunk_size):
+    dist_sq = squared_distances(start, end)
+    landmark_dist_sq[start:end] = dist_sq[:, landmarks]
+    if keep_all:
+      all_dist_sq[start:end] = dist_sq
+  landmark_coords, eig = cmdscale(np.sqrt(landmark_dist_sq), no_dims)
+  eig = eig[:no_dims]
+  positive = eig > 0
+  # pseudo inverse transpose of the landmark embedding
+  pinv = np.zeros((num, no_dims))
+  pinv[:, positive] = landmark_coords[:, positive] / eig[positive]
+  mean_dist_sq = np.mean(landmark_dist_sq, axis=1)
+  # the placement is linear in the landmark rows, so it is summed over the
+  # chunks of landmarks.
+  ret = np.zeros((n, no_dims))
+  for start, end in chunk_ranges(num, chunk_size):
+    if keep_all:
+      dist_sq = np.asarray(all_dist_sq[start:end], dtype=np.float64)
+    else:
+      dist_sq = squared_distances(start, end)
+    dist_sq -= mean_dist_sq[start:end, np.newaxis]
+    ret -= 0.5 * np.dot(dist_sq.T, pinv[start:end])
+  return ret
+
+def _batched_spd_solve(a, b):
+  """ Solves a[i] x[i] = b[i] for a stack of symmetric positive definite
+  matrices a (m, k, k) and vectors b (m, k), with gaussian elimination
+  vectorized over the stack.
+  """
+  a = a.copy()
+  b = b.copy()
+  k = a.shape[1]
+  for j in xrange(k):
+    factor = a[:, j+1:, j] / a[:, j, j][:, np.newaxis]
+    a[:, j+1:, j:] -= factor[:, :, np.newaxis] * a[:, j, np.newaxis, j:]
+    b[:, j+1:] -= factor * b[:, j, np.newaxis]
+  x = np.empty(b.shape)
+  for j in xrange(k - 1, -1, -1):
+    x[:, j] = (b[:, j] - np.sum(a[:, j, j+1:] * x[:, j+1:], axis=1)) / a[:, j, j]
+  return x
+
+def reconstruction_weights(points, reference, neighbors, reg=1e-3, chunk_size=10000):
+  """ The LLE weights that best reconstruct points[i] from
+  reference[neighbors[i]], every row sums to 1.
+  Returns an array shaped like neighbors.
+  """
+  n, k = neighbors.shape
+  weights = np.empty((n, k))
+  for start, end in chunk_ranges(n, chunk_size):
+    z = reference[neighbors[start:end]] - points[start:end, np.newaxis, :]
+    gram = np.einsum('ijk,ilk->ijl', z, z)
+    trace = np.trace(gram, axis1=1, axis2=2)
+    trace[trace == 0] = 1
+    gram += (reg * trace)[:, np.newaxis, np.newaxis] * np.eye(k)
+    w = _batched_spd_solve(gram, np.ones((end - start, k)))
+    weights[start:end] = w / np.sum(w, axis=1)[:, np.newaxis]
+  return weights
+
+def lle(points, no_dims=2, k=12, reg=1e-3, num_landmarks=DEFAULT_NUM_LANDMARKS,
+        random_state=0, num_threads=None):
+  """ Locally linear embedding (Roweis and Saul 2000) over landmarks.
+
+  The landmarks are embedded with LLE: the bottom eigenvectors of the
+  sparse matrix (I - W)^T (I - W) are found with eigsh. Every event is
+  then placed with its reconstruction weights from its k nearest
+  landmarks, the usual out of sample extension.
+
+  Returns an (n, no_dims) array.
+  """
+  from scipy.sparse import identity
+  from scipy.sparse.linalg import eigsh
+  points = as_points(points, np.float64)
+  n = len(points)
+  landmarks = choose_landmarks(n, num_landmarks, random_state)
+  landmark_points = points[landmarks]
+  num = len(landmarks)
+  k = min(k, num - 1)
+  tree = KDTree(landmark_points)
+  dist, neighbors = tree.query(landmark_points, k + 1, num_threads=num_threads)
+  neighbors = neighbors[:, 1:]
+  weights = reconstruction_weights(landmark_points, landmark_points, neighbors, reg)
+  w = coo_matrix((weights.ravel(), (np.repeat(np.arange(num), k), neighbors.ravel())), shape=(num, num))
+  m = identity(num, format='csr') - w.tocsr()
+  m = (m.T * m).tocsr()
+  if num <= 2000:
+    values, vectors = np.linalg.eigh(m.toarray())
+  else:
+    # shift-invert just below zero, m itself is singular.
+    values, vectors = eigsh(m, k=no_dims + 1, sigma=-1e-6, which='LM')
+  order = np.argsort(values)
+  # the bottom eigenvector is constant, skip it.
+  landmark_coords = vectors[:, order[1:no_dims + 1]]
+  ret = np.empty((n, no_dims))
+  for start, end in chunk_ranges(n, 100000):
+    dist, neighbors = tree.query(points[start:end], k, num_threads=num_threads)
+    w = reconstruction_weights(points[start:end], landmark_points, neighbors, reg)
+    ret[start:end] = np.sum(landmark_coords[neighbors] * w[:, :, np.newaxis], axis=1)
+  ret[landmarks] = landmark_coords
+  return ret
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+""" Permutation and bootstrap tests for comparing populations.
+
+Permutations are run in batches: a batch is a (batch_size, n) boolean array
+telling which of the pooled values go to the first sample in every
+permutation, so a whole batch is a few array operations. The pooled values
+are sorted once and shared by all the permutations (the KS statistic only
+needs the labels in sorted order). Batches run on a thread pool.
+
+The tests are sequential: after every round of batches the p-value is
+bounded with a Clopper-Pearson interval, and the test stops as soon as the
+interval is entirely above or below alpha (the decision can no longer
+change). Clearly significant and clearly insignificant comparisons stop
+after a single round.
+"""
+import numpy as np
+from scipy.stats import beta as beta_distribution
+from biology.chunked import map_chunks
+from biology.chunked import default_num_threads
+from biology.kmeans import as_random_state
+
+STATISTICS = ['ks', 'mean']
+DEFAULT_PERMUTATIONS = 1000
+BATCH_SIZE = 100
+# confidence of the interval used to stop the sequential test
+STOP_CONFIDENCE = 0.99
+# larger samples are uniformly subsampled to this size before testing
+MAX_SAMPLE_SIZE = 10000
+
+def _subsample(values, max_size, random_state):
+  values = np.asarray(values, dtype=np.float64).ravel()
+  if max_size and len(values) > max_size:
+    values = values[random_state.permutation(len(values))[:max_size]]
+  return values
+
+def _random_labels(num_rows, n, n_first, random_state):
+  """ Returns a (num_rows, n) boolean array with exactly n_first True
+  values at random positions in every row.
+  """
+  keys = random_state.random_sample((num_rows, n))
+  if n_first == n:
+    return np.ones((num_rows, n), dtype=bool)
+  threshold = np.partition(keys, n_first, axis=1)[:, n_first]
+  return keys < threshold[:, np.newaxis]
+
+class _PooledSamples(object):
+  """ Two samples pooled and sorted once, with the statistics of any
+  labeling of the pooled values.
+  """
+  def __init__(self, x, y):
+    self.n_x = len(x)
+    self.n_y = len(y)
+    pooled = np.concatenate((x, y))
+    order = np.argsort(pooled, kind='mergesort')
+    self.values = pooled[order]
+    self.observed = (order < self.n_x)[np.newaxis, :]
+    # the empirical CDFs are compared at the last copy of every value.
+    self.run_ends = np.flatnonzero(np.concatenate((self.values[1:] != self.values[:-1], [True])))
+
+  def statistic(self, labels, name):
+    """ labels -- (rows, n) boolean array, True for values of the first
+    sample (in sorted order). Returns a statistic per row.
+    """
+    if name == 'ks':
+      cdf_x = np.cumsum(labels, axis=1)[:, self.run_ends]
+      cdf_y = (self.run_ends + 1) - cdf_x
+      return np.max(np.abs(cdf_x / float(self.n_x) - cdf_y / float(self.n_y)), axis=1)
+    elif name == 'mean':
+      sum_x = np.dot(labels, self.values)
+      sum_y = np.sum(self.values) - sum_x
+      return np.abs(sum_x / self.n_x - sum_y / self.n_y)
+    raise ValueError('Unknown statistic %s, use one of %s' % (name, ', '.join(STATISTICS)))
+
+def _p_value_bounds(exceed, num_permutations, confidence):
+  """ Clopper-Pearson interval for the probability of exceeding the
+  observed statistic.
+  """
+  tail = (1 - confidence) / 2
+  low = beta_distribution.ppf(tail, exceed, num_permutations - exceed + 1) if exceed else 0.
+  high = beta_distribution.ppf(1 - tail, exceed + 1, num_permutations - exceed) if exceed < num_permutations else 1.
+  return low, high
+
+def permutation_test(x, y, statistic='ks', num_permutations=DEFAULT_PERMUTATIONS, alpha=0.05,
+                     sequential=True, max_sample_size=MAX_SAMPLE_SIZE, batch_size=BATCH_SIZE,
+                     random_state=0, num_threads=None):
+  """ Tests whether x and y come from the same distribution.
+  statistic -- 'ks' (two sample Kolmogorov-Smirnov) or 'mean' (absolute
+      difference of means).
+  alpha -- the significance level the sequential test decides about. With
+      sequential=False all num_permutations permutations are run.
+  Returns (observed statistic, p-value, number of permutations run). The
+  p-value is (exceed + 1) / (permutations + 1).
+  """
+  random_state = as_random_state(random_state)
+  x = _subsample(x, max_sample_size, random_state)
+  y = _subsample(y, max_sample_size, random_state)
+  if not len(x) or not len(y):
+    return 0., 1., 0
+  pooled = _PooledSamples(x, y)
+  observed = pooled.statistic(pooled.observed, statistic)[0]
+  if num_threads == None:
+    num_threads = default_num_threads()
+  round_batches = max(1, num_threads)
+  exceed = 0
+  done = 0
+  while done < num_permutations:
+    # every batch has its own seed, so the result does not depend on the
+    # number of threads.
+    seeds = random_state.randint(2 ** 31, size=round_batches)
+    sizes = [min(batch_size, max(0, num_permutations - done - i * batch_size)) for i in xrange(round_batches)]
+    def run_batches(start, end):
+      count = 0
+      for i in xrange(start, end):
+        if not sizes[i]:
+          continue
+        labels = _random_labels(sizes[i], len(pooled.values), pooled.n_x, np.random.RandomState(seeds[i]))
+        # a small tolerance so that equal statistics count as exceeding
+        count += np.sum(pooled.statistic(labels, statistic) >= observed - 1e-12)
+      return count
+    exceed += sum(map_chunks(run_batches, round_batches, 1, num_threads))
+    done += sum(sizes)
+    if sequential and alpha != None:
+      low, high = _p_value_bounds(exceed, done, STOP_CONFIDENCE)
+      if high < alpha or low > alpha:
+        break
+  return observed, (exceed + 1.) / (done + 1.), done
+
+def pairwise_permutation_tests(tables, dims, statistic='ks', **kargs):
+  """ Runs permutation_test between every pair of tables over every dim.
+  Extra arguments are passed to permutation_test.
+  Returns (statistics, p_values), arrays of shape
+  (len(tables), len(tables), len(dims)). Diagonal entries are 0 and 1.
+  """
+  num = len(tables)
+  statistics = np.zeros((num, num, len(dims)))
+  p_values = np.ones((num, num, len(dims)))
+  for d, dim in enumerate(dims):
+    cols = [t.get_cols(dim)[0] for t in tables]
+    for i in xrange(num):
+      for j in xrange(i + 1, num):
+        stat, p, runs = permutation_test(cols[i], cols[j], statistic, **kargs)
+        statistics[i, j, d] = statistics[j, i, d] = stat
+        p_values[i, j, d] = p_values[j, i, d] = p
+  return statistics, p_values
+
+def bootstrap_interval(values, statistic='mean', num_resamples=DEFAULT_PERMUTATIONS, confidence=0.95,
+                       max_sample_size=MAX_SAMPLE_SIZE, batch_size=BATCH_SIZE, random_state=0):
+  """ Percentile bootstrap confidence interval of the mean or the median
+  of values. Resamples are drawn in batches of index arrays.
+  Returns (low, high).
+  """
+  random_state = as_random_state(random_state)
+  values = _subsample(values, max_sample_size, random_state)
+  if not len(values):
+    return np.nan, np.nan
+  if statistic == 'mean':
+    func = lambda resampled: np.mean(resampled, axis=1)
+  elif statistic == 'median':
+    func = lambda resampled: np.median(resampled, axis=1)
+  else:
+    raise ValueError('Unknown statistic %s, use mean or median' % statistic)
+  results = []
+  for start in xrange(0, num_resamples, batch_size):
+    rows = min(batch_size, num_resamples - start)
+    results.append(func(values[random_state.randint(len(values), size=(rows, len(values)))]))
+  results = np.concatenate(results)
+  tail = (1 - confidence) / 2 * 100
+  return np.percentile(results, tail), np.percentile(results, 100 - tail)
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+""" Downsampling of event tables.
+
+Every function here returns a sorted array of row indices rather than a
+copy of the data, so a sample can be kept around cheaply and applied to any
+table with the same rows (see DataTable.sample). All the modes are seeded,
+so the same call gives the same sample.
+
+Modes:
+  uniform -- every event has the same chance.
+  stratified -- the same fraction of events from every value of a tag
+      column (or the same number of events, if balanced).
+  density -- density dependent downsampling (as in SPADE, Qiu et al. 2011):
+      events in dense regions are dropped more often, so rare populations
+      and outliers survive the sampling.
+  spread -- a Poisson disk sample: no two sampled events are closer than a
+      radius, which is tuned to give the wanted number of events. Covers the
+      space like farthest point sampling, in O(n log n).
+"""
+import logging
+import numpy as np
+from biology.kdtree import KDTree
+from biology.kmeans import as_points
+from biology.kmeans import as_random_state
+
+SAMPLING_MODES = ['uniform', 'stratified', 'density', 'spread']
+# density is estimated within DENSITY_RADIUS_FACTOR times the median
+# distance to the nearest neighbor, measured on a sample of this many points.
+DENSITY_RADIUS_FACTOR = 5.
+NEAREST_NEIGHBOR_SAMPLE = 2000
+# spread_sample bisects the radius at most SPREAD_ITERS times, and stops
+# once the sample holds up to SPREAD_SLACK times the wanted points.
+SPREAD_ITERS = 20
+SPREAD_SLACK = 1.05
+
+def uniform_sample(num_items, n, random_state=0):
+  """ Returns n indices out of xrange(num_items), sorted.
+  """
+  random_state = as_random_state(random_state)
+  n = min(int(n), num_items)
+  return np.sort(random_state.permutation(num_items)[:n])
+
+def _allocate(sizes, n, balanced):
+  """ Splits n between groups with the given sizes, proportionally (largest
+  remainder) or equally if balanced, never more than a group holds.
+  """
+  n = min(n, np.sum(sizes))
+  if balanced:
+    # raise the common share until n is reached, small groups give all.
+    order = np.sort(sizes)
+    share = 0
+    for i, size in enumerate(order):
+      left = n - np.sum(order[:i])
+      if size * (len(order) - i) >= left:
+        share = left // (len(order) - i)
+        break
+    counts = np.minimum(sizes, share)
+  else:
+    exact = sizes * float(n) / max(np.sum(sizes), 1)
+    counts = np.floor(exact).astype(np.int64)
+  extra = n - np.sum(counts)
+  if extra > 0:
+    room = np.flatnonzero(counts < sizes)
+    remainder = (sizes * float(n) / max(np.sum(sizes), 1) - counts)[room]
+    counts[room[np.argsort(-remainder, kind='mergesort')[:extra]]] += 1
+  return counts
+
+def stratified_sample(labels, n, balanced=False, random_state=0):
+  """ Returns n indices sampled uniformly within every distinct value of
+  labels. The groups are represented proportionally to their size, or
+  equally if balanced is True (groups that are too small are taken whole).
+  """
+  random_state = as_random_state(random_state)
+  labels = np.asarray(labels)
+  values, groups = np.unique(labels, return_inverse=True)
+  sizes = np.bincount(groups)
+  counts = _allocate(sizes, int(n), balanced)
+  # random order within every group, then the first counts[g] of group g.
+  order = np.lexsort((random_state.random_sample(len(labels)), groups))
+  group_starts = np.cumsum(sizes) - sizes
+  rank = np.arange(len(labels)) - group_starts[groups[order]]
+  return np.sort(order[rank < counts[groups[order]]])
+
+def local_density(points, radius=None, tree=None, num_threads=None, random_state=0):
+  """ Returns the number of points within radius of every point. The
+  default radius is DENSITY_RADIUS_FACTOR times the median nearest
+  neighbor distance.
+  """
+  if tree == None:
+    tree = KDTree(points)
+  if radius == None:
+    radius = DENSITY_RADIUS_FACTOR * median_neighbor_distance(points, tree, random_state)
+  return tree.count_ball_point(points, radius, num_threads=num_threads)
+
+def median_neighbor_distance(points, tree=None, random_state=0):
+  """ Estimates the median distance between a point and its nearest
+  neighbor from NEAREST_NEIGHBOR_SAMPLE points.
+  """
+  if tree == None:
+    tree = KDTree(points)
+  sample = points[uniform_sample(len(points), NEAREST_NEIGHBOR_SAMPLE, random_state)]
+  dist, indices = tree.query(sample, 2)
+  dist = dist[:, 1]
+  dist = dist[np.isfinite(dist) & (dist > 0)]
+  if not len(dist):
+    return 1.
+  return np.median(dist)
+
+def density_sample(points, n, radius=None, tree=None, num_threads=None, random_state=0):
+  """ Returns n indices sampled with probability inversely related to the
+  local density (see local_density), so sparse regions are kept.
+  """
+  random_state = as_random_state(random_state)
+  points = as_points(points, np.float64)
+  n = min(int(n), len(points))
+  density = local_density(points, radius, tree, num_threads, random_state)
+  # weighted sampling without replacement (Efraimidis and Spirakis 2006):
+  # the n largest u ** (1 / weight), here with weight = 1 / density.
+  keys = np.log(random_state.random_sample(len(points))) * density
+  return np.sort(np.argsort(-keys, kind='mergesort')[:n])
+
+def poisson_disk_sample(points, radius, random_state=0):
+  """ Returns indices of points such that no two are within radius of each
+  other, and every other point is within 2 * radius of one of them.
+
+  Each grid cell with a diagonal of radius holds at most one sample, so only
+  the first point of every cell (in a random order) is a candidate. The
+  candidates then pick a maximal independent set in rounds (Luby 1986): a
+  candidate joins when it comes before all its undecided neighbors, and its
+  neighbors leave.
+  """
+  random_state = as_random_state(random_state)
+  points = as_points(points, np.float64)
+  if not len(points):
+    return np.zeros(0, dtype=np.int64)
+  priority = random_state.permutation(len(points))
+  side = radius / np.sqrt(points.shape[1])
+  cells = np.floor((points - np.min(points, axis=0)) / side).astype(np.int64)
+  order = np.lexsort((priority,) + tuple(cells.T))
+  cells = cells[order]
+  first = np.concatenate(([True], np.any(cells[1:] != cells[:-1], axis=1)))
+  candidates = order[first]
+  tree = KDTree(points[candidates])
+  queries, neighbors = tree.query_ball_point_pairs(points[candidates], radius)
+  different = queries != neighbors
+  queries = queries[different]
+  neighbors = neighbors[different]
+  candidate_priority = priority[candidates]
+  undecided = np.ones(len(candidates), dtype=bool)
+  selected = np.zeros(len(candidates), dtype=bool)
+  while np.any(undecided):
+    live = undecided[queries] & undecided[neighbors]
+    queries = queries[live]
+    neighbors = neighbors[live]
+    # pairs are sorted by query, so every query's neighbors are a segment.
+    first_neighbor = np.empty(len(candidates), dtype=np.int64)
+    first_neighbor.fill(len(points))
+    if len(queries):
+      starts = np.flatnonzero(np.concatenate(([True], queries[1:] != queries[:-1])))
+      first_neighbor[queries[starts]] = np.minimum.reduceat(candidate_priority[neighbors], starts)
+    joining = undecided & (candidate_priority < first_neighbor)
+    selected |= joining
+    undecided &= ~joining
+    undecided[neighbors[joining[queries]]] = False
+  return np.sort(candidates[selected])
+
+def spread_sample(points, n, random_state=0):
+  """ Returns n well spread indices: a Poisson disk sample (see
+  poisson_disk_sample) whose radius is found by bisection so that it holds
+  at least n points, trimmed uniformly to n.
+  """
+  random_state = as_random_state(random_state)
+  points = as_points(points, np.float64)
+  n = min(int(n), len(points))
+  if n == len(points):
+    return np.arange(n)
+  seed = random_state.randint(2 ** 31)
+  low = 0.
+  high = np.sqrt(np.sum((np.max(points, axis=0) - np.min(points, axis=0)) ** 2)) or 1.
+  best = np.arange(len(points))
+  for i in xrange(SPREAD_ITERS):
+    radius = (low + high) / 2
+    indices = poisson_disk_sample(points, radius, seed)
+    if len(indices) >= n:
+      low = radius
+      best = indices
+      if len(indices) <= n * SPREAD_SLACK:
+        break
+    else:
+      high = radius
+  logging.info('Poisson disk radius %g gives %d points' % (low, len(best)))
+  return np.sort(best[uniform_sample(len(best), n, random_state)])
+
+def sample_indices(points, n, mode='uniform', labels=None, balanced=False, random_state=0, **kargs):
+  """ Returns n sorted row indices using one of SAMPLING_MODES.
+  points -- (n, dims) array, used by the density and spread modes (for the
+      other modes only its length matters).
+  labels -- the tag value of every row, for the stratified mode.
+  Extra arguments are passed to density_sample.
+  """
+  if mode == 'uniform':
+    return uniform_sample(len(points), n, random_state)
+  elif mode == 'stratified':
+    if labels is None:
+      raise ValueError('Stratified sampling needs labels')
+    return stratified_sample(labels, n, balanced, random_state)
+  elif mode == 'density':
+    return density_sample(points, n, random_state=random_state, **kargs)
+  elif mode == 'spread':
+    return spread_sample(points, n, random_state)
+  raise ValueError('Unknown sampling mode %s' % mode)
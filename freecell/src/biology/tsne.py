@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+""" In-process Barnes-Hut t-SNE (van der Maaten 2014).
+
+The input affinities are computed over the k nearest neighbors only, so P is
+a sparse matrix. The repulsive forces are approximated with a space
+partitioning tree (a quadtree for 2d embeddings) that is traversed dual-tree
+style: pairs of cells that are far enough apart interact as a whole, and
+all the cell pairs of a level are handled with array operations.
+
+Nothing is written to disk, so any number of embeddings can run at once.
+"""
+import logging
+import numpy as np
+from biology.chunked import map_chunks
+from biology.ann import nearest_neighbors
+from biology.kdtree import expand_ranges
+from biology.embedding import pca
+from biology.kmeans import as_random_state
+
+MAX_TREE_LEVELS = 20
+# number of P entries handled by every thread task
+EDGE_CHUNK_SIZE = 1000000
+
+def _conditional_probabilities(dist_sq, perplexity, tol=1e-5, max_iter=100):
+  """ Finds for every row the gaussian precision that gives the wanted
+  perplexity over its neighbors (binary search done for all rows at once).
+  dist_sq -- (n, k) squared distances to the k nearest neighbors.
+  Returns the (n, k) conditional probabilities p(j|i).
+  """
+  n = len(dist_sq)
+  target = np.log(perplexity)
+  beta = np.ones(n)
+  beta_min = np.zeros(n)
+  beta_max = np.empty(n)
+  beta_max.fill(np.inf)
+  # subtracting the nearest distance keeps the exponents in range
+  shifted = dist_sq - dist_sq[:, :1]
+  for i in xrange(max_iter):
+    p = np.exp(-shifted * beta[:, np.newaxis])
+    sum_p = np.maximum(np.sum(p, axis=1), 1e-12)
+    entropy = np.log(sum_p) + beta * np.sum(shifted * p, axis=1) / sum_p
+    diff = entropy - target
+    if np.all(np.abs(diff) < tol):
+      break
+    too_flat = diff > 0
+    beta_min[too_flat] = beta[too_flat]
+    beta_max[~too_flat] = beta[~too_flat]
+    beta = np.where(
+        np.isinf(beta_max),
+        beta * 2,
+        (beta_min + beta_max) / 2)
+  return p / sum_p[:, np.newaxis]
+
+def needed_neighbors(n, perplexity):
+  """ The number of nearest neighbors used for the affinities.
+  """
+  return min(n - 1, int(3 * perplexity))
+
+def joint_probabilities(points, perplexity=30, knn=None, num_threads=None):
+  """ Returns the symmetric t-SNE input affinities as coordinate arrays
+  (rows, cols, values) of a sparse matrix that sums to 1.
+  knn -- optional precomputed (distances, indices) arrays of the nearest
+      neighbors of every point, not including the point itself (see
+      biology.knngraph). At least needed_neighbors columns are needed.
+  """
+  n = len(points)
+  k = needed_neighbors(n, perplexity)
+  if knn is None:
+    dist, neighbors = nearest_neighbors(points, k, num_threads)
+  else:
+    dist = np.asarray(knn[0][:, :k], dtype=np.float64)
+    neighbors = knn[1][:, :k]
+  conditional = _conditional_probabilities(dist ** 2, perplexity)
+  from scipy.sparse import coo_matrix
+  p = coo_matrix(
+      (conditional.ravel(), (np.repeat(np.arange(n), k), neighbors.ravel())),
+      shape=(n, n)).tocsr()
+  p = (p + p.T).tocoo()
+  return p.row, p.col, p.data / np.sum(p.data)
+
+class _SpaceTree(object):
+  """ A 2^d-tree over the embedding, stored level by level. The cells of a
+  level are sorted by their morton code, so the children of a cell are a
+  contiguous range in the next level.
+  """
+  def __init__(self, y):
+    n, d = y.shape
+    self.n = n
+    levels = min(MAX_TREE_LEVELS, 62 // d)
+    mins = np.min(y, axis=0)
+    self.size = float(np.max(np.max(y, axis=0) - mins)) or 1.
+    grid = ((y - mins) * ((2 ** levels) / self.size)).astype(np.int64)
+    np.clip(grid, 0, 2 ** levels - 1, grid)
+    code = np.zeros(n, dtype=np.int64)
+    for bit in xrange(levels):
+      for dim in xrange(d):
+        code |= ((grid[:, dim] >> bit) & 1) << (bit * d + dim)
+    self.order = np.argsort(code)
+    code = code[self.order]
+    sorted_y = y[self.order]
+    self.starts = []
+    self.counts = []
+    self.centers = []
+    self.point_cell = []
+    for level in xrange(levels + 1):
+      level_code = code >> (d * (levels - level))
+      new_cell = np.concatenate(([True], level_code[1:] != level_code[:-1]))
+      starts = np.flatnonzero(new_cell)
+      counts = np.diff(np.concatenate((starts, [n])))
+      self.starts.append(starts)
+      self.counts.append(counts)
+      self.centers.append(np.add.reduceat(sorted_y, starts, axis=0) / counts[:, np.newaxis])
+      self.point_cell.append(np.cumsum(new_cell) - 1)
+      if np.all(counts == 1):
+        break
+    self.num_levels = len(self.starts)
+    # the children of cell i of a level are cells
+    # first_child[i]..first_child[i+1]-1 of the next level.
+    self.first_child = [
+        np.searchsorted(self.starts[level + 1], np.concatenate((self.starts[level], [n])))
+        for level in xrange(self.num_levels - 1)]
+
+  def children(self, level, cells):
+    first_child = self.first_child[level]
+    return first_child[cells], first_child[cells + 1]
+
+  def cell_size(self, level):
+    return self.size / 2 ** level
+
+def repulsive_forces(y, theta=0.5):
+  """ Barnes-Hut approximation of the unnormalized t-SNE repulsive forces.
+  Returns (forces, z) where forces[i] = sum_j q_ij^2 (y_i - y_j) with the
+  unnormalized q_ij = 1 / (1 + |y_i - y_j|^2), and z = sum_{i != j} q_ij.
+  """
+  n, d = y.shape
+  tree = _SpaceTree(y)
+  z = 0.
+  point_forces = np.zeros((n, d))
+  a = np.zeros(1, dtype=np.int64)
+  b = np.zeros(1, dtype=np.int64)
+  for level in xrange(tree.num_levels):
+    counts = tree.counts[level]
+    centers = tree.centers[level]
+    last = level == tree.num_levels - 1
+    diff = centers[a] - centers[b]
+    dist_sq = np.sum(diff * diff, axis=1)
+    same = a == b
+    if last:
+      accept = ~same
+    else:
+      single = (counts[a] == 1) & (counts[b] == 1)
+      # both cells have the same size, (size_a + size_b) / dist < theta.
+      accept = ~same & (single | ((2 * tree.cell_size(level)) ** 2 < theta ** 2 * dist_sq))
+    q = 1. / (1. + dist_sq[accept])
+    count_a = counts[a[accept]]
+    count_b = counts[b[accept]]
+    z += np.sum(count_a * count_b * q)
+    weight = count_b * q * q
+    cell_forces = np.empty((len(counts), d))
+    for dim in xrange(d):
+      cell_forces[:, dim] = np.bincount(
+          a[accept], weights=weight * diff[accept, dim], minlength=len(counts))
+    point_forces += cell_forces[tree.point_cell[level]]
+    if last:
+      # points that share a cell of the last level coincide.
+      z += np.sum(counts * (counts - 1.))
+      break
+    # Expand the remaining pairs into all the pairs of their children. A
+    # cell paired with itself is only expanded if it holds several points.
+    expand = ~accept & ~(same & (counts[a] == 1))
+    a = a[expand]
+    b = b[expand]
+    child_start, child_end = tree.children(level, a)
+    owner, a_children = expand_ranges(child_start, child_end)
+    b = b[owner]
+    child_start, child_end = tree.children(level, b)
+    owner, b_children = expand_ranges(child_start, child_end)
+    a = a_children[owner]
+    b = b_children
+  forces = np.empty((n, d))
+  forces[tree.order] = point_forces
+  return forces, z
+
+def _attractive_forces(y, rows, cols, values, num_threads):
+  """ Returns sum_j p_ij q_ij (y_i - y_j) for every i (unnormalized q).
+  """
+  n, d = y.shape
+  def chunk_forces(start, end):
+    chunk_rows = rows[start:end]
+    diff = y[chunk_rows] - y[cols[start:end]]
+    weight = values[start:end] / (1. + np.sum(diff * diff, axis=1))
+    forces = np.empty((n, d))
+    for dim in xrange(d):
+      forces[:, dim] = np.bincount(chunk_rows, weights=weight * diff[:, dim], minlength=n)
+    return forces
+  return sum(map_chunks(chunk_forces, len(rows), EDGE_CHUNK_SIZE, num_threads))
+
+def tsne(points, no_dims=2, perplexity=30, initial_dims=30, theta=0.5,
+         max_iter=1000, learning_rate=200., early_exaggeration=12.,
+         exaggeration_iter=250, random_state=0, knn=None, num_threads=None):
+  """ Embeds points (rows are events) in no_dims dimensions with
+  Barnes-Hut t-SNE.
+
+  initial_dims -- the points are first reduced to this many dims with PCA.
+  theta -- Barnes-Hut accuracy, 0 is exact (and slow), 0.5 is the usual value.
+  knn -- optional precomputed nearest neighbors, see joint_probabilities.
+  num_threads -- threads used for the neighbor search and the forces.
+
+  Returns an (n, no_dims) array.
+  """
+  random_state = as_random_state(random_state)
+  points = np.asarray(points, dtype=np.float64)
+  n = len(points)
+  if n < 2:
+    return np.zeros((n, no_dims))
+  if points.shape[1] > initial_dims:
+    coeffs, points, variances = pca(points, initial_dims, random_state=random_state)
+  perplexity = min(perplexity, (n - 1) / 3.)
+  rows, cols, values = joint_probabilities(points, perplexity, knn, num_threads)
+  y = random_state.normal(0, 1e-4, (n, no_dims))
+  update = np.zeros((n, no_dims))
+  gains = np.ones((n, no_dims))
+  for iteration in xrange(max_iter):
+    if iteration < exaggeration_iter:
+      exaggeration = early_exaggeration
+      momentum = 0.5
+    else:
+      exaggeration = 1.
+      momentum = 0.8
+    attractive = _attractive_forces(y, rows, cols, values, num_threads)
+    repulsive, z = repulsive_forces(y, theta)
+    gradient = 4 * (exaggeration * attractive - repulsive / z)
+    same_sign = (gradient > 0) == (update > 0)
+    gains = np.where(same_sign, gains * 0.8, gains + 0.2)
+    np.maximum(gains, 0.01, gains)
+    update = momentum * update - learning_rate * gains * gradient
+    y += update
+    y -= np.mean(y, axis=0)
+    if iteration % 100 == 0:
+      logging.info('t-SNE iteration %d' % iteration)
+  return y
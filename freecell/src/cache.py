@@ -21,14 +21,276 @@ import sys
 import types
 import inspect
 import re
+import ast
+import zlib
+import sqlite3
+import tempfile
+from cStringIO import StringIO
 from attrdict import AttrDict
 import numpy as np
+from memorygovernor import GOVERNOR
+try:
+  import fcntl
+except ImportError:
+  # windows
+  fcntl = None
+  import msvcrt
+
+# The index of the disk cache, an sqlite database in the cache directory.
+INDEX_NAME = 'index.sqlite'
+# Values files start with VALUE_MAGIC and a metadata line (older files are
+# plain protocol 0 pickles). Arrays of at least MIN_ARRAY_FILE_BYTES are
+# saved next to the value file as .npy files, and are memory mapped when
+# the value is read.
+VALUE_MAGIC = 'FCCACHE2\n'
+MIN_ARRAY_FILE_BYTES = 2 ** 16
+# Lock files for computations shared between processes, see Cache.lock.
+LOCKS_DIR = 'locks'
+# Entries of a sub_dir saved with no function, by versions of the cache
+# before functions were recorded (or preference dictionaries, see
+# Cache._unrecorded_rows).
+UNRECORDED_QUERY = 'SELECT hash, path FROM entries WHERE func IS NULL AND sub_dir = ?'
+
+def _update_code_digest(h, obj):
+  if isinstance(obj, (staticmethod, classmethod)):
+    obj = obj.__func__
+  if isinstance(obj, types.MethodType):
+    obj = obj.im_func
+  if isinstance(obj, types.FunctionType):
+    obj = obj.func_code
+  if isinstance(obj, types.CodeType):
+    # line numbers are left out, so moving a function does not change it.
+    h.update(obj.co_code)
+    h.update(repr((obj.co_names, obj.co_varnames, obj.co_freevars)))
+    for const in obj.co_consts:
+      if isinstance(const, types.CodeType):
+        _update_code_digest(h, const)
+      else:
+        h.update(repr(const))
+  elif isinstance(obj, (type, types.ClassType, types.ModuleType)):
+    members = sorted(vars(obj).items())
+    if isinstance(obj, types.ModuleType):
+      # only what the module defines, not what it imports
+      members = [(n, m) for n, m in members if getattr(m, '__module__', None) == obj.__name__]
+    for name, member in members:
+      if isinstance(member, (types.FunctionType, staticmethod, classmethod, type, types.ClassType)):
+        h.update(name)
+        _update_code_digest(h, member)
+  else:
+    raise Exception('Cannot digest the code of %s' % type(obj))
+
+def code_digest(*objs):
+  """ Returns a digest of the code of functions, methods, classes (all
+  their methods) or modules (all the functions and classes they define).
+  """
+  h = hashlib.sha1()
+  for obj in objs:
+    _update_code_digest(h, obj)
+  return h.hexdigest()
+
+def _array_filename(full_path_val, array_id):
+  return '%s%s.npy' % (full_path_val[:-len('val')], array_id)
+
+def _array_files(full_path_val):
+  """ Returns the .npy files saved with a value file.
+  """
+  directory = os.path.dirname(full_path_val)
+  if not os.path.exists(directory):
+    return []
+  base = os.path.basename(full_path_val)[:-len('val')]
+  return [
+      os.path.join(directory, name) for name in os.listdir(directory)
+      if name.startswith(base) and name.endswith('.npy')]
+
+def _remove_files(paths):
+  for path in paths:
+    try:
+      if os.path.exists(path):
+        os.remove(path)
+    except OSError:
+      # windows does not remove files that are still memory mapped
+      logging.warning('Could not remove cache file %s' % path)
+
+def _atomic_write(path, write):
+  """ Calls write(f) on a temporary file in the directory of path and
+  renames it to path, so that readers (or a crash) never see a partial file.
+  """
+  fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      write(f)
+      f.flush()
+      os.fsync(f.fileno())
+    if os.name == 'nt' and os.path.exists(path):
+      # rename does not replace files on windows
+      os.remove(path)
+    os.rename(temp_path, path)
+  except:
+    if os.path.exists(temp_path):
+      os.remove(temp_path)
+    raise
+
+def _dump_value(val, full_path_val, compress=False):
+  """ Saves val in full_path_val and returns the number of bytes written.
+  The value is pickled with the highest protocol. Large numeric arrays
+  anywhere inside it (DataTable.data, distance matrices...) are saved as
+  .npy files instead, unless compress is True, in which case everything
+  goes in one zlib compressed pickle.
+  Every file is written atomically, and the array files of every write have
+  new names, so readers of the previous value are not affected.
+  """
+  array_files = []
+  write_id = os.urandom(4).encode('hex')
+  def persistent_id(obj):
+    if (compress or not isinstance(obj, np.ndarray) or obj.dtype.hasobject or
+        obj.nbytes < MIN_ARRAY_FILE_BYTES):
+      return None
+    array_id = '%s.%d' % (write_id, len(array_files))
+    filename = _array_filename(full_path_val, array_id)
+    _atomic_write(filename, lambda f: np.save(f, obj))
+    array_files.append(filename)
+    return array_id
+  buf = StringIO()
+  pickler = pickle.Pickler(buf, pickle.HIGHEST_PROTOCOL)
+  pickler.persistent_id = persistent_id
+  pickler.dump(val)
+  data = buf.getvalue()
+  if compress:
+    data = zlib.compress(data)
+  meta = {'compressed': compress, 'arrays': len(array_files)}
+  _atomic_write(full_path_val, lambda f: f.write(VALUE_MAGIC + repr(meta) + '\n' + data))
+  return os.path.getsize(full_path_val) + sum(os.path.getsize(a) for a in array_files)
+
+def _load_value(full_path_val):
+  """ Reads a value saved by _dump_value (or an older plain pickle).
+  """
+  with open(full_path_val, 'rb') as f:
+    if f.read(len(VALUE_MAGIC)) != VALUE_MAGIC:
+      f.seek(0)
+      return pickle.load(f)
+    meta = ast.literal_eval(f.readline())
+    data = f.read()
+  if meta['compressed']:
+    data = zlib.decompress(data)
+  unpickler = pickle.Unpickler(StringIO(data))
+  unpickler.persistent_load = lambda array_id: np.load(
+      _array_filename(full_path_val, array_id), mmap_mode='r')
+  return unpickler.load()
+
+class FileLock(object):
+  """ An exclusive lock on a file, shared between processes. Use it in a
+  with statement.
+  """
+  def __init__(self, path):
+    self.path = path
+    self._file = None
+
+  def __enter__(self):
+    directory = os.path.dirname(self.path)
+    if not os.path.exists(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:
+        # created by another process
+        pass
+    self._file = open(self.path, 'ab')
+    if fcntl:
+      fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+    else:
+      self._file.seek(0)
+      while True:
+        try:
+          # gives up after 10 seconds
+          msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+          break
+        except IOError:
+          pass
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if fcntl:
+      fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+    else:
+      self._file.seek(0)
+      msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+    self._file.close()
+    self._file = None
+
 
 class Cache(object):
+  """ A disk cache of pickled values.
+
+  Every value is saved in a file named after the sha1 of its key, under
+  cache_dir/sub_dir/<first two hex digits of the hash>/ so that no
+  directory grows too large. An sqlite index maps key hashes to their
+  files, so checking for a key or reading it never scans the directory tree.
+  Files saved by older versions (with no index) are indexed once, the
+  first time the cache is opened.
+
+  Files are written atomically (see _atomic_write) and an entry is added
+  to the index only after its files are complete, so several processes can
+  share the cache directory.
+
+  Entries saved by @cache record the function that computed them and a
+  digest of its code. Once a function is seen with a new digest, the
+  entries of its older versions are removed in the background (see
+  register_code).
+  """
   def __init__(self, cache_dir):
     self.cache_dir = cache_dir
-  
-  def put(self, key, val, sub_dir='', file_prefix=''):
+    self._lock = threading.RLock()
+    self._db = None
+
+  def _index(self):
+    """ Returns the index connection, it is opened (and older cache files
+    are migrated) on first use.
+    """
+    with self._lock:
+      if self._db == None:
+        if not os.path.exists(self.cache_dir):
+          os.makedirs(self.cache_dir)
+        db = sqlite3.connect(
+            os.path.join(self.cache_dir, INDEX_NAME), timeout=60, check_same_thread=False)
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS entries '
+            '(hash TEXT PRIMARY KEY, path TEXT NOT NULL, sub_dir TEXT, size INTEGER, created REAL)')
+        db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+        db.execute('CREATE TABLE IF NOT EXISTS code (func TEXT PRIMARY KEY, version TEXT)')
+        columns = [row[1] for row in db.execute('PRAGMA table_info(entries)')]
+        if not 'func' in columns:
+          db.execute('ALTER TABLE entries ADD COLUMN func TEXT')
+          db.execute('ALTER TABLE entries ADD COLUMN version TEXT')
+        db.execute('CREATE INDEX IF NOT EXISTS entries_func ON entries (func)')
+        db.commit()
+        if not db.execute("SELECT value FROM meta WHERE name = 'migrated'").fetchone():
+          self._migrate(db)
+        self._db = db
+      return self._db
+
+  def _migrate(self, db):
+    """ Adds all the .val files under the cache directory to the index.
+    """
+    logging.info('Indexing the cache in %s' % self.cache_dir)
+    rows = []
+    for root, dirs, files in os.walk(self.cache_dir):
+      for name in files:
+        splitted = name.split('.')
+        if len(splitted) < 2 or splitted[-1] != 'val':
+          continue
+        full_path = os.path.join(root, name)
+        rel_path = os.path.relpath(full_path, self.cache_dir)
+        stat = os.stat(full_path)
+        rows.append((splitted[-2], rel_path, os.path.dirname(rel_path), stat.st_size, stat.st_mtime))
+    db.executemany(
+        'INSERT OR REPLACE INTO entries (hash, path, sub_dir, size, created) VALUES (?, ?, ?, ?, ?)', rows)
+    db.execute("INSERT OR REPLACE INTO meta VALUES ('migrated', '1')")
+    db.commit()
+    logging.info('Indexed %d cache files' % len(rows))
+
+  def put(self, key, val, sub_dir='', file_prefix='', compress=False, code=None):
+    """ Saves val under key, see _dump_value for the file format.
+    code -- (function id, code digest) of the function that computed val.
+    """
     sub_dir = re.sub('[^a-zA-Z_0-9]', '_', sub_dir)
     file_prefix = re.sub('[^a-zA-Z_0-9]', '_', file_prefix)
     def ensure_dir(f):
@@ -38,24 +300,143 @@ class Cache(object):
 
     assert type(key) in (str, unicode)
     hashed_key = hashlib.sha1(key).hexdigest()
-    full_path_key = os.path.join(self.cache_dir, sub_dir, '%s.%s.key' % (file_prefix, hashed_key))
-    full_path_val = os.path.join(self.cache_dir, sub_dir, '%s.%s.val' % (file_prefix, hashed_key))
+    rel_dir = os.path.join(sub_dir, hashed_key[:2])
+    full_path_key = os.path.join(self.cache_dir, rel_dir, '%s.%s.key' % (file_prefix, hashed_key))
+    rel_path_val = os.path.join(rel_dir, '%s.%s.val' % (file_prefix, hashed_key))
+    full_path_val = os.path.join(self.cache_dir, rel_path_val)
     ensure_dir(full_path_key)
-    with open(full_path_key, 'w') as f:
-      f.write(key)
-    with open(full_path_val, 'w') as f:
-      pickle.dump(val, f)
+    db = self._index()
+    with self._lock:
+      row = db.execute('SELECT path FROM entries WHERE hash = ?', (hashed_key,)).fetchone()
+    old_array_files = _array_files(full_path_val)
+    if row and row[0] != rel_path_val:
+      # saved before under another sub_dir or file_prefix
+      old_path = os.path.join(self.cache_dir, row[0])
+      old_array_files += _array_files(old_path) + [old_path, old_path[:-len('val')] + 'key']
+    _atomic_write(full_path_key, lambda f: f.write(key))
+    size = _dump_value(val, full_path_val, compress)
+    func, version = code or (None, None)
+    with self._lock:
+      db.execute(
+          'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)',
+          (hashed_key, rel_path_val, sub_dir, size, time.time(), func, version))
+      db.commit()
+    _remove_files(old_array_files)
+
+  def register_code(self, func, version, sub_dir=None):
+    """ Records the current code digest of a cached function. If it
+    changed, the entries of older versions are removed on a background
+    thread. So are the entries of sub_dir (the namespace of the function)
+    that were saved before functions were recorded, see collect_garbage.
+    """
+    db = self._index()
+    with self._lock:
+      row = db.execute('SELECT version FROM code WHERE func = ?', (func,)).fetchone()
+      changed = not row or row[0] != version
+      if changed:
+        db.execute('INSERT OR REPLACE INTO code VALUES (?, ?)', (func, version))
+        db.commit()
+      unrecorded = sub_dir != None and any(self._unrecorded_rows(db, sub_dir))
+    if (row and changed) or unrecorded:
+      if row and changed:
+        logging.info('The code of %s changed, removing its old cache entries' % func)
+      thread = threading.Thread(None, self.collect_garbage, 'CACHE_GC_THREAD', (func, sub_dir))
+      thread.daemon = True
+      thread.start()
+
+  def _unrecorded_rows(self, db, sub_dir):
+    """ Yields the (hash, path) rows of UNRECORDED_QUERY, except for the
+    preference dictionaries (see preferences.py), which have no function
+    and are saved with their key as sub_dir.
+    """
+    sub_dir = re.sub('[^a-zA-Z_0-9]', '_', sub_dir)
+    for hashed_key, path in db.execute(UNRECORDED_QUERY, (sub_dir,)).fetchall():
+      key_path = os.path.join(self.cache_dir, path)[:-len('val')] + 'key'
+      try:
+        with open(key_path, 'rb') as f:
+          key = f.read()
+      except IOError:
+        key = None
+      if key != None and re.sub('[^a-zA-Z_0-9]', '_', key) == sub_dir:
+        continue
+      yield hashed_key, path
+
+  def collect_garbage(self, func=None, sub_dir=None):
+    """ Removes the entries computed by older code versions of func (or of
+    all the registered functions), and the entries of sub_dir with no
+    recorded function (saved by older versions of freecell). Returns the
+    number of removed entries.
+    """
+    db = self._index()
+    query = (
+        'SELECT entries.hash, entries.path FROM entries JOIN code ON entries.func = code.func '
+        'WHERE entries.version != code.version')
+    with self._lock:
+      if func == None:
+        rows = db.execute(query).fetchall()
+      else:
+        rows = db.execute(query + ' AND code.func = ?', (func,)).fetchall()
+      if sub_dir != None:
+        rows += list(self._unrecorded_rows(db, sub_dir))
+      db.executemany('DELETE FROM entries WHERE hash = ?', [(row[0],) for row in rows])
+      db.commit()
+    for hashed_key, path in rows:
+      full_path = os.path.join(self.cache_dir, path)
+      _remove_files(_array_files(full_path) + [full_path, full_path[:-len('val')] + 'key'])
+    if rows:
+      logging.info('Removed %d stale cache entries' % len(rows))
+    return len(rows)
+
+  def compress(self, key):
+    """ Rewrites an entry as a single zlib compressed file. Saves space for
+    cold entries, but their arrays are no longer memory mapped.
+    """
+    full_path = self.find_file(key)
+    if not full_path:
+      return
+    old_array_files = _array_files(full_path)
+    size = _dump_value(_load_value(full_path), full_path, True)
+    db = self._index()
+    with self._lock:
+      db.execute(
+          'UPDATE entries SET size = ? WHERE hash = ?', (size, hashlib.sha1(key).hexdigest()))
+      db.commit()
+    _remove_files(old_array_files)
+
+  def lock(self, key):
+    """ Returns a FileLock for key, held by @cache while it computes a
+    value that is saved to disk, so that processes sharing the cache
+    directory compute it once.
+    """
+    hashed_key = hashlib.sha1(key).hexdigest()
+    return FileLock(os.path.join(self.cache_dir, LOCKS_DIR, hashed_key[:2], '%s.lock' % hashed_key))
   
   def find_file(self, key):
     hashed_key = hashlib.sha1(key).hexdigest()
-    for root, dirs, files in os.walk(self.cache_dir):
-      for name in files:
-        splitted = name.split('.')
-        if len(splitted) < 2: 
-          continue
-        if splitted[-1] == 'val' and splitted[-2] == hashed_key:
-          return os.path.join(root, name)
-    return None
+    db = self._index()
+    with self._lock:
+      row = db.execute('SELECT path FROM entries WHERE hash = ?', (hashed_key,)).fetchone()
+    if not row:
+      return None
+    full_path = os.path.join(self.cache_dir, row[0])
+    if not os.path.exists(full_path):
+      # the file was deleted behind our back
+      self.remove(key)
+      return None
+    return full_path
+
+  def remove(self, key):
+    """ Removes a key from the cache.
+    """
+    hashed_key = hashlib.sha1(key).hexdigest()
+    db = self._index()
+    with self._lock:
+      row = db.execute('SELECT path FROM entries WHERE hash = ?', (hashed_key,)).fetchone()
+      db.execute('DELETE FROM entries WHERE hash = ?', (hashed_key,))
+      db.commit()
+    if row:
+      full_path = os.path.join(self.cache_dir, row[0])
+      _remove_files(_array_files(full_path) + [full_path, full_path[:-len('val')] + 'key'])
 
   def __contains__(self, key):
     return self.find_file(key) != None
@@ -67,40 +448,483 @@ class Cache(object):
       if none_if_not_found:
         return None
       raise Exception('file for key %s not found' % key)
-    with open(full_path, 'r') as f:
-      return pickle.load(f)
+    return _load_value(full_path)
+
+  def sub_dir_stats(self):
+    """ Returns a dictionary from sub_dir to (number of entries, bytes).
+    """
+    db = self._index()
+    with self._lock:
+      rows = db.execute('SELECT sub_dir, COUNT(*), SUM(size) FROM entries GROUP BY sub_dir').fetchall()
+    return dict((row[0], (row[1], row[2] or 0)) for row in rows)
+
+  def remove_sub_dir(self, sub_dir):
+    """ Removes all the entries saved under sub_dir.
+    """
+    sub_dir = re.sub('[^a-zA-Z_0-9]', '_', sub_dir)
+    db = self._index()
+    with self._lock:
+      rows = db.execute('SELECT path FROM entries WHERE sub_dir = ?', (sub_dir,)).fetchall()
+      db.execute('DELETE FROM entries WHERE sub_dir = ?', (sub_dir,))
+      db.commit()
+    for row in rows:
+      full_path = os.path.join(self.cache_dir, row[0])
+      _remove_files(_array_files(full_path) + [full_path, full_path[:-len('val')] + 'key'])
+    return len(rows)
 
+  def trim_sub_dir(self, sub_dir, max_bytes):
+    """ Removes the oldest entries of sub_dir until it holds at most
+    max_bytes.
+    """
+    sub_dir = re.sub('[^a-zA-Z_0-9]', '_', sub_dir)
+    db = self._index()
+    with self._lock:
+      rows = db.execute(
+          'SELECT hash, path, size FROM entries WHERE sub_dir = ? ORDER BY created DESC', (sub_dir,)).fetchall()
+      total = 0
+      removed = []
+      for hashed_key, path, size in rows:
+        total += size or 0
+        if total > max_bytes:
+          removed.append((hashed_key, path))
+      db.executemany('DELETE FROM entries WHERE hash = ?', [(row[0],) for row in removed])
+      db.commit()
+    for hashed_key, path in removed:
+      full_path = os.path.join(self.cache_dir, path)
+      _remove_files(_array_files(full_path) + [full_path, full_path[:-len('val')] + 'key'])
+    return len(removed)
+
+
+# Memory budgets in bytes for the in-memory cache. Every namespace (the dir
+# argument of @cache) gets DEFAULT_MEMORY_BUDGET unless it appears in
+# MEMORY_BUDGETS, and all the namespaces together are kept under
+# TOTAL_MEMORY_BUDGET, a share of the process budget (see memorygovernor.py).
+TOTAL_MEMORY_BUDGET = GOVERNOR.budget * 2 // 3
+DEFAULT_MEMORY_BUDGET = min(512 * 2 ** 20, TOTAL_MEMORY_BUDGET // 4)
+MEMORY_BUDGETS = {}
+# Objects are sized down to this depth, deeper attributes are ignored.
+MAX_SIZE_DEPTH = 6
+# Counters kept per namespace by MemoryCache. misses are lookups not found
+# in memory, some of which are then disk_hits (read in load_time seconds)
+# and the rest computes (computed in compute_time seconds). time_saved
+# sums the compute time of the entries that were hit, see MemoryCache.
+COUNTER_NAMES = [
+    'hits', 'misses', 'disk_hits', 'computes', 'compute_time', 'load_time', 'time_saved',
+    'evictions', 'spills']
+
+def estimate_size(obj, depth=0, seen=None):
+  """ Estimates the memory held by obj in bytes: nbytes for arrays (memory
+  mapped arrays are counted as free), and the sizes of the contents of
+  containers and of object attributes.
+  """
+  if seen == None:
+    seen = set()
+  if id(obj) in seen:
+    return 0
+  seen.add(id(obj))
+  if isinstance(obj, np.memmap) and getattr(obj, '_mmap', None) is not None:
+    return 0
+  if isinstance(obj, np.ndarray):
+    if obj.base is not None and id(obj.base) in seen:
+      return 0
+    return obj.nbytes
+  size = sys.getsizeof(obj, 64)
+  if depth >= MAX_SIZE_DEPTH or isinstance(obj, (str, unicode, int, long, float, bool)):
+    return size
+  if isinstance(obj, dict):
+    for k, v in obj.iteritems():
+      size += estimate_size(k, depth + 1, seen) + estimate_size(v, depth + 1, seen)
+  elif isinstance(obj, (list, tuple, set, frozenset)):
+    for item in obj:
+      size += estimate_size(item, depth + 1, seen)
+  elif hasattr(obj, '__dict__'):
+    size += estimate_size(obj.__dict__, depth + 1, seen)
+  return size
+
+class MemoryCache(object):
+  """ The in-memory cache of @cache, with a memory budget per namespace.
+
+  Every entry records its size (see estimate_size) and the time it took to
+  compute. When a namespace is over budget, entries are evicted by the
+  GreedyDual-Size policy (Cao and Irani 1997): an entry's priority is the
+  clock at its last use plus its compute time per byte, and evicting an
+  entry advances the clock to its priority. So the least recently used
+  entries go first, but large entries that are cheap to compute go
+  earlier than small expensive ones.
+
+  Namespaces set to spill (see set_budget) save evicted values in the disk
+  cache, and @cache reads them back from there.
+
+  Every namespace has the counters in COUNTER_NAMES, see stats.
+
+  MEM_CACHE is also registered with the process wide memory governor (see
+  memorygovernor.py), which may evict its entries when memory is short.
+  """
+  def __init__(self, disk_cache):
+    self.disk_cache = disk_cache
+    self._lock = threading.RLock()
+    self._entries = {}
+    self._namespace_sizes = {}
+    self._spill = set()
+    self._clock = 0.
+    self.counters = {}
+
+  def set_budget(self, namespace, budget=None, spill=None):
+    """ Sets the memory budget (bytes) of a namespace, and whether its
+    evicted entries are spilled to disk.
+    """
+    with self._lock:
+      if budget != None:
+        MEMORY_BUDGETS[namespace] = budget
+      if spill == True:
+        self._spill.add(namespace)
+      elif spill == False:
+        self._spill.discard(namespace)
+      self._evict(namespace)
+
+  def spills(self, namespace):
+    return namespace in self._spill
+
+  def _count(self, namespace, counter, amount=1):
+    counters = self.counters.setdefault(namespace, dict.fromkeys(COUNTER_NAMES, 0))
+    counters[counter] += amount
+
+  def record(self, namespace, counter, amount=1):
+    """ Adds amount to a counter of namespace (see COUNTER_NAMES).
+    """
+    with self._lock:
+      self._count(namespace, counter, amount)
+
+  def estimate_compute_time(self, namespace):
+    """ Returns the average compute time in namespace (0 if nothing was
+    computed yet).
+    """
+    with self._lock:
+      counters = self.counters.get(namespace)
+      if not counters or not counters['computes']:
+        return 0.
+      return counters['compute_time'] / counters['computes']
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def __len__(self):
+    return len(self._entries)
+
+  def lookup(self, key, namespace=''):
+    """ Returns (found, value) and counts a hit or a miss.
+    """
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry == None:
+        self._count(namespace, 'misses')
+        return False, None
+      entry[3] = self._clock + entry[4]
+      entry[7] = time.time()
+      self._count(entry[1], 'hits')
+      self._count(entry[1], 'time_saved', entry[6])
+      return True, entry[0]
+
+  def get(self, key, default=None):
+    found, value = self.lookup(key)
+    if not found:
+      return default
+    return value
+
+  def put(self, key, value, namespace='', cost=0., code=None):
+    """ Adds a value that took cost seconds to compute. code is saved
+    with the value if it is spilled (see Cache.put).
+    """
+    size = estimate_size(value)
+    with self._lock:
+      self.remove(key)
+      # entries of zero cost are still kept in LRU order
+      credit = (cost + 1e-6) / max(size, 1)
+      self._entries[key] = [value, namespace, size, self._clock + credit, credit, code, cost, time.time()]
+      self._namespace_sizes[namespace] = self._namespace_sizes.get(namespace, 0) + size
+      self._evict(namespace)
+    GOVERNOR.check()
+
+  def __setitem__(self, key, value):
+    self.put(key, value)
+
+  def remove(self, key):
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry != None:
+        self._namespace_sizes[entry[1]] -= entry[2]
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._namespace_sizes.clear()
+
+  def drop_namespace(self, namespace):
+    """ Removes all the entries of namespace and resets its counters.
+    """
+    with self._lock:
+      for key in [k for k, e in self._entries.iteritems() if e[1] == namespace]:
+        self.remove(key)
+      self._namespace_sizes.pop(namespace, None)
+      self.counters.pop(namespace, None)
+
+  def namespace_size(self, namespace):
+    return self._namespace_sizes.get(namespace, 0)
+
+  def total_size(self):
+    return sum(self._namespace_sizes.itervalues())
+
+  def _evict(self, namespace):
+    """ Evicts entries until namespace is within its budget and the cache
+    is within TOTAL_MEMORY_BUDGET.
+    """
+    budget = MEMORY_BUDGETS.get(namespace, DEFAULT_MEMORY_BUDGET)
+    while self.namespace_size(namespace) > budget:
+      self._evict_one(namespace)
+    while self.total_size() > TOTAL_MEMORY_BUDGET and self._entries:
+      self._evict_one(None)
+
+  def _evict_one(self, namespace):
+    candidates = [
+        (entry[3], key) for key, entry in self._entries.iteritems()
+        if namespace == None or entry[1] == namespace]
+    priority, key = min(candidates)
+    self._clock = max(self._clock, priority)
+    self.evict(key)
+
+  def memory_entries(self):
+    """ Returns (key, size, last used, compute time) per entry, for the
+    memory governor.
+    """
+    with self._lock:
+      return [(key, e[2], e[7], e[6]) for key, e in self._entries.iteritems()]
+
+  def evict(self, key):
+    """ Removes an entry, spilling it to disk if its namespace spills.
+    """
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry == None:
+        return
+      value, entry_namespace, code = entry[0], entry[1], entry[5]
+      self.remove(key)
+      self._count(entry_namespace, 'evictions')
+      if entry_namespace in self._spill and not key in self.disk_cache:
+        try:
+          self.disk_cache.put(key, value, entry_namespace, 'spill', code=code)
+          self._count(entry_namespace, 'spills')
+        except Exception:
+          logging.exception('Could not spill a cache entry of %s to disk' % entry_namespace)
+
+  def stats(self):
+    """ Returns a dictionary from namespace to its counters, entry count,
+    size and budget.
+    """
+    with self._lock:
+      ret = {}
+      for namespace in set(self.counters) | set(self._namespace_sizes):
+        stats = dict(self.counters.get(namespace, dict.fromkeys(COUNTER_NAMES, 0)))
+        stats['size'] = self.namespace_size(namespace)
+        stats['entries'] = sum(1 for e in self._entries.itervalues() if e[1] == namespace)
+        stats['budget'] = MEMORY_BUDGETS.get(namespace, DEFAULT_MEMORY_BUDGET)
+        ret[namespace] = stats
+      return ret
+
+class _Flight(object):
+  def __init__(self):
+    self.thread = threading.current_thread()
+    self.done = threading.Event()
+    self.value = None
+    self.error = None
+
+
+class SingleFlight(object):
+  """ Runs one computation per key at a time. Callers that ask for a key
+  that is already being computed wait for that computation and share its
+  result (or its exception).
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._flights = {}
+    self.shared = 0
+
+  def in_flight(self):
+    with self._lock:
+      return len(self._flights)
+
+  def do(self, key, func):
+    with self._lock:
+      flight = self._flights.get(key)
+      leader = flight == None
+      if leader:
+        flight = _Flight()
+        self._flights[key] = flight
+      else:
+        self.shared += 1
+    if not leader:
+      if flight.thread is threading.current_thread():
+        # a recursive call for the same key would wait for itself
+        return func()
+      flight.done.wait()
+      if flight.error:
+        raise flight.error[0], flight.error[1], flight.error[2]
+      return flight.value
+    try:
+      flight.value = func()
+    except:
+      flight.error = sys.exc_info()
+      raise
+    finally:
+      with self._lock:
+        del self._flights[key]
+      flight.done.set()
+    return flight.value
 
-MEM_CACHE = {}
 CACHE = Cache(os.path.join(settings.FREECELL_DIR, 'cache'))
+MEM_CACHE = MemoryCache(CACHE)
+GOVERNOR.register('memory cache', MEM_CACHE.memory_entries, MEM_CACHE.evict)
+IN_FLIGHT = SingleFlight()
 
+def cache_stats():
+  """ Returns a dictionary from namespace to the stats of MEM_CACHE (see
+  MemoryCache.stats) with the entries and bytes on disk and the hit rate.
+  """
+  ret = MEM_CACHE.stats()
+  disk_stats = CACHE.sub_dir_stats()
+  # disk sub dirs are namespaces with special characters replaced
+  in_memory = set(re.sub('[^a-zA-Z_0-9]', '_', namespace) for namespace in ret)
+  for namespace in disk_stats:
+    if not namespace in in_memory:
+      ret[namespace] = dict.fromkeys(COUNTER_NAMES + ['size', 'entries'], 0)
+      ret[namespace]['budget'] = MEMORY_BUDGETS.get(namespace, DEFAULT_MEMORY_BUDGET)
+  for namespace, stats in ret.iteritems():
+    stats['disk_entries'], stats['disk_size'] = disk_stats.get(
+        re.sub('[^a-zA-Z_0-9]', '_', namespace), (0, 0))
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = (stats['hits'] + stats['disk_hits']) / float(lookups) if lookups else 0.
+  return ret
 
-def cache(dir='', prefix='', disk=False):
+def drop_namespace(namespace, disk=True):
+  """ Removes a namespace from the memory cache and, if disk, from the
+  disk cache.
+  """
+  MEM_CACHE.drop_namespace(namespace)
+  if disk:
+    CACHE.remove_sub_dir(namespace)
+
+
+def _load(key, namespace):
+  """ Reads a value from the disk cache, returns it with its estimated
+  compute time.
+  """
+  start = time.time()
+  ret = CACHE.get(key)
+  load_time = time.time() - start
+  MEM_CACHE.record(namespace, 'disk_hits')
+  MEM_CACHE.record(namespace, 'load_time', load_time)
+  # the compute time of values read from disk is estimated
+  cost = MEM_CACHE.estimate_compute_time(namespace)
+  MEM_CACHE.record(namespace, 'time_saved', max(0., cost - load_time))
+  return ret, cost
+
+def _compute(namespace, compute):
+  start = time.time()
+  ret = compute()
+  cost = time.time() - start
+  MEM_CACHE.record(namespace, 'computes')
+  MEM_CACHE.record(namespace, 'compute_time', cost)
+  return ret, cost
+
+def load_or_compute(
+    key, namespace, compute, code, disk=False, prefix='', usable=None, max_disk_bytes=None):
+  """ Returns the value of key from the memory cache, from the disk cache
+  (if disk is True or namespace spills) or from compute(), and keeps it in
+  the memory cache. This is what @cache does once it has a key.
+  Values computed with disk True are saved under a file lock, so that
+  processes sharing the cache compute them once, and the saved copy (with
+  memory mapped arrays) is returned.
+  code -- (function id, code digest) saved with the value.
+  usable -- if given, cached values it returns False for are computed
+  again.
+  max_disk_bytes -- if given, the oldest entries of namespace are removed
+  from disk beyond that, see Cache.trim_sub_dir.
+  """
+  if usable == None:
+    usable = lambda value: True
+  if key in MEM_CACHE:
+    # computed by another thread just before this call started
+    found, ret = MEM_CACHE.lookup(key, namespace)
+    if found and usable(ret):
+      return ret
+  found = False
+  if (disk or MEM_CACHE.spills(namespace)) and key in CACHE:
+    ret, cost = _load(key, namespace)
+    found = usable(ret)
+  if not found:
+    if not disk:
+      ret, cost = _compute(namespace, compute)
+    else:
+      with CACHE.lock(key):
+        # another process may have saved it while we waited for the lock
+        if key in CACHE:
+          ret, cost = _load(key, namespace)
+          found = usable(ret)
+        if not found:
+          ret, cost = _compute(namespace, compute)
+          CACHE.put(key, ret, namespace, prefix, code=code)
+          if max_disk_bytes != None:
+            CACHE.trim_sub_dir(namespace, max_disk_bytes)
+          # the saved copy, so every call gets the same memory mapped arrays
+          ret = CACHE.get(key)
+  MEM_CACHE.put(key, ret, namespace, cost, code)
+  return ret
+
+def cache(dir='', prefix='', disk=False, depends_on=()):
   """ Applies caching on a function. 
   The function parameters (including self) must be supported by 
   the make_unique_str function. 
   disk determines if the cache is saved on disk. It will be saved in /cache. 
   dir, prefix determine directory name and a filename prefix in case
   the cached result is saved on disk. 
+  dir is also the namespace of the in-memory cache, which has a memory
+  budget (see MemoryCache).
+  Concurrent calls with the same key wait for a single computation (see
+  SingleFlight), and values saved to disk are computed under a file lock
+  so that processes sharing the cache compute them once.
+  Keys include a digest of the code of the function, and of depends_on (a
+  list of functions, classes or modules it calls), so changing the code
+  never serves stale values. Entries of older code are removed from disk
+  (see Cache.register_code).
   """
   def cache_wrap(func):
+    code = []
+    # the class (or function) whose body defines func, methods of different
+    # classes in a module often share a name.
+    scope = sys._getframe(1).f_code.co_name
+    if scope == '<module>':
+      func_id = '%s.%s' % (func.__module__, func.__name__)
+    else:
+      func_id = '%s.%s.%s' % (func.__module__, scope, func.__name__)
+    def get_code():
+      """ Returns (function id, code digest). Computed on the first call,
+      when everything in depends_on is defined.
+      """
+      if not code:
+        code.append((func_id, code_digest(func, *depends_on)))
+        if disk or MEM_CACHE.spills(dir):
+          try:
+            CACHE.register_code(code[0][0], code[0][1], dir)
+          except Exception:
+            logging.exception('Could not register the code version of %s' % func.__name__)
+      return code[0]
+
     def cached_func(*args, **kargs):
-      #start = time.timer()
-      key = function_call_to_unique_string(func, args, kargs)
-      #logging.info('key took %.2f seconds' % (time.timer() - start))
-      if not key in MEM_CACHE:
-        if disk:
-          if not key in CACHE:
-            val = func(*args, **kargs)
-            CACHE.put(key, val, dir, prefix)
-          MEM_CACHE[key] = CACHE.get(key)
-        else:
-          val = func(*args, **kargs)
-          MEM_CACHE[key] = val
-      #start = time.timer()
-      ret =  MEM_CACHE.get(key)
-      #logging.info('get took %.2f seconds' % (time.timer() - start))
-      return ret
+      key = '<code %s>\n%s' % (get_code()[1], function_call_to_unique_string(func, args, kargs))
+      found, ret = MEM_CACHE.lookup(key, dir)
+      if found:
+        return ret
+      return IN_FLIGHT.do(key, lambda: load_or_compute(
+          key, dir, lambda: func(*args, **kargs), get_code(), disk, prefix))
     return cached_func
   return cache_wrap
   
@@ -123,7 +947,7 @@ def make_unique_str(obj):
   # We don't want to differentiate between lists and tuples
   elif type(obj) in (list, tuple):
     return '[%s]' % comma_join(map(make_unique_str, obj))
-  elif type(obj) in (dict, AttrDict):
+  elif isinstance(obj, dict):
     items = sorted(obj.items())
     if items:
       keys, vals = zip(*items)
@@ -136,10 +960,9 @@ def make_unique_str(obj):
   elif type(obj) == DataTable:
     return '<DataTable %s >' % (obj.hash_table())
   elif isinstance(obj, Widget):
-    widget_name = type(obj).__name__
-    sub_widgets_str = make_unique_str(obj.widgets)
-    vals_str = make_unique_str(obj.values)
-    return '<Widget %s %s %s %s>' % (widget_name, obj.id, sub_widgets_str, vals_str)
+    # the fingerprint covers the values and the sub widgets, and is only
+    # recomputed when the widget changes.
+    return '<Widget %s %s %s>' % (type(obj).__name__, obj.id, obj.fingerprint())
   elif type(obj) == types.FunctionType:
     return '<function %s %s>' % (obj.__name__, obj.__module__)
   elif type(obj) == types.MethodType:
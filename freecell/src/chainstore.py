@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+""" Chain module outputs saved on disk (see widgets/chain.py).
+
+Every module in a chain gets an output fingerprint: a digest of its code
+(and of the source of the packages it calls, see code_version), its
+values, the size and modification time of the files it reads, and the
+fingerprints of the outputs connected to its inputs.
+Large outputs are saved in the disk cache under this fingerprint, with
+every DataTable in column major order (one contiguous block per column),
+and are read back memory mapped (see cache._dump_value). So later modules
+and later renders, also after a restart, get the tables without running
+the module again and without holding every stage of the chain in memory.
+"""
+import os
+import hashlib
+import logging
+import sys
+import threading
+import numpy as np
+import settings
+from cache import CACHE
+from cache import code_digest
+from biology.datatable import DataTable
+
+# The disk cache sub directory of the outputs.
+OUTPUTS_DIR = 'chain_outputs'
+# Outputs with fewer cells (in all their tables) stay in memory only.
+SPILL_MIN_CELLS = 10 ** 6
+# Bytes kept in OUTPUTS_DIR, the oldest outputs are removed beyond that.
+MAX_STORE_BYTES = 20 * 2 ** 30
+# The packages chain modules call into, their source is part of every
+# fingerprint.
+CODE_PACKAGES = ('biology', 'widgets')
+# The function id of saved outputs in the disk cache, see Cache.register_code.
+CODE_ID = 'chainstore.outputs'
+_code_lock = threading.Lock()
+# [source files state, digest] of the last code_version call.
+_code_version = [None, None]
+
+def enabled():
+  return getattr(settings, 'SPILL_CHAIN_OUTPUTS', True)
+
+def _file_state(path):
+  try:
+    stat = os.stat(path)
+  except OSError:
+    return '%s missing' % path
+  return '%s %d %r' % (path, stat.st_size, stat.st_mtime)
+
+def code_version():
+  """ Returns a digest of the source of CODE_PACKAGES. It is computed again
+  when a source file changes (the autoreloader may load it), and outputs
+  of older versions are then removed from disk.
+  """
+  sources = []
+  for package in CODE_PACKAGES:
+    directory = os.path.dirname(__import__(package).__file__)
+    sources += sorted(
+        os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.py'))
+  state = [_file_state(path) for path in sources]
+  with _code_lock:
+    if state == _code_version[0]:
+      return _code_version[1]
+    h = hashlib.sha1()
+    for path in sources:
+      h.update(os.path.basename(path))
+      with open(path, 'rb') as f:
+        h.update(f.read())
+    _code_version[:] = [state, h.hexdigest()]
+  try:
+    CACHE.register_code(CODE_ID, _code_version[1], OUTPUTS_DIR)
+  except Exception:
+    logging.exception('Could not register the code version of the chain outputs')
+  return _code_version[1]
+
+def output_fingerprint(module, input_fingerprints):
+  """ Returns the fingerprint of the outputs of module (a widget in a
+  chain) given the fingerprints of the outputs it is connected to, as a
+  list of (output name, fingerprint).
+  Widgets that read files list them in an input_files method.
+  """
+  h = hashlib.sha1()
+  h.update(module.fingerprint())
+  sub_widget = module.widgets.sub_widget
+  # the module that defines the widget type covers its helper functions
+  h.update(code_digest(sys.modules[type(sub_widget).__module__]))
+  h.update(code_version())
+  if sub_widget.has_method('input_files'):
+    for path in sub_widget.input_files():
+      h.update(' %s' % _file_state(path))
+  for name, fingerprint in input_fingerprints:
+    h.update(' %s:%s' % (name, fingerprint))
+  return h.hexdigest()
+
+def _is_table_list(value):
+  return type(value) == list and value and all(type(t) == DataTable for t in value)
+
+def _column_major(table):
+  ret = DataTable(np.asfortranarray(table.data), table.dims, table.legends, table.tags)
+  # the fingerprint does not depend on the memory order, keep it if known
+  if getattr(table, 'hash_cache', None) != None:
+    ret.hash_cache = table.hash_cache
+  return ret
+
+def load_outputs(fingerprint):
+  """ Returns the outputs saved under fingerprint, with memory mapped
+  tables, or None.
+  """
+  manifest = CACHE.get('chain outputs %s' % fingerprint, none_if_not_found=True)
+  if manifest == None:
+    return None
+  outputs = {}
+  for name, (kind, value) in manifest.iteritems():
+    if kind == 'tables':
+      tables = [CACHE.get(key, none_if_not_found=True) for key in value]
+      if None in tables:
+        return None
+      value = tables
+    outputs[name] = value
+  logging.info('Read chain outputs %s from disk' % fingerprint)
+  return outputs
+
+def save_outputs(fingerprint, outputs):
+  """ Saves outputs under fingerprint if they are large enough. Returns
+  the outputs to use: the saved ones (with memory mapped tables) or the
+  given ones.
+  """
+  if not outputs:
+    return outputs
+  num_cells = sum(
+      t.data.shape[0] for value in outputs.itervalues() if _is_table_list(value) for t in value)
+  if num_cells < SPILL_MIN_CELLS:
+    return outputs
+  code = (CODE_ID, code_version())
+  try:
+    manifest = {}
+    for name, value in outputs.iteritems():
+      if _is_table_list(value):
+        keys = []
+        for i, table in enumerate(value):
+          key = 'chain outputs %s %s %d' % (fingerprint, name, i)
+          CACHE.put(key, _column_major(table), OUTPUTS_DIR, code=code)
+          keys.append(key)
+        manifest[name] = ('tables', keys)
+      else:
+        manifest[name] = ('value', value)
+    # the manifest is saved last, so partial outputs are never read
+    CACHE.put('chain outputs %s' % fingerprint, manifest, OUTPUTS_DIR, code=code)
+    CACHE.trim_sub_dir(OUTPUTS_DIR, MAX_STORE_BYTES)
+  except Exception:
+    logging.exception('Could not save chain outputs to disk')
+    return outputs
+  return load_outputs(fingerprint) or outputs
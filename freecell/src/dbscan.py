@@ -5,116 +5,247 @@ fix_path(skip_matlab=True)
 NOISE_CLUSTER = 0
 UNCLASSIFIED = -1
 
-def simple_binned_clustering(D, min_val):
-  next_cluster = 1
-  shape = D.shape
-  out = np.ones(shape) * UNCLASSIFIED
-  for index in np.ndindex(*shape):
-    if out[index] == UNCLASSIFIED:
-  next_cluster = 1
-  shape = D.shape
-  out = np.ones(shape) * UNCLASSIFIED
-  for index in np.ndindex(*shape):
-    if out[index] == UNCLASSIFIED:
-      sum_neighbors, neighbors_idx = get_neighbors_idx(index)
-      #print neighbors_idx
-      if sum_neighbors < min_points:
-        out[index] = NOISE_CLUSTER
-      else:
-        print 'index: %d %d, sum:' % index, sum_neighbors
-        print neighbors_idx
-        #print neighbors
-        out[index] = next_cluster
-        neighbors_idx = set(
-            [i for i in neighbors_idx if out[i]==UNCLASSIFIED])
-        expand_cluster(out, next_cluster, neighbors_idx)
-        next_cluster += 1
-  return out
-      
+def neighborhood_sums(D, distance):
+  """ Returns an array shaped like D in which every cell holds the sum of D
+  over the cells in the index range [i-distance, i+distance] (clipped to the
+  array bounds).
+
+  Uses a summed-area table, so the cost does not depend on distance and the
+  function works for any number of dimensions.
+  """
+  D = np.asarray(D, dtype=np.float64)
+  summed = np.zeros([size + 1 for size in D.shape])
+  summed[(slice(1, None),) * D.ndim] = D
+  for axis in xrange(D.ndim):
+    summed = np.cumsum(summed, axis=axis)
+  # For every axis, the (exclusive) start and (inclusive) end of the window
+  # in summed-area table coordinates.
+  lows = []
+  highs = []
+  for axis, size in enumerate(D.shape):
+    index = np.arange(size)
+    lows.append(np.clip(index - distance, 0, size))
+    highs.append(np.clip(index + distance + 1, 0, size))
+  ret = np.zeros(D.shape)
+  # inclusion-exclusion over the 2^ndim corners of the window
+  for corner in np.ndindex(*([2] * D.ndim)):
+    idx = [highs[axis] if c else lows[axis] for axis, c in enumerate(corner)]
+    sign = (-1) ** (D.ndim - sum(corner))
+    ret += sign * summed[np.ix_(*idx)]
+  return ret
 
+def _label_core_cells(core, distance):
+  """ Labels the connected components of the core mask, where two core cells
+  are connected if every index differs by at most distance.
+  Returns the number of components and an int array shaped like core
+  (-1 for non-core cells, components are numbered from 0).
+  """
+  from scipy import ndimage
+  labels = -np.ones(core.shape, dtype=np.int32)
+  if not np.any(core):
+    return 0, labels
+  if distance % 2 == 1:
+    # Growing every core cell by (distance-1)/2 in each direction makes two
+    # core cells touch exactly when they are at most distance apart.
+    structure = np.ones([3] * core.ndim, dtype=bool)
+    grown = core
+    if distance > 1:
+      grown = ndimage.binary_dilation(
+          core, structure=np.ones([distance] * core.ndim, dtype=bool))
+    component_map, num_components = ndimage.label(grown, structure=structure)
+    labels[core] = component_map[core] - 1
+    # Dilated components may not contain core cells once restricted, keep
+    # the numbering dense.
+    used, dense = np.unique(labels[core], return_inverse=True)
+    labels[core] = dense
+    return len(used), labels
+  # Even distances: build the sparse adjacency graph between core cells by
+  # shifting the core mask over every offset in half of the neighborhood.
+  from scipy.sparse import coo_matrix
+  from scipy.sparse.csgraph import connected_components
+  core_index = -np.ones(core.shape, dtype=np.int64)
+  num_core = np.count_nonzero(core)
+  core_index[core] = np.arange(num_core)
+  rows = []
+  cols = []
+  offsets = np.ndindex(*([2 * distance + 1] * core.ndim))
+  for offset in offsets:
+    offset = np.array(offset) - distance
+    nonzero = offset[offset != 0]
+    if not len(nonzero) or nonzero[0] < 0:
+      # skip the zero offset and the mirror image of offsets already visited
+      continue
+    if np.any(np.abs(offset) >= core.shape):
+      continue
+    src = []
+    dst = []
+    for axis, o in enumerate(offset):
+      size = core.shape[axis]
+      src.append(slice(max(0, -o), min(size, size - o)))
+      dst.append(slice(max(0, o), min(size, size + o)))
+    src_index = core_index[tuple(src)]
+    dst_index = core_index[tuple(dst)]
+    both = (src_index >= 0) & (dst_index >= 0)
+    rows.append(src_index[both])
+    cols.append(dst_index[both])
+  if rows:
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+  else:
+    rows = cols = np.zeros(0, dtype=np.int64)
+  graph = coo_matrix(
+      (np.ones(len(rows), dtype=np.int8), (rows, cols)), shape=(num_core, num_core))
+  num_components, component_of_core = connected_components(graph, directed=False)
+  labels[core] = component_of_core
+  return num_components, labels
 
 def DBSCAN_binned(D, distance, min_points):
-  """A clustering algorithm based on DBSCAN for binned data. 
-  
+  """A clustering algorithm based on DBSCAN for binned data.
+
   Parameters:
-      D - a histogram array.
+      D - a histogram array (any number of dimensions).
       distance - when looking at a cell of index i, cells in the index range
           [i-distance, i+distance] are considered neighbors.
       min_points - if the sum of the neighboring cells of x is more than
           min_points, x is considered dense (otherwise it is noise).
-    
+
   Algorithm:
-      Take a cell x in D. If the sum of neighboring cells is less than
-      min_points mark cell as noise. Otherwise, create a cluster c with the cell
-      x inside. Add the neighbors of x to a candidates list. As long as there
-      are candidates, add a candidate which is not noise to cluster c, and add
-      its neighbors to the candidates list. Repeat until all cells are either 
-      noise or in a cluster.
-      
+      A cell is dense if the sum of its neighboring cells is at least
+      min_points, other cells are noise. Two dense cells are in the same
+      cluster if they are neighbors, or are connected through a chain of
+      dense neighbors.
+      The neighbor sums are computed with a summed-area table and the clusters
+      with array based connected component labeling, so nothing loops over
+      the cells in python.
+
   Output:
-    an array (shaped like D) specifying cluster assignments. 0 means noise."""
-  
-  global get_neighbors_idx_CACHE
-  get_neighbors_idx_CACHE = {}
-  def get_neighbors_idx(index):   
-    global get_neighbors_idx_CACHE
-    if not index in get_neighbors_idx_CACHE:
-      index_arr = np.array(index)
-      dims = len(D.shape)
-      begin = np.clip(index_arr - distance, 0, D.shape)
-      end = np.clip(index_arr + distance + 1, 0, D.shape)
-      slices = [slice(begin[i], end[i]) for i in xrange(dims)]
-      mesh = np.mgrid[slices]
-      idx = mesh.T.reshape(mesh.size/dims, dims)
-      idx = [tuple(i) for i in idx]
-      #omesh = np.ogrid[slices]
-      get_neighbors_idx_CACHE[index] =  (np.sum(D[slices]), idx)
-    return get_neighbors_idx_CACHE[index]
-    
-  
-  def expand_cluster(out, cluster_num, candidates_idx):
-    candidates_idx = set(candidates_idx)
-    while candidates_idx:
-      index = candidates_idx.pop()
-      #print index
-      #print out[index]
-      assert out[index] in (NOISE_CLUSTER, UNCLASSIFIED, cluster_num)
-      if out[index] == cluster_num:
-        continue
-      sum_neighbors, neighbors_idx = get_neighbors_idx(index)
-      if sum_neighbors < min_points:
-        out[index] = NOISE_CLUSTER
-      else:
-        out[index] = cluster_num
-        sum_new_neighbors, new_neighbors_idx = get_neighbors_idx(index)
-        new_neighbors_idx = set(
-            [i for i in new_neighbors_idx if out[i]==UNCLASSIFIED])
-        candidates_idx |= new_neighbors_idx
-        
-  next_cluster = 1
-  shape = D.shape
-  out = np.ones(shape) * UNCLASSIFIED
-  for index in np.ndindex(*shape):
-    if out[index] == UNCLASSIFIED:
-      sum_neighbors, neighbors_idx = get_neighbors_idx(index)
-      #print neighbors_idx
-      if sum_neighbors < min_points:
-        out[index] = NOISE_CLUSTER
-      else:
-        print 'index: %d %d, sum:' % index, sum_neighbors
-        print neighbors_idx
-        #print neighbors
-        out[index] = next_cluster
-        neighbors_idx = set(
-            [i for i in neighbors_idx if out[i]==UNCLASSIFIED])
-        expand_cluster(out, next_cluster, neighbors_idx)
-        next_cluster += 1
+    an array (shaped like D) specifying cluster assignments. 0 means noise.
+    Clusters are numbered from 1 in the order in which their first cell
+    appears when scanning D in C order."""
+  D = np.asarray(D)
+  distance = int(distance)
+  core = neighborhood_sums(D, distance) >= min_points
+  num_components, labels = _label_core_cells(core, distance)
+  out = np.zeros(D.shape, dtype=np.int32)
+  if not num_components:
+    return out
+  # Renumber the clusters by the position of their first cell:
+  flat_labels = labels.ravel()
+  core_positions = np.flatnonzero(flat_labels >= 0)
+  unused, first_position = np.unique(flat_labels[core_positions], return_index=True)
+  order = np.argsort(core_positions[first_position])
+  new_numbers = np.empty(num_components, dtype=np.int32)
+  new_numbers[order] = np.arange(1, num_components + 1)
+  out.ravel()[core_positions] = new_numbers[flat_labels[core_positions]]
   return out
-      
-      
-      
-      
-      
+
+def _find_roots(parent, items):
+  roots = parent[items]
+  while True:
+    next_roots = parent[roots]
+    if np.all(next_roots == roots):
+      return roots
+    roots = next_roots
+
+def _compress(parent):
+  while True:
+    grand_parent = parent[parent]
+    if np.all(grand_parent == parent):
+      return parent
+    parent = grand_parent
+
+def _union(parent, a, b):
+  """ Merges the sets of a[i] and b[i] for all i (vectorized union-find).
+  Roots always point to a smaller index, so the loop ends.
+  """
+  while len(a):
+    root_a = _find_roots(parent, a)
+    root_b = _find_roots(parent, b)
+    different = root_a != root_b
+    a = a[different]
+    b = b[different]
+    if not len(a):
+      break
+    high = np.maximum(root_a[different], root_b[different])
+    low = np.minimum(root_a[different], root_b[different])
+    # hook every high root to the smallest low root it is paired with.
+    order = np.lexsort((low, high))
+    high = high[order]
+    low = low[order]
+    first = np.concatenate(([True], high[1:] != high[:-1]))
+    parent[high[first]] = low[first]
+  return _compress(parent)
+
+def DBSCAN_points(points, distance, min_points, chunk_size=10000, num_threads=None, tree=None):
+  """DBSCAN over events (not binned).
+
+  Parameters:
+      points - array of shape (num_events, num_dims).
+      distance - events closer than distance (euclidean) are neighbors.
+      min_points - an event with at least min_points neighbors (including
+          itself) is a core event.
+      chunk_size, num_threads - the neighbor queries are done in chunks of
+          this many events on a thread pool, which bounds the memory used.
+      tree - optional kd-tree over points (see DataTable.kd_tree).
+
+  Algorithm:
+      Core events are found with batched radius counts on a kd-tree. Core
+      events that are neighbors are merged with union-find, one chunk of
+      neighbor pairs at a time. Every other event joins the cluster of its
+      nearest core event if it is within distance, and is noise otherwise.
+
+  Output:
+    an int32 array with a cluster index per event. -1 means noise, clusters
+    are numbered from 0 in the order of their first core event.
+  """
+  from biology.kdtree import KDTree
+  from biology.kmeans import as_points
+  from biology.chunked import chunk_ranges
+  points = as_points(points, np.float64)
+  labels = -np.ones(len(points), dtype=np.int32)
+  if not len(points):
+    return labels
+  if tree is None:
+    tree = KDTree(points)
+  # Queries in leaf order touch few nodes per chunk.
+  counts = tree.count_ball_point(
+      tree.tree_data, distance, limit=min_points, chunk_size=chunk_size, num_threads=num_threads)
+  core = np.sort(tree.indices[counts >= min_points])
+  if not len(core):
+    return labels
+  core_tree = KDTree(points[core])
+  parent = np.arange(len(core))
+  # Whole kd-tree nodes within distance of a core event are connected through
+  # it, they are linked as runs of consecutive events in leaf order.
+  runs = np.zeros(len(core) + 1, dtype=np.int64)
+  for start, end in chunk_ranges(len(core), chunk_size):
+    query, neighbor, run_starts, run_ends = core_tree.query_ball_point_links(
+        core_tree.tree_data[start:end], distance)
+    query = core_tree.indices[start + query]
+    parent = _union(parent, query[query != neighbor], neighbor[query != neighbor])
+    runs += np.bincount(run_starts, minlength=len(core) + 1)
+    runs -= np.bincount(run_ends - 1, minlength=len(core) + 1)
+  link_next = np.flatnonzero(np.cumsum(runs[:-1])[:-1] > 0)
+  parent = _union(parent, core_tree.indices[link_next], core_tree.indices[link_next + 1])
+  unused, core_labels = np.unique(parent, return_inverse=True)
+  labels[core] = core_labels
+  border = np.flatnonzero(labels < 0)
+  dist, nearest = core_tree.query(
+      points[border], 1, distance_upper_bound=distance, chunk_size=chunk_size, num_threads=num_threads)
+  found = np.isfinite(dist[:, 0])
+  labels[border[found]] = core_labels[nearest[found, 0]]
+  # Renumber the clusters by the position of their first core event:
+  unused, first_position = np.unique(core_labels, return_index=True)
+  new_numbers = np.empty(len(first_position), dtype=np.int32)
+  new_numbers[np.argsort(core[first_position])] = np.arange(len(first_position))
+  clustered = labels >= 0
+  labels[clustered] = new_numbers[labels[clustered]]
+  return labels
+
+
+
+
+
 if __name__ == "__main__":
     import pylab as P
     import scipy as S
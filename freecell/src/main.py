@@ -88,11 +88,14 @@ matplotlib.use('Agg')
 import urllib
 import logging
 import web
+import json
 import cPickle as pickle
 import settings
 from time import gmtime, strftime
 from widgets.graph import Graph
 from report import REPORTS
+from cache import cache_stats
+from cache import drop_namespace
 from reportrunner import ReportRunner
 from widgets.population_report import PopulationReport
 from widgets.histogram_report import HistogramReport
@@ -108,6 +111,7 @@ urls = (
     '/set_value', 'SetValue', 
     '/report', 'ShowReport',
     '/url/(.*)', 'UrlReport',
+    '/cache_stats', 'CacheStats',
     '/images/(.*)', 'Images' #this is where the image folder is located....
 )
 app = web.application(urls, globals(), autoreload=False)
@@ -185,8 +189,9 @@ class ShowReport(object):
     if not 'min_version' in i:
       i.min_version  = r.version
     while True:
-      if i.id in runner.report_id_to_result:
-        report, result = runner.report_id_to_result[i.id]
+      report_result = runner.get_result(i.id)
+      if report_result:
+        report, result = report_result
         if report.version >= i.min_version:
           if isinstance(result, Exception):
             return result
@@ -254,6 +259,37 @@ def report_from_file(i, base_report):
     r = REPORTS.new_from_report(base_report, i.name, i.author)
     raise web.seeother('/report?id=%s' % r.id)   
 
+class CacheStats(object):
+  """ Cache statistics per namespace, as an HTML table or as JSON (with
+  format=json). Posting a namespace drops it from the cache.
+  """
+  def GET(self):
+    from view import render
+    from view import View
+    i = web.input(format='html')
+    stats = cache_stats()
+    if i.format == 'json':
+      web.header('Content-Type', 'application/json')
+      return json.dumps(stats, sort_keys=True, indent=2)
+    mb = lambda x: '%.1f MB' % (x / 2. ** 20)
+    seconds = lambda x: '%.2f s' % x
+    columns = [
+        ('hits', str), ('misses', str), ('disk_hits', str), ('hit_rate', lambda x: '%.0f%%' % (100 * x)),
+        ('computes', str), ('compute_time', seconds), ('load_time', seconds), ('time_saved', seconds),
+        ('entries', str), ('size', mb), ('budget', mb), ('disk_entries', str), ('disk_size', mb),
+        ('evictions', str), ('spills', str)]
+    lines = [
+        (namespace, [format(stats[namespace][name]) for name, format in columns])
+        for namespace in sorted(stats)]
+    return View(None, render('cache_stats.html', {
+        'header_names': [name for name, format in columns],
+        'lines': lines})).create_page()
+
+  def POST(self):
+    i = web.input()
+    drop_namespace(i.namespace)
+    raise web.seeother('/cache_stats')
+
 class UrlReport(object):
   def GET(self, url):
     i = web.input()
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+""" A process wide memory budget shared by the caches of Freecell.
+
+Caches register with GOVERNOR, giving a function that lists their entries
+as (key, size in bytes, last used time, compute time in seconds) and a
+function that evicts an entry by key. They call GOVERNOR.check() after
+adding entries. When the anonymous memory of the process (see
+current_memory) is over the budget (settings.MEMORY_BUDGET, or
+default_memory_budget), entries are evicted across all the caches, lowest
+score first, until the sizes of the evicted entries cover the excess. If
+all the evictable entries together cannot cover it, the memory is held
+elsewhere and nothing is evicted.
+
+The score of an entry is the time it was last used, plus RECOMPUTE_WEIGHT
+seconds for every second per megabyte it takes to recompute it. So entries
+that were not used for a long time go first, but large entries that are
+cheap to recompute go before small expensive ones.
+"""
+import os
+import time
+import struct
+import logging
+import threading
+import settings
+try:
+  import psutil
+except ImportError:
+  psutil = None
+
+# A 32 bit process has 2GB of address space, and fragmentation leaves less
+# than that for large arrays.
+ADDRESS_SPACE_BUDGET_32BIT = 1200 * 2 ** 20
+# The share of physical memory used by default in a 64 bit process.
+PHYSICAL_MEMORY_SHARE = 0.5
+# Used when the physical memory is unknown.
+FALLBACK_MEMORY_BUDGET = 3 * 2 ** 30
+RECOMPUTE_WEIGHT = 60.
+# Memory is measured at most once every CHECK_INTERVAL seconds.
+CHECK_INTERVAL = 1.
+# Entries used in the last MIN_ENTRY_AGE seconds are never evicted, so that
+# a result is not evicted before its caller gets to it.
+MIN_ENTRY_AGE = 5.
+
+def current_memory():
+  """ Returns the anonymous memory of the process in bytes (resident memory
+  without the pages of memory mapped files), or None if it cannot be
+  measured here. The caches count memory mapped arrays as free (see
+  cache.estimate_size), and evicting entries does not release those pages.
+  """
+  if os.path.exists('/proc/self/statm'):
+    with open('/proc/self/statm') as f:
+      fields = f.read().split()
+    # resident pages minus the shared (file backed) ones
+    return (int(fields[1]) - int(fields[2])) * os.sysconf('SC_PAGE_SIZE')
+  if psutil:
+    process = psutil.Process(os.getpid())
+    if hasattr(process, 'memory_full_info'):
+      return process.memory_full_info().uss
+    if hasattr(process, 'memory_info_ex'):
+      info = process.memory_info_ex()
+      if hasattr(info, 'private'):
+        # windows, committed private memory
+        return info.private
+      if hasattr(info, 'shared'):
+        return info.rss - info.shared
+  return None
+
+def physical_memory():
+  """ Returns the physical memory of the machine in bytes, or None if it
+  cannot be measured here.
+  """
+  if psutil:
+    if hasattr(psutil, 'virtual_memory'):
+      return psutil.virtual_memory().total
+    return psutil.phymem_usage().total
+  try:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+  except (AttributeError, ValueError, OSError):
+    return None
+
+def default_memory_budget():
+  """ Returns the budget used when settings.MEMORY_BUDGET is not set: what
+  fits in the address space of a 32 bit process, or a share of the
+  physical memory.
+  """
+  if struct.calcsize('P') == 4:
+    return ADDRESS_SPACE_BUDGET_32BIT
+  memory = physical_memory()
+  if not memory:
+    return FALLBACK_MEMORY_BUDGET
+  return int(memory * PHYSICAL_MEMORY_SHARE)
+
+class MemoryGovernor(object):
+  """ Keeps the registered caches within a memory budget, see the module
+  docstring.
+  """
+  def __init__(self, budget=None):
+    if budget == None:
+      budget = getattr(settings, 'MEMORY_BUDGET', None) or default_memory_budget()
+    self.budget = budget
+    self._lock = threading.RLock()
+    self._caches = {}
+    self._last_check = 0.
+    self._checking = False
+    self.evictions = {}
+
+  def register(self, name, list_entries, evict):
+    """ Registers a cache.
+    list_entries -- returns a list of (key, size, last used, compute time).
+    evict -- called with a key to drop an entry.
+    """
+    with self._lock:
+      self._caches[name] = (list_entries, evict)
+      self.evictions.setdefault(name, 0)
+
+  def unregister(self, name):
+    with self._lock:
+      self._caches.pop(name, None)
+
+  def sizes(self):
+    """ Returns a dictionary from cache name to the bytes it holds.
+    """
+    with self._lock:
+      caches = self._caches.items()
+    return dict((name, sum(e[1] for e in list_entries())) for name, (list_entries, evict) in caches)
+
+  def memory_used(self):
+    """ Returns the anonymous memory of the process, or the total size of
+    the registered caches if it cannot be measured.
+    """
+    memory = current_memory()
+    if memory == None:
+      return sum(self.sizes().itervalues())
+    return memory
+
+  def check(self, force=False):
+    """ Evicts entries if the process is over budget. Returns the number
+    of bytes evicted.
+    """
+    now = time.time()
+    with self._lock:
+      if self._checking or (not force and now - self._last_check < CHECK_INTERVAL):
+        return 0
+      self._last_check = now
+      self._checking = True
+    try:
+      excess = self.memory_used() - self.budget
+      if excess <= 0:
+        return 0
+      return self._evict(excess, now)
+    finally:
+      with self._lock:
+        self._checking = False
+
+  def _evict(self, excess, now):
+    with self._lock:
+      caches = self._caches.items()
+    candidates = []
+    for name, (list_entries, evict) in caches:
+      for key, size, last_used, cost in list_entries():
+        if now - last_used < MIN_ENTRY_AGE:
+          continue
+        score = last_used + RECOMPUTE_WEIGHT * cost / max(size / 2. ** 20, 1e-3)
+        candidates.append((score, name, key, size))
+    evictable = sum(candidate[3] for candidate in candidates)
+    if evictable < excess:
+      logging.info(
+          'Memory over budget by %.0f MB, but only %.0f MB can be evicted, not evicting' %
+          (excess / 2. ** 20, evictable / 2. ** 20))
+      return 0
+    candidates.sort()
+    evictors = dict((name, evict) for name, (list_entries, evict) in caches)
+    freed = 0
+    for score, name, key, size in candidates:
+      if freed >= excess:
+        break
+      try:
+        evictors[name](key)
+      except Exception:
+        logging.exception('Could not evict an entry of %s' % name)
+        continue
+      freed += size
+      self.evictions[name] += 1
+    logging.info('Memory over budget by %.0f MB, evicted %.0f MB' % (excess / 2. ** 20, freed / 2. ** 20))
+    return freed
+
+GOVERNOR = MemoryGovernor()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+""" Remembered widget values (see Widget._guess_or_remember).
+
+Preferences are kept in memory, one dictionary per widget class, each read
+from the disk cache the first time the class is used. Changes are written
+back in the background, at most once every FLUSH_DELAY seconds per batch,
+and once more when the process exits.
+"""
+import atexit
+import copy
+import logging
+import threading
+from cache import CACHE
+
+# Seconds between a change and the write of all the pending changes.
+FLUSH_DELAY = 2.
+
+class PreferenceStore(object):
+  """ Values keyed by (dict_name, key), where dict_name names the widget
+  class. The dictionary of every dict_name is saved in the disk cache under
+  dict_name.
+  """
+  def __init__(self, disk_cache, flush_delay=FLUSH_DELAY):
+    self.disk_cache = disk_cache
+    self.flush_delay = flush_delay
+    self._lock = threading.RLock()
+    # held from taking the pending dictionaries until they are written, so
+    # an older copy never overwrites a newer one.
+    self._write_lock = threading.Lock()
+    self._dicts = {}
+    self._dirty = set()
+    self._timer = None
+
+  def _get_dict(self, dict_name):
+    with self._lock:
+      if not dict_name in self._dicts:
+        self._dicts[dict_name] = self.disk_cache.get(dict_name, none_if_not_found=True) or {}
+      return self._dicts[dict_name]
+
+  def get(self, dict_name, key, default=None):
+    with self._lock:
+      prefs = self._get_dict(dict_name)
+      if not key in prefs:
+        return default
+      # widgets get their own copy, as values used to be read from disk
+      return copy.deepcopy(prefs[key])
+
+  def set(self, dict_name, key, value):
+    """ Sets a value, it is written to disk within flush_delay seconds.
+    """
+    with self._lock:
+      prefs = self._get_dict(dict_name)
+      if key in prefs and type(prefs[key]) == type(value) and prefs[key] == value:
+        return
+      prefs[key] = copy.deepcopy(value)
+      self._dirty.add(dict_name)
+      if self._timer == None:
+        self._timer = threading.Timer(self.flush_delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+  def flush(self):
+    """ Writes all the changed dictionaries to disk.
+    """
+    with self._write_lock:
+      with self._lock:
+        if self._timer != None:
+          self._timer.cancel()
+          self._timer = None
+        pending = [(name, dict(self._dicts[name])) for name in self._dirty]
+        self._dirty.clear()
+      for dict_name, prefs in pending:
+        try:
+          self.disk_cache.put(dict_name, prefs, dict_name)
+        except Exception:
+          logging.exception('Could not save the preferences of %s' % dict_name)
+
+PREFERENCES = PreferenceStore(CACHE)
+atexit.register(PREFERENCES.flush)
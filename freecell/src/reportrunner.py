@@ -9,6 +9,8 @@ import threading
 from threading import Thread
 from report import REPORTS
 from timer import Timer
+from cache import estimate_size
+from memorygovernor import GOVERNOR
 
 class ReportRequest(object):
   """A request to run a report."""
@@ -26,7 +28,37 @@ class ReportRunner(object):
     self.exit_object = object()
     self.waiting_report_id_to_request = {}
     self.report_id_to_result = {}
+    # [last used time, run time, size] of every result
+    self.report_id_to_usage = {}
     self.working_lock = threading.RLock()
+    GOVERNOR.register('report results', self._result_entries, self._evict_result)
+
+  def get_result(self, report_id):
+    """ Returns (report, view or exception) of the last run of a report,
+    or None if it is not available.
+    """
+    with self.lock:
+      if not report_id in self.report_id_to_result:
+        return None
+      self.report_id_to_usage[report_id][0] = time.time()
+      return self.report_id_to_result[report_id]
+
+  def _set_result(self, report_id, result, run_time):
+    with self.lock:
+      self.report_id_to_result[report_id] = result
+      self.report_id_to_usage[report_id] = [time.time(), run_time, estimate_size(result)]
+    GOVERNOR.check()
+
+  def _result_entries(self):
+    with self.lock:
+      return [(report_id, usage[2], usage[0], usage[1]) for report_id, usage in self.report_id_to_usage.iteritems()]
+
+  def _evict_result(self, report_id):
+    """ Drops a result, the report runs again when it is next shown.
+    """
+    with self.lock:
+      self.report_id_to_result.pop(report_id, None)
+      self.report_id_to_usage.pop(report_id, None)
     
   def start(self):
     if self.thread and self.thread.is_alive():
@@ -66,13 +98,15 @@ class ReportRunner(object):
       with self.working_lock:
         r = REPORTS.load(req.report_id)
         logging.info('******RUNNING REPORT %s %s******' % (r.name, r.version))
+        start = time.time()
         try:
           r.widget.run_on_load()
           with Timer('Report'):
-            self.report_id_to_result[req.report_id] = (r, r.widget.view())
+            result = (r, r.widget.view())
         except Exception as e:
           logging.exception('Exception while running a report.')
-          self.report_id_to_result[req.report_id] = (r, e)
+          result = (r, e)
+        self._set_result(req.report_id, result, time.time() - start)
         # Save the report in case the last run modified its state.
         REPORTS.save(r)
       with self.lock:
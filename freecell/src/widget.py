@@ -1,12 +1,48 @@
 ﻿#!/usr/bin/env python
 import re
+import hashlib
+import itertools
 from cache import make_unique_str
-from cache import CACHE
+from preferences import PREFERENCES
 from view import View
 from view import render
 from attrdict import AttrDict
 
 ID_SEPERATOR = '-'
+# Source of widget versions, see Widget.touch.
+_VERSIONS = itertools.count(1)
+
+class WidgetValues(AttrDict):
+  """ The values dictionary of a widget. Every change to it updates the
+  version of its widget (see Widget.touch).
+  """
+  def _touch(self):
+    owner = self.__dict__.get('_owner')
+    if owner != None:
+      owner.touch()
+
+  def __setitem__(self, key, value):
+    AttrDict.__setitem__(self, key, value)
+    self._touch()
+
+  def __delitem__(self, name):
+    AttrDict.__delitem__(self, name)
+    self._touch()
+
+  def update(self, *args, **kargs):
+    AttrDict.update(self, *args, **kargs)
+    self._touch()
+
+  def setdefault(self, key, default=None):
+    if not key in self:
+      self[key] = default
+    return self[key]
+
+  __setattr__ = __setitem__
+
+  def set_owner(self, owner):
+    object.__setattr__(self, '_owner', owner)
+
 
 class Widget(object):
   """ A widget is an object that can generate HTML (in a View instance) and 
@@ -39,6 +75,15 @@ class Widget(object):
   Usually you will want to set state using an ApplyButton. 
   See ApplyButton.py for details.
   
+  Versions and cache keys
+  -----------------------
+  Every change to the values of a widget, or to its sub widgets, gives it
+  (and its parents) a new version. @cache keys identify a widget by its
+  fingerprint, a digest of its values and of its sub widgets that is
+  computed once per version. Values must be replaced rather than changed in
+  place (values.choices = new_list, not values.choices.append(...)), or
+  cached views will not notice the change.
+
   """
   
   def __init__(self, id, parent):
@@ -50,8 +95,43 @@ class Widget(object):
     self.parent = parent
     self.unique_counter = 0
     self.widgets = AttrDict()
-    self.values = AttrDict()
+    self.values = WidgetValues()
+    self.values.set_owner(self)
     self.value_name_to_cache_key = {}
+    self.touch()
+
+  def __setstate__(self, state):
+    """ Widgets saved by older versions have plain AttrDict values.
+    """
+    self.__dict__.update(state)
+    self.values = WidgetValues(self.values)
+    self.values.set_owner(self)
+    self.touch()
+
+  def touch(self):
+    """ Gives the widget and all its parents a new version. Called on
+    every change to the values.
+    """
+    self.version = next(_VERSIONS)
+    # while unpickling, the parent may not be restored yet
+    parent = self.__dict__.get('parent')
+    if isinstance(parent, Widget) and 'values' in parent.__dict__:
+      parent.touch()
+
+  def fingerprint(self):
+    """ Returns a digest of the type, id, values and sub widgets of the
+    widget. It is recomputed only when the version changes.
+    """
+    version = self.version
+    cached = self.__dict__.get('_fingerprint')
+    if cached and cached[0] == version:
+      return cached[1]
+    h = hashlib.sha1()
+    h.update('%s %s %s' % (type(self).__name__, self.id, make_unique_str(self.values)))
+    for name, widget in sorted(self.widgets.items()):
+      h.update(' %s:%s' % (name, widget.fingerprint()))
+    self._fingerprint = (version, h.hexdigest())
+    return self._fingerprint[1]
          
   def has_method(self, name):
     """ Tests is the widget has a method with the given name.
@@ -96,12 +176,14 @@ class Widget(object):
     new_id = '%s%s%s' % (self.id, ID_SEPERATOR, name)
     new_widget = new_widget_type(new_id, self, *args, **kargs)   
     self.widgets[name] = new_widget
+    self.touch()
     return new_widget
   
   def _remove_widget(self, widget):
     """ Removes a sub widget. """
     widget_name = widget.id.split(ID_SEPERATOR)[-1]
     del self.widgets[widget_name]
+    self.touch()
   
   def run_on_load(self):
     """ Called by a Report when a widget is reloaded. """
@@ -128,12 +210,7 @@ class Widget(object):
     if not value_name in self.value_name_to_cache_key:
       return
     cache_key = self.value_name_to_cache_key[value_name]
-    dict_name = str(type(self))
-    cache_dict = CACHE.get(dict_name, none_if_not_found=True)
-    if not cache_dict:
-      cache_dict = {}
-    cache_dict[cache_key] = value
-    CACHE.put(dict_name, cache_dict, dict_name)
+    PREFERENCES.set(str(type(self)), cache_key, value)
 
   def _guess_or_remember(self, value_name, key, default_value=None):
     """ Used to suggest a default for a certain value of the widget, or
@@ -148,14 +225,10 @@ class Widget(object):
     """
     key = make_unique_str(key)
     dict_name = str(type(self))
-    cache_dict = CACHE.get(dict_name, none_if_not_found=True)
-    if not cache_dict:
-      cache_dict = {}
     if self.values[value_name] == None:
-      self.values[value_name] = cache_dict.get(key, default_value)
+      self.values[value_name] = PREFERENCES.get(dict_name, key, default_value)
     else:
-      cache_dict[key] = self.values[value_name]
-      CACHE.put(dict_name, cache_dict, dict_name)
+      PREFERENCES.set(dict_name, key, self.values[value_name])
     # make sure we will update the value in cache when it changes:
     self.value_name_to_cache_key[value_name] = key
 
@@ -23,13 +23,16 @@ from freecellmenu import FreecellMenu
 from histogram import HistogramPlot
 from loadfcs import LoadFcs
 from clustering import KMeansClusterer
+from clustering import DBSCANClusterer
 import plots
 from network import Network
 from slidingwindow import SlidingWindow
 from discretize import Discretize
+from downsample import Downsample
 from boxplot import BoxPlot
 from ratio import Ratio
 from populationpicker import PopulationPicker
+import chainstore
 
 """ A chain is a special widget that allows users to create interactive chains
 of modules. This creates a pipeline that manipulates data and displays results
@@ -98,6 +101,10 @@ When the chain widget view method is called, it starts running the chain.
 Each module is activated in order. First, the view method is called and
 provided with the relevant inptus. Secondly, the run method is called,
 and its outputs are saved for later use. 
+Large outputs are also saved on disk under a fingerprint of the module and
+of its inputs (see chainstore.py). When the fingerprint is found on disk,
+the saved outputs are used (their tables memory mapped) instead of calling
+run again.
 Exceptions in view/run are printed on the report. If there is an exception in 
 run, the chain execution is stopped (as some outputs will probably be missing). 
 """
@@ -114,7 +121,9 @@ CHAINABLE_WIDGETS = [
     ('Sliding Window', SlidingWindow),
     ('Ratio', Ratio),
     ('Discretize', Discretize),
+    ('Downsample', Downsample),
     ('Kmeans', KMeansClusterer),
+    ('DBSCAN', DBSCANClusterer),
     ('True Scatter Plot', plots.TrueScatterPlot),
     ('Function Plot', plots.FunctionPlot),
     ('Scatter Gater', plots.ScatterGater),
@@ -201,23 +210,28 @@ class WidgetInChain(Widget):
     return ret
   
   def update_input_after_delete(self, input, deleted_index):
-    choices_to_delete = []
-    for i, input_choice in enumerate(self.input_to_select[input].values.choices):
+    # the choices are replaced rather than changed in place, so that the
+    # widget version changes.
+    choices = []
+    for input_choice in self.input_to_select[input].values.choices:
       idx = int(input_choice.split(',')[0])
       out = input_choice.split(',')[1]
-      if idx == deleted_index:
-        choices_to_delete.append(input_choice)
       if idx > deleted_index:
-        self.input_to_select[input].values.choices[i] = '%s,%s' % (idx - 1, out)
-    for choice in choices_to_delete:
-      self.input_to_select[input].values.choices.remove(choice)
+        choices.append('%s,%s' % (idx - 1, out))
+      elif idx != deleted_index:
+        choices.append(input_choice)
+    self.input_to_select[input].values.choices = choices
   
   def update_input_after_add(self, input, add_index):
-    for i, input_choice in enumerate(self.input_to_select[input].values.choices):
+    choices = []
+    for input_choice in self.input_to_select[input].values.choices:
       idx = int(input_choice.split(',')[0])
       out = input_choice.split(',')[1]
       if idx >= add_index:
-        self.input_to_select[input].values.choices[i] = '%s,%s' % (idx + 1, out)
+        choices.append('%s,%s' % (idx + 1, out))
+      else:
+        choices.append(input_choice)
+    self.input_to_select[input].values.choices = choices
     
   def create_input_map(self, data):
     input_map = {}
@@ -230,13 +244,32 @@ class WidgetInChain(Widget):
         input_map[input] = None
     return input_map     
       
-  def run(self, data):
+  def output_fingerprint(self, fingerprints):
+    """ Returns the fingerprint of the outputs of this module, given the
+    output fingerprints of the previous modules.
+    """
+    connected = []
+    for input in self.input_to_select:
+      connected += [(out, fingerprints[idx]) for idx, out in self.get_idx_outputs(input)]
+    return chainstore.output_fingerprint(self, connected)
+
+  def run(self, data, fingerprint=None):
+    """ Runs the module on the outputs of the previous modules. If a
+    fingerprint is given, outputs saved under it are used when found, and
+    large outputs are saved under it.
+    """
     self.outputs_from_run = []
     if self.widgets.sub_widget.has_method('run'):
         if 'pre_run' in dir(self.widgets.sub_widget):
           self.widgets.sub_widget.pre_run()
+        if fingerprint:
+          ret = chainstore.load_outputs(fingerprint)
+          if ret != None:
+            return ret
         ret =  self.widgets.sub_widget.run(**self.create_input_map(data))
         #self.outputs_from_run = ret.keys()
+        if fingerprint:
+          ret = chainstore.save_outputs(fingerprint, ret)
         return ret
     
   def title(self, place_in_chain, short=False):
@@ -379,6 +412,7 @@ class Chain(Widget):
     global CHAINABLE_WIDGETS
     # Run the chain:
     data = []
+    fingerprints = []
     views = []
     possible_inputs = []
     for i, widget in enumerate(self.widgets_in_chain):
@@ -388,9 +422,13 @@ class Chain(Widget):
       possible_inputs += self.widget_in_chain_to_inputs(widget, i)
       #logging.info('Running Widget %d %s' % (i, widget.title(i)))
       try:
+        fingerprint = None
+        if chainstore.enabled():
+          fingerprint = widget.output_fingerprint(fingerprints)
         with Timer('Module %d run' % (i+1)):
-          widget_data = widget.run(data)
+          widget_data = widget.run(data, fingerprint)
         data.append(widget_data)
+        fingerprints.append(fingerprint)
         views.append(self.output_log(widget_data))
         if widget_data and 'view' in widget_data:
           views.append(widget_data['view'])
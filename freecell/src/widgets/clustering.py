@@ -26,7 +26,8 @@ from motionchart import MotionChart
 class ClusterModule(WidgetWithControlPanel):
   """ Base class for clustering modules. Inheritors should implement:
    - method_name() - returns the name of the clustering method
-   - cluster(datatable) - returns a list of datables which are clusters of the given table.
+   - cluster_labels(datatable) - returns a cluster index for every row of the
+     given table (negative values mean the row is not in any cluster).
    - _control_panel(tables) - custom controls
   """
   def __init__(self, id, parent):
@@ -46,15 +47,32 @@ class ClusterModule(WidgetWithControlPanel):
     """
     ret = []
     timer = MultiTimer(len(tables))
+    add_column = self.widgets.cluster_output.get_choice() == 'column'
     for table in tables:
-      clusters = self.cluster(table)
-      for i, cluster in enumerate(clusters):
-        cluster.tags = table.tags.copy()
-        cluster.name = '%s %d %s' % (self.method_name(), i, table.name)
-        ret.append(cluster)
+      labels = self.cluster_labels(table)
+      if add_column:
+        num_clusters = int(np.max(labels)) + 1 if len(labels) else 0
+        legend = dict([(float(i), '%s %d' % (self.method_name(), i)) for i in xrange(num_clusters)])
+        legend[-1.] = 'noise'
+        new_table = table.add_dim(self.cluster_dim_name(), labels, legend)
+        new_table.name = table.name
+        ret.append(new_table)
+      else:
+        for i, cluster in enumerate(table.split_by_labels(labels)):
+          cluster.tags = table.tags.copy()
+          cluster.name = '%s %d %s' % (self.method_name(), i, table.name)
+          ret.append(cluster)
       timer.complete_task(table.name)  
     return {'tables':ret}
     
+  def cluster(self, table):
+    """ Returns a list of datatables, one per cluster.
+    """
+    return table.split_by_labels(self.cluster_labels(table))
+
+  def cluster_dim_name(self):
+    return '%s cluster' % self.method_name()
+
   def control_panel(self, tables):
     self._add_select(
         'cluster_dims',
@@ -63,6 +81,15 @@ class ClusterModule(WidgetWithControlPanel):
         is_multiple=True, 
         cache_key=tables, 
         default=[])
+    self._add_select(
+        'cluster_output',
+        'Output',
+        options=[
+            ('tables', 'One table per cluster'),
+            ('column', 'Add a cluster column to every table')],
+        is_multiple=False,
+        cache_key=tables,
+        default=['tables'])
     return self._control_panel(tables)  
   
   def get_cluster_dims(self):
@@ -93,5 +120,32 @@ class KMeansClusterer(ClusterModuleWithNumClusters):
   def method_name(self):
     return 'k-means'
   
-  def cluster(self, table):
-    return table.kmeans(self.get_cluster_dims(), self.get_num_clusters())
+  def cluster_labels(self, table):
+    return table.kmeans_labels(self.get_cluster_dims(), self.get_num_clusters())
+
+class DBSCANClusterer(ClusterModule):
+  def __init__(self, id, parent):
+    ClusterModule.__init__(self, id, parent)
+    self._add_widget('distance', Input)
+    self._add_widget('min_points', Input)
+
+  def method_name(self):
+    return 'DBSCAN'
+
+  def _control_panel(self, tables):
+    self._add_input(
+        'distance',
+        'Neighborhood Radius',
+        cache_key=tables,
+        default=0.1)
+    self._add_input(
+        'min_points',
+        'Min Neighbors for Core Cells',
+        cache_key=tables,
+        default=10)
+
+  def cluster_labels(self, table):
+    return table.dbscan_labels(
+        self.get_cluster_dims(),
+        self.widgets.distance.value_as_float(),
+        int(self.widgets.min_points.value_as_float()))
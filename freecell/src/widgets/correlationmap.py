@@ -22,6 +22,7 @@ from table import Table
 from select import Select
 from cache import cache
 from motionchart import MotionChart
+from biology.embedding import cmdscale
 
 class CorrelationMap(WidgetWithControlPanel):
   """ This module allows the user to compare multiple populations. The
@@ -108,8 +109,7 @@ class CorrelationMap(WidgetWithControlPanel):
       mutual_information_table = table.get_mutual_information_table(dims_to_use = dims, use_correlation=corr)      
       #assert np.all(mutual_information_table.data >= 0)
       distance = 1-np.abs(mutual_information_table.data)
-      from mlabwrap import mlab
-      Y, eig = mlab.cmdscale(distance, nout=2)
+      Y, eig = cmdscale(distance, 2)
       cols.append(Y.T[0])
       cols.append(Y.T[1])
       comments.append(','.join(['%.3f' % val for val in eig[:4]]))
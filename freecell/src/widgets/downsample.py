@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+from multitimer import MultiTimer
+from widgetwithcontrolpanel import WidgetWithControlPanel
+from select import options_from_table
+from biology.sampling import SAMPLING_MODES
+
+MODE_TEXTS = {
+    'uniform': 'Uniform',
+    'stratified': 'Stratified by a tag',
+    'density': 'Density dependent (keeps rare cells)',
+    'spread': 'Spread (Poisson disk)'}
+
+class Downsample(WidgetWithControlPanel):
+  """ This module samples a number of cells from every table, so that
+  expensive modules after it in the chain run on fewer cells. See
+  biology.sampling for the sampling modes.
+  """
+  def __init__(self, id, parent):
+    WidgetWithControlPanel.__init__(self, id, parent)
+
+  def title(self, short):
+    """Title for the module, the short version is displayed in menus,
+    the long version is displayed in the expander title.
+    """
+    if not 'mode' in self.widgets:
+      return 'Downsample'
+    return 'Downsample: %s cells, %s' % (self.widgets.num_cells.value_as_str(), self.widgets.mode.get_choice())
+
+  def run(self, tables):
+    """ Samples the tables.
+    """
+    n = self.widgets.num_cells.value_as_int()
+    mode = self.widgets.mode.get_choice()
+    dims = self.widgets.dims.get_choices()
+    tag_dim = None
+    if mode == 'stratified':
+      tag_dim = self.widgets.tag_dim.get_choice()
+      if not tag_dim:
+        raise Exception('Choose a tag dimension for stratified sampling')
+    seed = self.widgets.seed.value_as_int()
+    ret = []
+    timer = MultiTimer(len(tables))
+    for table in tables:
+      new_table = table.sample(n, mode, dims, tag_dim, random_state=seed)
+      new_table.tags = table.tags.copy()
+      new_table.name = '%s sampled' % table.name
+      ret.append(new_table)
+      timer.complete_task(table.name)
+    return {'tables':ret}
+
+  def control_panel(self, tables):
+    self._add_select(
+        'mode',
+        'Sampling mode',
+        options=[(mode, MODE_TEXTS[mode]) for mode in SAMPLING_MODES],
+        is_multiple=False,
+        cache_key=tables,
+        default=['uniform'])
+
+    self._add_input(
+        'num_cells',
+        'Cells per table',
+        cache_key=tables,
+        default='10000')
+
+    self._add_select(
+        'dims',
+        'Dimensions for density and spread (all if empty)',
+        options=options_from_table(tables[0]),
+        is_multiple=True,
+        cache_key=tables,
+        default=[])
+
+    self._add_select(
+        'tag_dim',
+        'Tag dimension for stratified sampling',
+        options=options_from_table(tables[0]),
+        is_multiple=False,
+        cache_key=tables,
+        default=[])
+
+    self._add_input(
+        'seed',
+        'Random seed',
+        cache_key=tables,
+        default='0')
+
+  def main_view(self, tables):
+    pass
@@ -202,8 +202,12 @@ class HistogramPlot(Widget):
         
           if len(tables) > 1:
             from scipy.stats import ks_2samp
+            from biology.resampling import permutation_test
             ks, p_ks = ks_2samp(tables[0].get_cols(dim)[0], tables[1].get_cols(dim)[0])
-            ks_view = View(self, 'ks: %.3f, p_ks: %.10f' % (ks, p_ks))
+            ks_perm, p_perm, num_permutations = permutation_test(
+                tables[0].get_cols(dim)[0], tables[1].get_cols(dim)[0], 'ks')
+            ks_view = View(self, 'ks: %.3f, p_ks: %.10f, permutation p: %.4f (%d permutations)' % (
+                ks, p_ks, p_perm, num_permutations))
             final_view = stack_lines(ks_view, figure_widget.view(fig))
           else:
             ks, p_ks = 0, 0
@@ -47,6 +47,12 @@ class LoadFcs(Widget):
       return 'Please enter a valid path for a directory with FCS files'
    return os.path.split(dirname)[-1]
 
+  def input_files(self):
+    """ Returns the FCS files read by run.
+    """
+    dirname = self.widgets.fcs_dir.value_as_str()
+    return [os.path.join(dirname, f) for f in self.widgets.fcs_files.values.choices or []]
+
   def run(self):
     """ The run method loads the datatable.
     """
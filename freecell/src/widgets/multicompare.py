@@ -22,6 +22,10 @@ from table import Table
 from select import Select
 from cache import cache
 from motionchart import MotionChart
+from biology.embedding import pca
+from biology.embedding import cmdscale
+from biology.groupby import GroupBy
+from biology.resampling import permutation_test
 
 class MultiCompare(WidgetWithControlPanel):
   """ This module allows the user to compare multiple populations. The
@@ -79,12 +83,7 @@ class MultiCompare(WidgetWithControlPanel):
     if not dims:
       return [0] * len(tables), [0] * len(tables), None
     average_vectors = np.array([t.get_average(*dims) for t in tables])
-    print average_vectors.shape
-    from mlabwrap import mlab
-    #extra_points, mapping = mlab.compute_mapping(
-    #    average_vectors, 'PCA', 2, nout=2)
-    coeffs, extra_points = mlab.princomp(average_vectors, nout=2)
-    print extra_points.shape
+    coeffs, extra_points, variances = pca(average_vectors, 2)
     return extra_points.T[0], extra_points.T[1], coeffs
     
   def dim_reduce_average(self, tables, dims):
@@ -104,8 +103,7 @@ class MultiCompare(WidgetWithControlPanel):
       multi_timer.complete_task()
     # average
     mean_distances = datatable.tables_mean(distances, p=3)
-    from mlabwrap import mlab
-    Y, eig = mlab.cmdscale(mean_distances.data, nout=2)
+    Y, eig = cmdscale(mean_distances.data, 2)
     return Y.T[0], Y.T[1], eig
   
   def control_panel(self, tables):
@@ -154,6 +152,14 @@ class MultiCompare(WidgetWithControlPanel):
         cache_key=tables,
         default=[])
 
+    self._add_select(
+        'p_value_dims',
+        'Permutation p-values (difference of averages from the first population) for',
+        options=options_from_table(tables[0]),
+        is_multiple=True,
+        cache_key=tables,
+        default=[])
+
     self._add_select(
         'id_tags',
         'Id tags',
@@ -226,8 +232,8 @@ class MultiCompare(WidgetWithControlPanel):
       elif method == 'pca':
         col_reduce1, col_reduce2, coeffs = self.dim_reduce_pca(tables, dims1)
         if coeffs != None:
-          comments.append(', '.join(['%s: %.2f' % (dims1[i], coeffs[0][i]) for i,dim in enumerate(dims1)]))
-          comments.append(', '.join(['%s: %.2f' % (dims1[i], coeffs[1][i]) for i,dim in enumerate(dims1)]))
+          comments.append(', '.join(['%s: %.2f' % (dims1[i], coeffs[i][0]) for i,dim in enumerate(dims1)]))
+          comments.append(', '.join(['%s: %.2f' % (dims1[i], coeffs[i][1]) for i,dim in enumerate(dims1)]))
       elif method == 'ks':
         col_reduce1, col_reduce2, eigen = self.dim_reduce_ks(tables, dims1)
         comments.append(','.join(['%.3f' % val for val in eigen[:4]]))
@@ -242,19 +248,29 @@ class MultiCompare(WidgetWithControlPanel):
     cols.append(final_col1)
     cols.append(final_col2)
     
-    # Add average columns:
+    # Add average and std columns, computed for all tables at once:
+    average_dims = self.widgets.average_dims.get_choices()
+    std_dims = self.widgets.std_dims.get_choices()
+    spec = [(dim, ['mean']) for dim in average_dims] + [(dim, ['std']) for dim in std_dims]
+    summary = GroupBy.from_tables(tables).agg(spec)
     average_cols = []
-    for dim in self.widgets.average_dims.get_choices():
+    for dim in average_dims:
       col_names.append('%s avg' % dim)
-      dim_col = [t.get_average(dim) for t in tables]
+      dim_col = list(summary.get_cols('%s mean' % dim)[0])
       cols.append(dim_col)
       average_cols.append(dim_col)
 
-    # Add std columns
-    for dim in self.widgets.std_dims.get_choices():
+    for dim in std_dims:
       col_names.append('%s std' % dim)
-      dim_col = [t.get_std(dim) for t in tables]
-      cols.append(dim_col)
+      cols.append(list(summary.get_cols('%s std' % dim)[0]))
+
+    # Add p-values for the difference of every population's average from
+    # the first population:
+    for dim in self.widgets.p_value_dims.get_choices():
+      col_names.append('%s p vs first' % dim)
+      first = tables[0].get_cols(dim)[0]
+      cols.append([1.] + [
+          permutation_test(first, t.get_cols(dim)[0], 'mean')[1] for t in tables[1:]])
       
     # Add dim-reduce columns
     #distances = datatable.ks_distances(tables, dim)
@@ -46,10 +46,8 @@ class PopulationReport(Widget):
       t = self.widgets.population_picker.get_data()
       #t = fake_table((1,0.1), (20,1))
 
-      samples_percent = min((10000. / t.num_cells) * 100, 100)
-      num_samples = int((samples_percent/100) * t.data.shape[0])
       truncate_cells_mi = True
-      t_samp = t.random_sample(num_samples)
+      t_samp = t.random_sample(min(10000, t.data.shape[0]))
     
       t_mi = t_samp.get_mutual_information(
           t.get_markers('signal'),
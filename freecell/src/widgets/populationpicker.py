@@ -27,13 +27,16 @@ class PopulationPicker(Widget):
     self.data = None
     self.summary = ''
 
-  def _get_index(self):
+  def _get_index_path(self):
     if not self.experiment:
       raise Exception('No experiment defined')
     if type(settings.EXPERIMENTS[self.experiment]) == tuple:
-      return DataIndex.load(settings.EXPERIMENTS[self.experiment][0])
+      return settings.EXPERIMENTS[self.experiment][0]
     else:
-      return DataIndex.load(settings.EXPERIMENTS[self.experiment])
+      return settings.EXPERIMENTS[self.experiment]
+
+  def _get_index(self):
+    return DataIndex.load(self._get_index_path())
       
 
   def title(self, short):
@@ -65,11 +68,22 @@ class PopulationPicker(Widget):
       #ret['view'] = '\n'.join(logs)        
     return ret
 
-  def get_data(self, count, arcsin_factor):
-    index = self._get_index()
+  def input_files(self):
+    """ Returns the files read by run, the index and the chosen data files.
+    """
+    if not self.is_ready():
+      return []
+    return [self._get_index_path()] + self._get_index().files(self._get_tag_to_vals())
+
+  def _get_tag_to_vals(self):
     tag_to_vals = {}
     for w in self.experiment_to_widgets[self.experiment]:
       tag_to_vals[w.tag] = w.values.choices
+    return tag_to_vals
+
+  def get_data(self, count, arcsin_factor):
+    index = self._get_index()
+    tag_to_vals = self._get_tag_to_vals()
     if count:      
       return index.count_cells(tag_to_vals, arcsin_factor=arcsin_factor)
     else:
@@ -1,55 +1,278 @@
 ﻿import numpy as np
-import scipy.spatial as ssp
+from biology.kdtree import KDTree
+from biology.kdtree import expand_ranges
+from biology.kdtree import range_blocks
+
+# The default error bounds of every sum: DEFAULT_ATOL is a fraction of the
+# largest possible sum len(data) * func(0), DEFAULT_RTOL of the sum itself.
+DEFAULT_ATOL = 1e-4
+DEFAULT_RTOL = 1e-2
+# Leaf size of the trees built by evaluate_sums.
+KDE_LEAF_SIZE = 32
+# Upper bound on the number of point pairs evaluated at once.
+MAX_PAIRS = 2000000
+# kde2d_grid bins the data this many bandwidths around the grid, and uses
+# lattices of up to MAX_LATTICE_SIZE nodes per dim.
+GRID_MARGIN = 8
+MAX_LATTICE_SIZE = 1024
+# Allowance for the roundoff of the FFT convolutions, as a fraction of
+# len(data) * func(0).
+GRID_ROUNDOFF = 1e-12
+
+def _as_tree(data):
+  """Accepts a biology.kdtree.KDTree, a scipy kd-tree or an array of
+  points and returns a biology.kdtree.KDTree."""
+  if isinstance(data, KDTree):
+    return data
+  if not isinstance(data, np.ndarray) and hasattr(data, 'data'):
+    data = data.data
+  return KDTree(data, KDE_LEAF_SIZE)
+
+def _box_distances(mins_a, maxes_a, mins_b, maxes_b):
+  """Minimum and maximum euclidean distances between matching boxes."""
+  nearest = np.maximum(0, np.maximum(mins_a - maxes_b, mins_b - maxes_a))
+  farthest = np.maximum(maxes_a - mins_b, maxes_b - mins_a)
+  return np.sqrt(np.sum(nearest ** 2, axis=1)), np.sqrt(np.sum(farthest ** 2, axis=1))
+
+def evaluate_sums(query_points, func, data, atol=None, rtol=DEFAULT_RTOL):
+  """Evaluates sum(func(distance(x, x_i))) for x_i in data, for every
+  point x of query_points at once.
+
+  A tree over the query points and a tree over the data are walked
+  together (Gray and Moore 2000, "N-body problems in statistical
+  learning"). For a pair of nodes the distances lie between the distances
+  of the boxes, so a monotone func lies between its values there. When
+  these bounds are close enough the whole pair is added at once,
+  otherwise the larger node is split. Pairs of leaves are handled per
+  query point: a data leaf is added as a whole when its bounds are close
+  enough, and point by point otherwise. A pair added at once adds the
+  midpoint of its bounds.
+
+  A pair of c data points is close enough if half the width of its bounds
+  (its error bound) is at most c / N * atol, or at most rtol times its
+  lower bound. So the error of every sum is at most atol + rtol * value.
+
+  query_points - an array (M, dims) of points.
+  func - a monotone function from R to R, applied to arrays.
+  data - a biology.kdtree.KDTree, a scipy kd-tree or an array (N, dims).
+  atol - absolute error bound, defaults to DEFAULT_ATOL * N * |func(0)|.
+  rtol - relative error bound.
+
+  Returns values, errors: two arrays of length M, the true sum of query
+  point i is within errors[i] of values[i].
+  """
+  queries = _as_tree(np.atleast_2d(np.asarray(query_points, dtype=np.float)))
+  data = _as_tree(data)
+  if atol is None:
+    atol = DEFAULT_ATOL * data.n * abs(func(0.))
+  point_atol = atol / max(data.n, 1)
+  def bounds(nearest, farthest, counts):
+    """Returns (low, high, close_enough) of the sums of pairs."""
+    near_values = func(nearest)
+    far_values = func(farthest)
+    low = counts * np.minimum(near_values, far_values)
+    high = counts * np.maximum(near_values, far_values)
+    close = high - low <= np.maximum(2 * counts * point_atol, 2 * rtol * low)
+    return low, high, close
+  node_values = np.zeros(queries.node_start.shape)
+  node_errors = np.zeros(queries.node_start.shape)
+  point_values = np.zeros(queries.n)
+  point_errors = np.zeros(queries.n)
+  query_diameter = np.sum((queries.node_maxes - queries.node_mins) ** 2, axis=1)
+  data_diameter = np.sum((data.node_maxes - data.node_mins) ** 2, axis=1)
+  a = np.zeros(1, dtype=np.int64)
+  b = np.zeros(1, dtype=np.int64)
+  while len(a):
+    nearest, farthest = _box_distances(
+        queries.node_mins[a], queries.node_maxes[a], data.node_mins[b], data.node_maxes[b])
+    low, high, accept = bounds(nearest, farthest, data.node_size[b])
+    # the midpoint of the bounds is within half their width of the true sum.
+    value = (low[accept] + high[accept]) / 2.
+    error = (high[accept] - low[accept]) / 2.
+    node_values += np.bincount(a[accept], weights=value, minlength=len(node_values))
+    node_errors += np.bincount(a[accept], weights=error, minlength=len(node_values))
+    a_leaf = queries.node_lesser[a] < 0
+    b_leaf = data.node_lesser[b] < 0
+    leaf = ~accept & a_leaf & b_leaf
+    leaf_a = a[leaf]
+    leaf_b = b[leaf]
+    for block_start, block_end in range_blocks(queries.node_size[leaf_a], MAX_PAIRS):
+      # every query point of the leaf against the whole data leaf
+      owner, position = expand_ranges(
+          queries.node_start[leaf_a[block_start:block_end]], queries.node_end[leaf_a[block_start:block_end]])
+      block_b = leaf_b[block_start:block_end][owner]
+      x = queries.tree_data[position]
+      nearest, farthest = _box_distances(x, x, data.node_mins[block_b], data.node_maxes[block_b])
+      low, high, close = bounds(nearest, farthest, data.node_size[block_b])
+      value = (low[close] + high[close]) / 2.
+      error = (high[close] - low[close]) / 2.
+      point_values += np.bincount(position[close], weights=value, minlength=queries.n)
+      point_errors += np.bincount(position[close], weights=error, minlength=queries.n)
+      # the rest point by point, exactly.
+      position = position[~close]
+      block_b = block_b[~close]
+      for pair_start, pair_end in range_blocks(data.node_size[block_b], MAX_PAIRS):
+        inner_owner, data_position = expand_ranges(
+            data.node_start[block_b[pair_start:pair_end]], data.node_end[block_b[pair_start:pair_end]])
+        query_position = position[pair_start:pair_end][inner_owner]
+        diff = queries.tree_data[query_position] - data.tree_data[data_position]
+        point_values += np.bincount(
+            query_position, weights=func(np.sqrt(np.sum(diff ** 2, axis=1))), minlength=queries.n)
+    split = ~accept & ~leaf
+    a = a[split]
+    b = b[split]
+    # split the larger of the two boxes, unless it is a leaf.
+    split_a = ~a_leaf[split] & (b_leaf[split] | (query_diameter[a] >= data_diameter[b]))
+    split_b = ~split_a
+    a, b = (
+        np.concatenate((queries.node_lesser[a[split_a]], queries.node_greater[a[split_a]], a[split_b], a[split_b])),
+        np.concatenate((b[split_a], b[split_a], data.node_lesser[b[split_b]], data.node_greater[b[split_b]])))
+  # every node adds its sums to all its points.
+  values = np.zeros(queries.n + 1)
+  errors = np.zeros(queries.n + 1)
+  for node_sums, point_sums in ((node_values, values), (node_errors, errors)):
+    used = np.flatnonzero(node_sums)
+    point_sums += np.bincount(queries.node_start[used], weights=node_sums[used], minlength=queries.n + 1)
+    point_sums -= np.bincount(queries.node_end[used], weights=node_sums[used], minlength=queries.n + 1)
+  values = np.cumsum(values)[:-1] + point_values
+  errors = np.cumsum(errors)[:-1] + point_errors
+  result_values = np.empty(queries.n)
+  result_errors = np.empty(queries.n)
+  result_values[queries.indices] = values
+  result_errors[queries.indices] = np.maximum(errors, 0)
+  return result_values, result_errors
 
-d = lambda u,v: ssp.distance.minkowski(u, v, 2)
 def evaluate_sum(point, func, points, res=1000):
   """Evaluates the sum of a monotone distance function on given distances.
-  
+
   This method estimates sum(func(distance(x, x_i))) for x_i in points.
-  It returns val, error.  
+  It returns val, error.
   point - a tuple representing a point.
   func - a monotone function from R to R.
-  points - a scipy.spatial.kdtree with points to evaluate
-  res - resolution
+  points - a kd-tree (or an array) with points to evaluate
+  res - resolution, the error is at most len(points) * |func(0)| / res.
+  See evaluate_sums to evaluate many points at once.
   """
-  max_r = max(
-      d((points.mins[0], points.mins[1]), point),
-      d((points.maxes[0], points.mins[1]), point),
-      d((points.maxes[0], points.maxes[1]), point),
-      d((points.mins[0], points.maxes[1]), point))
-  
-  point = ssp.KDTree([point])
-  
-  radii = [max_r / (i + 1) for i in xrange(res)]
-  radii += [0] # add a last circle with 0 radius
-  
-  func_vals = [func(r) for r in radii]
-    
-  counts = points.count_neighbors(point, radii)
-  #counts = len(radii) * [5]
-    
-  points_per_ring = [counts[i] - counts[i+1] for i in xrange(res)]
-  min_val_per_ring = [func_vals[i] * points_per_ring[i] for i in xrange(res)]
-  max_val_per_ring = [func_vals[i+1] * points_per_ring[i] for i in xrange(res)]
-  
-  min_val = sum(min_val_per_ring)
-  max_val = sum(max_val_per_ring)
-  
-  error = max_val - min_val
-  val = (min_val + max_val) / 2
-  return val, error
+  points = _as_tree(points)
+  values, errors = evaluate_sums([point], func, points, points.n * abs(func(0.)) / res, 0)
+  return values[0], errors[0]
 
 def create_gaussian_kernel(bandwidth):
-  def gaussian_kernel(d): 
+  def gaussian_kernel(d):
     return (2*np.pi) ** (-0.5) * np.exp(-(d ** 2)/(2 * (bandwidth **2)))
   return gaussian_kernel
-    
-def kde2d(sample_points, data, bandwidth):
+
+def kde2d(sample_points, data, bandwidth, atol=None, rtol=DEFAULT_RTOL):
+  """Evaluates the gaussian kernel sums of data at all the sample points
+  at once. Returns values, errors arrays (see evaluate_sums)."""
+  kernel = create_gaussian_kernel(bandwidth)
+  return evaluate_sums(sample_points, kernel, data, atol, rtol)
+
+def _bin_moments(points, origin, spacing, shape):
+  """Assigns points to the nearest node of a regular lattice. Returns the
+  number of points, the sums of their offsets from the node (per dim) and
+  the sums of their squared offsets, as arrays of the lattice shape."""
+  index = np.floor((points - origin) / spacing + 0.5).astype(np.int64)
+  offsets = points - (origin + index * spacing)
+  cells = np.ravel_multi_index(index.T, shape)
+  size = np.prod(shape)
+  counts = np.bincount(cells, minlength=size).astype(np.float)
+  sums = [np.bincount(cells, weights=offsets[:, dim], minlength=size).reshape(shape) for dim in xrange(len(shape))]
+  squares = np.bincount(cells, weights=np.sum(offsets ** 2, axis=1), minlength=size)
+  return counts.reshape(shape), sums, squares.reshape(shape)
+
+def _convolve(pairs, shape):
+  """Returns sum(convolve(a, k)) over the (a, k) pairs, where every a has
+  the lattice shape and k is indexed by the offset between two nodes
+  (shape 2 * shape - 1, offset 0 in the middle). The result is evaluated at
+  the lattice nodes."""
+  size = [2 * s - 1 for s in shape]
+  fft_size = [int(2 ** np.ceil(np.log2(s))) for s in size]
+  total = 0
+  for a, k in pairs:
+    total = total + np.fft.rfft2(a, fft_size) * np.fft.rfft2(k, fft_size)
+  full = np.fft.irfft2(total, fft_size)
+  return full[shape[0] - 1:2 * shape[0] - 1, shape[1] - 1:2 * shape[1] - 1]
+
+def _grid_sums(data, bandwidth, mins, maxes, shape, refine):
+  """Gaussian kernel sums over a grid, from data binned on a lattice that
+  is refine times finer than the grid (see kde2d_grid). Data outside the
+  lattice is returned separately, as well as the roundoff allowance of the
+  convolutions."""
+  kernel = create_gaussian_kernel(bandwidth)
+  spacing = (maxes - mins) / (np.array(shape, dtype=np.float) - 1) / refine
+  spacing[spacing == 0] = bandwidth
+  # the lattice covers the grid and GRID_MARGIN bandwidths around it
+  margin = np.ceil(GRID_MARGIN * bandwidth / spacing).astype(np.int64)
+  origin = mins - margin * spacing
+  lattice = tuple((np.array(shape) - 1) * refine + 1 + 2 * margin)
+  position = (data - origin) / spacing + 0.5
+  inside = np.all((position >= 0) & (position < lattice), axis=1)
+  counts, sums, squares = _bin_moments(data[inside], origin, spacing, lattice)
+  # kernels indexed by the offset of the grid point from the node, see
+  # _convolve. The points of a node lie in a box of the node spacing around
+  # it, so the distance from a grid point to them lies between nearest and
+  # farthest.
+  steps = [np.arange(1 - size, size) for size in lattice]
+  offsets = np.meshgrid(steps[0] * spacing[0], steps[1] * spacing[1], indexing='ij')
+  nearest = np.meshgrid(
+      np.maximum(np.abs(steps[0]) - 0.5, 0) * spacing[0],
+      np.maximum(np.abs(steps[1]) - 0.5, 0) * spacing[1], indexing='ij')
+  farthest = np.meshgrid((np.abs(steps[0]) + 0.5) * spacing[0], (np.abs(steps[1]) + 0.5) * spacing[1], indexing='ij')
+  center_values = kernel(np.sqrt(offsets[0] ** 2 + offsets[1] ** 2))
+  nearest = np.sqrt(nearest[0] ** 2 + nearest[1] ** 2)
+  farthest = np.sqrt(farthest[0] ** 2 + farthest[1] ** 2)
+  # The kernel at a point is its value at the node plus the gradient term,
+  # up to half the squared offset times the largest hessian eigenvalue
+  # (in absolute value) in the node box.
+  variance = bandwidth ** 2
+  hessian = kernel(nearest) / variance * np.maximum(1, farthest ** 2 / variance - 1)
+  values = _convolve(
+      [(counts, center_values)] +
+      [(sums[dim], center_values * offsets[dim] / variance) for dim in xrange(2)], lattice)
+  errors = _convolve([(squares, hessian / 2)], lattice)
+  roundoff = GRID_ROUNDOFF * len(data) * kernel(0.)
+  take = tuple(slice(m, m + (s - 1) * refine + 1, refine) for m, s in zip(margin, shape))
+  return values[take], errors[take] + roundoff, data[~inside]
+
+def kde2d_grid(data, bandwidth, mins, maxes, shape=(256, 256), atol=None, rtol=DEFAULT_RTOL):
+  """Evaluates the gaussian kernel sums of data over a regular grid
+  spanning [mins, maxes]. Returns values, errors arrays of the grid shape,
+  values[i, j] is at the i'th x value and the j'th y value.
+
+  The data is binned on a lattice aligned with the grid, keeping the
+  number of points in every node and the first and second moments of
+  their offsets from it. The sums at all the grid points are then
+  convolutions of these with the kernel, its gradient and a bound on its
+  hessian, computed with FFTs, so the errors are rigorous second order
+  Taylor bounds. The lattice is refined until the errors are within
+  atol + rtol * value (as in evaluate_sums), up to MAX_LATTICE_SIZE nodes
+  per dim. Grid points that are still not accurate enough, and data far
+  outside the grid, are handled by evaluate_sums.
+  """
+  data = np.asarray(data, dtype=np.float)
+  mins = np.asarray(mins, dtype=np.float)
+  maxes = np.asarray(maxes, dtype=np.float)
   kernel = create_gaussian_kernel(bandwidth)
-  vals = []
-  errors = []
-  for p in sample_points:
-    val, err = evaluate_sum(p, kernel, data)
-    vals.append(val)
-    errors.append(err)
-  return np.array(vals), np.array(errors)
\ No newline at end of file
+  if atol is None:
+    atol = DEFAULT_ATOL * len(data) * kernel(0.)
+  x = np.linspace(mins[0], maxes[0], shape[0])
+  y = np.linspace(mins[1], maxes[1], shape[1])
+  grid = np.column_stack((np.repeat(x, len(y)), np.tile(y, len(x))))
+  refine = 1
+  while True:
+    values, errors, outside = _grid_sums(data, bandwidth, mins, maxes, shape, refine)
+    values = values.ravel()
+    errors = errors.ravel()
+    if len(outside):
+      outside_values, outside_errors = evaluate_sums(
+          grid, kernel, outside, atol * len(outside) / len(data), rtol)
+      values += outside_values
+      errors += outside_errors
+    bad = errors > atol + rtol * values
+    if not np.any(bad) or max(shape) * refine * 2 > MAX_LATTICE_SIZE:
+      break
+    refine *= 2
+  if np.any(bad):
+    values[bad], errors[bad] = kde2d(grid[bad], data, bandwidth, atol, rtol)
+  return values.reshape(shape), errors.reshape(shape)
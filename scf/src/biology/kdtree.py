@@ -1,7 +1,10 @@
 ﻿# Copyright Anne M. Archibald 2008
 # Released under the scipy license
+import os
+import ast
+import struct
+import hashlib
 import numpy as np
-from heapq import heappush, heappop
 import scipy.sparse
 
 def minkowski_distance_p(x,y,p=2):
@@ -93,6 +96,85 @@ class Rectangle(object):
         return np.logical_and(min_test, max_test)
 
 
+
+# Upper bound on the number of point pairs whose distances are computed at
+# once, bounds the memory used by the queries.
+MAX_PAIRS = 2000000
+# Number of query points handled by every traversal of query and
+# query_ball_point.
+QUERY_CHUNK_SIZE = 10000
+# Layout of the files written by KDTree.save: the magic, the header length,
+# a header that describes the arrays and then the arrays, every one aligned.
+FILE_MAGIC = 'SCKDTREE'
+FILE_ALIGNMENT = 64
+SAVED_ARRAYS = ('indices', 'tree_data', 'node_start', 'node_end', 'node_split_dim',
+                'node_split', 'node_lesser', 'node_greater', 'node_mins', 'node_maxes',
+                'maxes', 'mins')
+
+def _distance_p(r, p):
+    """Converts a distance to the form compared by the tree: its pth
+    power, unless p is 1 or infinity."""
+    if p==np.inf or p==1:
+        return r
+    return np.asarray(r, dtype=np.float)**p
+
+def _distance_root(d, p):
+    """The inverse of _distance_p."""
+    if p==np.inf or p==1:
+        return d
+    return d**(1./p)
+
+def _reduce_sides(sides, p):
+    """Combines per-axis gaps (n,m) into pth power distances (n,)."""
+    if p==np.inf:
+        return np.amax(sides, axis=-1)
+    elif p==1:
+        return np.sum(sides, axis=-1)
+    else:
+        return np.sum(sides**p, axis=-1)
+
+def _point_rect_distances(x, mins, maxes, p):
+    """pth power distances from every row of x to the nearest and the
+    farthest point of the matching hyperrectangle."""
+    nearest = np.maximum(0, np.maximum(mins-x, x-maxes))
+    farthest = np.maximum(maxes-x, x-mins)
+    return _reduce_sides(nearest, p), _reduce_sides(farthest, p)
+
+def _rect_rect_distances(mins1, maxes1, mins2, maxes2, p):
+    """pth power minimum and maximum distances between matching pairs of
+    hyperrectangles."""
+    nearest = np.maximum(0, np.maximum(mins1-maxes2, mins2-maxes1))
+    farthest = np.maximum(maxes1-mins2, maxes2-mins1)
+    return _reduce_sides(nearest, p), _reduce_sides(farthest, p)
+
+def expand_ranges(starts, ends):
+    """Returns (owner, position): for every range i, the positions
+    starts[i]..ends[i]-1 each tagged with i."""
+    lengths = ends - starts
+    owner = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.arange(len(owner)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return owner, starts[owner] + offsets
+
+def range_blocks(lengths, max_total):
+    """Splits a list of lengths into consecutive blocks whose total is at
+    most max_total (unless a single length is larger)."""
+    cumulative = np.cumsum(lengths)
+    blocks = []
+    start = 0
+    while start < len(lengths):
+        base = cumulative[start-1] if start else 0
+        end = max(np.searchsorted(cumulative, base + max_total, side='right'), start+1)
+        blocks.append((start, end))
+        start = end
+    return blocks
+
+def _group_starts(sorted_owner, num_groups):
+    return np.searchsorted(sorted_owner, np.arange(num_groups))
+
+def _aligned(offset):
+    return -(-offset // FILE_ALIGNMENT) * FILE_ALIGNMENT
+
+
 class KDTree(object):
     """
     kd-tree for quick nearest-neighbor lookup
@@ -111,10 +193,16 @@ class KDTree(object):
     "sliding midpoint" rule, which ensures that the cells do not all
     become long and thin.
 
+    The tree is stored in flat arrays with one entry per node (split axis,
+    split value, children, bounding box and the range of its points), and
+    the points are permuted so that the points of every node are a
+    contiguous range of self.indices. The tree is built one level at a
+    time, and the queries walk it for many query points (or node pairs) at
+    once with array operations instead of recursing in python.
+
     The tree can be queried for the r closest neighbors of any given point
     (optionally returning only those within some maximum distance of the
-    point). It can also be queried, with a substantial gain in efficiency,
-    for the r approximate closest neighbors.
+    point).
 
     For large dimensions (20 is already large) do not expect this to run
     significantly faster than brute force. High-dimensional nearest-neighbor
@@ -148,146 +236,311 @@ class KDTree(object):
         self.maxes = np.amax(self.data,axis=0)
         self.mins = np.amin(self.data,axis=0)
 
-        self.tree = self.__build(np.arange(self.n), self.maxes, self.mins)
-
-    class node(object):
-        pass
-    class leafnode(node):
-        def __init__(self, idx):
-            self.idx = idx
-            self.children = len(idx)
-    class innernode(node):
-        def __init__(self, split_dim, split, less, greater):
-            self.split_dim = split_dim
-            self.split = split
-            self.less = less
-            self.greater = greater
-            self.children = less.children+greater.children
-
-    def __build(self, idx, maxes, mins):
-        if len(idx)<=self.leafsize:
-            return KDTree.leafnode(idx)
-        else:
-            data = self.data[idx]
-            #maxes = np.amax(data,axis=0)
-            #mins = np.amin(data,axis=0)
-            d = np.argmax(maxes-mins)
-            maxval = maxes[d]
-            minval = mins[d]
-            if maxval==minval:
-                # all points are identical; warn user?
-                return KDTree.leafnode(idx)
-            data = data[:,d]
-
-            # sliding midpoint rule; see Maneewongvatana and Mount 1999
-            # for arguments that this is a good idea.
-            split = (maxval+minval)/2
-            less_idx = np.nonzero(data<=split)[0]
-            greater_idx = np.nonzero(data>split)[0]
-            if len(less_idx)==0:
-                split = np.amin(data)
-                less_idx = np.nonzero(data<=split)[0]
-                greater_idx = np.nonzero(data>split)[0]
-            if len(greater_idx)==0:
-                split = np.amax(data)
-                less_idx = np.nonzero(data<split)[0]
-                greater_idx = np.nonzero(data>=split)[0]
-            if len(less_idx)==0:
-                # _still_ zero? all must have the same value
-                assert np.all(data==data[0]), "Troublesome data array: %s" % data
-                split = data[0]
-                less_idx = np.arange(len(data)-1)
-                greater_idx = np.array([len(data)-1])
-
-            lessmaxes = np.copy(maxes)
-            lessmaxes[d] = split
-            greatermins = np.copy(mins)
-            greatermins[d] = split
-            return KDTree.innernode(d, split,
-                    self.__build(idx[less_idx],lessmaxes,mins),
-                    self.__build(idx[greater_idx],maxes,greatermins))
-
-    def __query(self, x, k=1, eps=0, p=2, distance_upper_bound=np.inf):
-
-        side_distances = np.maximum(0,np.maximum(x-self.maxes,self.mins-x))
-        if p!=np.inf:
-            side_distances**=p
-            min_distance = np.sum(side_distances)
-        else:
-            min_distance = np.amax(side_distances)
-
-        # priority queue for chasing nodes
-        # entries are:
-        #  minimum distance between the cell and the target
-        #  distances between the nearest side of the cell and the target
-        #  the head node of the cell
-        q = [(min_distance,
-              tuple(side_distances),
-              self.tree)]
-        # priority queue for the nearest neighbors
-        # furthest known neighbor first
-        # entries are (-distance**p, i)
-        neighbors = []
+        self.__build()
 
-        if eps==0:
-            epsfac=1
-        elif p==np.inf:
-            epsfac = 1/(1+eps)
-        else:
-            epsfac = 1/(1+eps)**p
-
-        if p!=np.inf and distance_upper_bound!=np.inf:
-            distance_upper_bound = distance_upper_bound**p
-
-        while q:
-            min_distance, side_distances, node = heappop(q)
-            if isinstance(node, KDTree.leafnode):
-                # brute-force
-                data = self.data[node.idx]
-                ds = minkowski_distance_p(data,x[np.newaxis,:],p)
-                for i in range(len(ds)):
-                    if ds[i]<distance_upper_bound:
-                        if len(neighbors)==k:
-                            heappop(neighbors)
-                        heappush(neighbors, (-ds[i], node.idx[i]))
-                        if len(neighbors)==k:
-                            distance_upper_bound = -neighbors[0][0]
-            else:
-                # we don't push cells that are too far onto the queue at all,
-                # but since the distance_upper_bound decreases, we might get
-                # here even if the cell's too far
-                if min_distance>distance_upper_bound*epsfac:
-                    # since this is the nearest cell, we're done, bail out
-                    break
-                # compute minimum distances to the children and push them on
-                if x[node.split_dim]<node.split:
-                    near, far = node.less, node.greater
-                else:
-                    near, far = node.greater, node.less
-
-                # near child is at the same distance as the current node
-                heappush(q,(min_distance, side_distances, near))
-
-                # far child is further by an amount depending only
-                # on the split value
-                sd = list(side_distances)
-                if p == np.inf:
-                    min_distance = max(min_distance, abs(node.split-x[node.split_dim]))
-                elif p == 1:
-                    sd[node.split_dim] = np.abs(node.split-x[node.split_dim])
-                    min_distance = min_distance - side_distances[node.split_dim] + sd[node.split_dim]
-                else:
-                    sd[node.split_dim] = np.abs(node.split-x[node.split_dim])**p
-                    min_distance = min_distance - side_distances[node.split_dim] + sd[node.split_dim]
+    def __build(self):
+        """Builds the tree level by level. All the nodes of a level are
+        split at once; a node is a leaf if it has at most leafsize points
+        or all its points are identical.
 
-                # far child might be too far, if so, don't bother pushing it
-                if min_distance<=distance_upper_bound*epsfac:
-                    heappush(q,(min_distance, tuple(sd), far))
+        Node i holds the points indices[node_start[i]:node_end[i]], and
+        for inner nodes node_lesser[i] and node_greater[i] are its
+        children (-1 for leaves).
+        """
+        indices = np.arange(self.n)
+        starts = [np.zeros(1, dtype=np.int64)]
+        ends = [np.array([self.n], dtype=np.int64)]
+        split_dims = []
+        splits = []
+        lessers = []
+        greaters = []
+        mins = []
+        maxes = []
+        num_nodes = 1
+        level_start = starts[0]
+        level_end = ends[0]
+        while len(level_start):
+            size = len(level_start)
+            owner, position = expand_ranges(level_start, level_end)
+            points = self.data[indices[position]]
+            # the nodes of a level are not contiguous, leaves of the earlier
+            # levels sit between them.
+            offsets = np.cumsum(level_end - level_start) - (level_end - level_start)
+            level_mins = np.minimum.reduceat(points, offsets, axis=0)
+            level_maxes = np.maximum.reduceat(points, offsets, axis=0)
+            spread = level_maxes - level_mins
+            d = np.argmax(spread, axis=1)
+            level_split_dim = -np.ones(size, dtype=np.int32)
+            level_split = np.zeros(size)
+            level_lesser = -np.ones(size, dtype=np.int64)
+            level_greater = -np.ones(size, dtype=np.int64)
+            to_split = np.flatnonzero(
+                (level_end - level_start > self.leafsize) &
+                (spread[np.arange(size), d] > 0))
+            child_start = np.zeros(2*len(to_split), dtype=np.int64)
+            child_end = np.zeros(2*len(to_split), dtype=np.int64)
+            if len(to_split):
+                split_d = d[to_split]
+                num_points = level_end[to_split] - level_start[to_split]
+                split_owner, position = expand_ranges(level_start[to_split], level_end[to_split])
+                value = self.data[indices[position], split_d[split_owner]]
+                minval = level_mins[to_split, split_d]
+                maxval = level_maxes[to_split, split_d]
+                # sliding midpoint rule; see Maneewongvatana and Mount 1999
+                # for arguments that this is a good idea.
+                split = (maxval + minval) / 2.
+                less = value <= split[split_owner]
+                num_less = np.bincount(split_owner, weights=less, minlength=len(to_split))
+                # the split can only leave the greater side empty (the
+                # minimum is always <= split), slide it down to the
+                # largest value below the maximum.
+                all_less = num_less == num_points
+                if np.any(all_less):
+                    below_max = np.where(value < maxval[split_owner], value, -np.inf)
+                    largest_below = np.maximum.reduceat(below_max, num_points.cumsum() - num_points)
+                    split[all_less] = largest_below[all_less]
+                    less = value <= split[split_owner]
+                    num_less = np.bincount(split_owner, weights=less, minlength=len(to_split))
+                num_less = num_less.astype(np.int64)
+                # stable partition of every node, lesser points first.
+                first = num_points.cumsum() - num_points
+                less_count = np.cumsum(less)
+                less_before = (less_count[first] - less[first])[split_owner]
+                greater_count = np.arange(1, len(less)+1) - less_count
+                greater_before = (greater_count[first] - ~less[first])[split_owner]
+                destination = np.where(
+                    less,
+                    less_count - 1 - less_before,
+                    num_less[split_owner] + greater_count - 1 - greater_before)
+                indices[level_start[to_split][split_owner] + destination] = indices[position]
+                level_split_dim[to_split] = split_d
+                level_split[to_split] = split
+                level_lesser[to_split] = num_nodes + 2*np.arange(len(to_split))
+                level_greater[to_split] = level_lesser[to_split] + 1
+                num_nodes += 2*len(to_split)
+                child_start[0::2] = level_start[to_split]
+                child_end[0::2] = level_start[to_split] + num_less
+                child_start[1::2] = child_end[0::2]
+                child_end[1::2] = level_end[to_split]
+            split_dims.append(level_split_dim)
+            splits.append(level_split)
+            lessers.append(level_lesser)
+            greaters.append(level_greater)
+            mins.append(level_mins)
+            maxes.append(level_maxes)
+            starts.append(child_start)
+            ends.append(child_end)
+            level_start = child_start
+            level_end = child_end
+        self.indices = indices
+        self.tree_data = np.asarray(self.data[indices], dtype=np.float)
+        self.node_start = np.concatenate(starts)
+        self.node_end = np.concatenate(ends)
+        self.node_split_dim = np.concatenate(split_dims)
+        self.node_split = np.concatenate(splits)
+        self.node_lesser = np.concatenate(lessers)
+        self.node_greater = np.concatenate(greaters)
+        self.node_mins = np.concatenate(mins).astype(np.float)
+        self.node_maxes = np.concatenate(maxes).astype(np.float)
+        self.node_size = self.node_end - self.node_start
+
+    def save(self, filename):
+        """Save the tree to a single file.
+
+        The file holds a small header followed by the raw node arrays and
+        the permuted points, so load can memory map it. It is written
+        under a temporary name first, readers never see a partial file.
+        """
+        header = {'n': self.n, 'm': self.m, 'leafsize': self.leafsize, 'arrays': []}
+        offset = 0
+        for name in SAVED_ARRAYS:
+            array = np.ascontiguousarray(getattr(self, name))
+            offset = _aligned(offset)
+            header['arrays'].append((name, array.dtype.str, array.shape, offset))
+            offset += array.nbytes
+        header = repr(header)
+        data_start = _aligned(len(FILE_MAGIC) + 8 + len(header))
+        temp_name = '%s.%d.tmp' % (filename, os.getpid())
+        try:
+            f = open(temp_name, 'wb')
+            try:
+                f.write(FILE_MAGIC)
+                f.write(struct.pack('<Q', len(header)))
+                f.write(header)
+                for name, dtype, shape, array_offset in ast.literal_eval(header)['arrays']:
+                    f.seek(data_start + array_offset)
+                    np.ascontiguousarray(getattr(self, name)).tofile(f)
+            finally:
+                f.close()
+            if os.name == 'nt' and os.path.exists(filename):
+                # rename does not replace files on windows
+                os.remove(filename)
+            os.rename(temp_name, filename)
+        except:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            raise
+
+    @staticmethod
+    def load(filename, data=None, mmap_mode='r'):
+        """Load a tree written by save.
 
-        if p==np.inf:
-            return sorted([(-d,i) for (d,i) in neighbors])
+        Parameters
+        ==========
+
+        filename : the file to load
+        data : array-like, shape (n,k), optional
+            The original points, becomes the data attribute. The queries
+            do not need it.
+        mmap_mode : the np.memmap mode of the arrays, or None to read
+            them into memory. Memory mapping takes constant time and lets
+            several processes share one copy of the tree.
+        """
+        f = open(filename, 'rb')
+        try:
+            if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+                raise ValueError("%s is not a kd-tree file" % filename)
+            header_length, = struct.unpack('<Q', f.read(8))
+            header = ast.literal_eval(f.read(header_length))
+            data_start = _aligned(len(FILE_MAGIC) + 8 + header_length)
+            tree = KDTree.__new__(KDTree)
+            tree.n = header['n']
+            tree.m = header['m']
+            tree.leafsize = header['leafsize']
+            tree.data = data
+            for name, dtype, shape, offset in header['arrays']:
+                if not np.prod(shape):
+                    array = np.zeros(shape, dtype=dtype)
+                elif mmap_mode:
+                    array = np.memmap(filename, dtype=dtype, mode=mmap_mode,
+                                      offset=data_start+offset, shape=shape)
+                else:
+                    f.seek(data_start + offset)
+                    array = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+                setattr(tree, name, array)
+        finally:
+            f.close()
+        tree.node_size = tree.node_end - tree.node_start
+        return tree
+
+    def __traverse_points(self, x, prune_p, inside_p, p):
+        """Walks the tree for all the points of x at once. Nodes further
+        than prune_p[q] from x[q] are dropped, nodes that are completely
+        within inside_p[q] and leaves that are neither are returned as
+        (query, node) arrays: (inside_q, inside_nodes, leaf_q, leaf_nodes).
+        """
+        q = np.arange(len(x))
+        nodes = np.zeros(len(x), dtype=np.int64)
+        inside_q, inside_nodes, leaf_q, leaf_nodes = [q[:0]], [nodes[:0]], [q[:0]], [nodes[:0]]
+        while len(q):
+            nearest, farthest = _point_rect_distances(
+                x[q], self.node_mins[nodes], self.node_maxes[nodes], p)
+            keep = nearest <= prune_p[q]
+            inside = keep & (farthest <= inside_p[q])
+            leaf = keep & ~inside & (self.node_lesser[nodes] < 0)
+            split = keep & ~inside & ~leaf
+            inside_q.append(q[inside])
+            inside_nodes.append(nodes[inside])
+            leaf_q.append(q[leaf])
+            leaf_nodes.append(nodes[leaf])
+            q = np.concatenate((q[split], q[split]))
+            nodes = np.concatenate((self.node_lesser[nodes[split]], self.node_greater[nodes[split]]))
+        return (np.concatenate(inside_q), np.concatenate(inside_nodes),
+                np.concatenate(leaf_q), np.concatenate(leaf_nodes))
+
+    def __ball_pairs(self, x, r_p, p, eps=0):
+        """Finds all the (query, point) pairs with a pth power distance of
+        at most r_p[query]. Returns (queries, positions, distances) where
+        positions index self.indices and the distances are pth powers.
+        """
+        r_p = np.asarray(r_p, dtype=np.float)
+        if eps==0:
+            prune_p = inside_p = r_p
         else:
-            return sorted([((-d)**(1./p),i) for (d,i) in neighbors])
+            r = _distance_root(r_p, p)
+            prune_p = _distance_p(r/(1.+eps), p)
+            inside_p = _distance_p(r*(1.+eps), p)
+        inside_q, inside_nodes, leaf_q, leaf_nodes = self.__traverse_points(x, prune_p, inside_p, p)
+        owner, position = expand_ranges(self.node_start[inside_nodes], self.node_end[inside_nodes])
+        queries = [inside_q[owner]]
+        positions = [position]
+        distances = [minkowski_distance_p(self.tree_data[position], x[inside_q[owner]], p)]
+        starts = self.node_start[leaf_nodes]
+        ends = self.node_end[leaf_nodes]
+        for block_start, block_end in range_blocks(ends - starts, MAX_PAIRS):
+            owner, position = expand_ranges(starts[block_start:block_end], ends[block_start:block_end])
+            query = leaf_q[block_start:block_end][owner]
+            d = minkowski_distance_p(self.tree_data[position], x[query], p)
+            within = d <= r_p[query]
+            queries.append(query[within])
+            positions.append(position[within])
+            distances.append(d[within])
+        return np.concatenate(queries), np.concatenate(positions), np.concatenate(distances)
+
+    def __kth_bound(self, x, k, p):
+        """An upper bound on the pth power distance from every point of x
+        to its kth nearest neighbor: the kth distance within the smallest
+        node on the way down the tree that still has k points."""
+        rows = np.arange(len(x))
+        nodes = np.zeros(len(x), dtype=np.int64)
+        while True:
+            inner = self.node_lesser[nodes] >= 0
+            d = np.maximum(self.node_split_dim[nodes], 0)
+            child = np.where(x[rows, d] <= self.node_split[nodes],
+                             self.node_lesser[nodes], self.node_greater[nodes])
+            descend = inner & (self.node_size[child] >= k)
+            if not np.any(descend):
+                break
+            nodes[descend] = child[descend]
+        owner, position = expand_ranges(self.node_start[nodes], self.node_end[nodes])
+        d = minkowski_distance_p(self.tree_data[position], x[owner], p)
+        order = np.lexsort((d, owner))
+        return d[order][_group_starts(owner[order], len(x)) + k - 1]
+
+    def __query(self, x, k, p, distance_upper_bound):
+        """The k nearest neighbors of every point of x (n,m), returns
+        (n,k) arrays of pth power distances and of indices."""
+        dd = np.empty((len(x), k), dtype=np.float)
+        dd.fill(np.inf)
+        ii = np.empty((len(x), k), dtype=np.int)
+        ii.fill(self.n)
+        upper_bound_p = _distance_p(distance_upper_bound, p)
+        for start in range(0, len(x), QUERY_CHUNK_SIZE):
+            chunk = x[start:start+QUERY_CHUNK_SIZE]
+            # leave room for rounding differences between the distances
+            # computed for the bound and for the candidates.
+            bound = self.__kth_bound(chunk, min(k, self.n), p) * (1 + 1e-9)
+            bound = np.minimum(bound, upper_bound_p)
+            queries, positions, distances = self.__ball_pairs(chunk, bound, p)
+            within = distances < upper_bound_p
+            queries, positions, distances = queries[within], positions[within], distances[within]
+            order = np.lexsort((self.indices[positions], distances, queries))
+            queries, positions, distances = queries[order], positions[order], distances[order]
+            rank = np.arange(len(queries)) - _group_starts(queries, len(chunk))[queries]
+            nearest = rank < k
+            dd[start + queries[nearest], rank[nearest]] = distances[nearest]
+            ii[start + queries[nearest], rank[nearest]] = self.indices[positions[nearest]]
+        return dd, ii
+
+    def __query_all(self, x, p, distance_upper_bound):
+        """All the neighbors closer than distance_upper_bound of every
+        point of x, as lists sorted by distance."""
+        results = []
+        upper_bound_p = _distance_p(distance_upper_bound, p)
+        for start in range(0, len(x), QUERY_CHUNK_SIZE):
+            chunk = x[start:start+QUERY_CHUNK_SIZE]
+            queries, positions, distances = self.__ball_pairs(
+                chunk, np.repeat(upper_bound_p, len(chunk)), p)
+            within = distances < upper_bound_p
+            queries, positions, distances = queries[within], positions[within], distances[within]
+            order = np.lexsort((self.indices[positions], distances, queries))
+            bounds = _group_starts(queries[order], len(chunk) + 1)
+            distances = _distance_root(distances[order], p)
+            indices = self.indices[positions[order]]
+            for j in range(len(chunk)):
+                results.append((distances[bounds[j]:bounds[j+1]].tolist(),
+                                indices[bounds[j]:bounds[j+1]].tolist()))
+        return results
 
     def query(self, x, k=1, eps=0, p=2, distance_upper_bound=np.inf):
         """
@@ -303,7 +556,8 @@ class KDTree(object):
         eps : nonnegative float
             Return approximate nearest neighbors; the kth returned value
             is guaranteed to be no further than (1+eps) times the
-            distance to the real kth nearest neighbor.
+            distance to the real kth nearest neighbor. The search is
+            always exact, so this is accepted for compatibility only.
         p : float, 1<=p<=infinity
             Which Minkowski p-norm to use.
             1 is the sum-of-absolute-values "Manhattan" distance
@@ -311,9 +565,7 @@ class KDTree(object):
             infinity is the maximum-coordinate-difference distance
         distance_upper_bound : nonnegative float
             Return only neighbors within this distance. This is used to prune
-            tree searches, so if you are doing a series of nearest-neighbor
-            queries, it may help to supply the distance to the nearest neighbor
-            of the most recent point.
+            tree searches.
 
         Returns
         -------
@@ -333,40 +585,8 @@ class KDTree(object):
         Examples
         --------
 
-        >>> from scipy.spatial import KDTree
         >>> x, y = np.mgrid[0:5, 2:8]
         >>> tree = KDTree(zip(x.ravel(), y.ravel()))
-        >>> tree.data
-        array([[0, 2],
-               [0, 3],
-               [0, 4],
-               [0, 5],
-               [0, 6],
-               [0, 7],
-               [1, 2],
-               [1, 3],
-               [1, 4],
-               [1, 5],
-               [1, 6],
-               [1, 7],
-               [2, 2],
-               [2, 3],
-               [2, 4],
-               [2, 5],
-               [2, 6],
-               [2, 7],
-               [3, 2],
-               [3, 3],
-               [3, 4],
-               [3, 5],
-               [3, 6],
-               [3, 7],
-               [4, 2],
-               [4, 3],
-               [4, 4],
-               [4, 5],
-               [4, 6],
-               [4, 7]])
         >>> pts = np.array([[0, 0], [2.1, 2.9]])
         >>> tree.query(pts)
         (array([ 2.        ,  0.14142136]), array([ 0, 13]))
@@ -377,97 +597,28 @@ class KDTree(object):
             raise ValueError("x must consist of vectors of length %d but has shape %s" % (self.m, np.shape(x)))
         if p<1:
             raise ValueError("Only p-norms with 1<=p<=infinity permitted")
+        if k is not None and k<1:
+            raise ValueError("Requested %s nearest neighbors; acceptable numbers are integers greater than or equal to one, or None")
         retshape = np.shape(x)[:-1]
-        if retshape!=():
-            if k>1:
-                dd = np.empty(retshape+(k,),dtype=np.float)
-                dd.fill(np.inf)
-                ii = np.empty(retshape+(k,),dtype=np.int)
-                ii.fill(self.n)
-            elif k==1:
-                dd = np.empty(retshape,dtype=np.float)
-                dd.fill(np.inf)
-                ii = np.empty(retshape,dtype=np.int)
-                ii.fill(self.n)
-            elif k is None:
-                dd = np.empty(retshape,dtype=np.object)
-                ii = np.empty(retshape,dtype=np.object)
-            else:
-                raise ValueError("Requested %s nearest neighbors; acceptable numbers are integers greater than or equal to one, or None")
-            for c in np.ndindex(retshape):
-                hits = self.__query(x[c], k=k, p=p, distance_upper_bound=distance_upper_bound)
-                if k>1:
-                    for j in range(len(hits)):
-                        dd[c+(j,)], ii[c+(j,)] = hits[j]
-                elif k==1:
-                    if len(hits)>0:
-                        dd[c], ii[c] = hits[0]
-                    else:
-                        dd[c] = np.inf
-                        ii[c] = self.n
-                elif k is None:
-                    dd[c] = [d for (d,i) in hits]
-                    ii[c] = [i for (d,i) in hits]
+        points = np.asarray(x, dtype=np.float).reshape(-1, self.m)
+        if k is None:
+            hits = self.__query_all(points, p, distance_upper_bound)
+            if retshape==():
+                return hits[0]
+            dd = np.empty(retshape,dtype=np.object)
+            ii = np.empty(retshape,dtype=np.object)
+            for j, c in enumerate(np.ndindex(retshape)):
+                dd[c], ii[c] = hits[j]
             return dd, ii
-        else:
-            hits = self.__query(x, k=k, p=p, distance_upper_bound=distance_upper_bound)
+        dd, ii = self.__query(points, k, p, distance_upper_bound)
+        dd = _distance_root(dd, p)
+        if retshape==():
             if k==1:
-                if len(hits)>0:
-                    return hits[0]
-                else:
-                    return np.inf, self.n
-            elif k>1:
-                dd = np.empty(k,dtype=np.float)
-                dd.fill(np.inf)
-                ii = np.empty(k,dtype=np.int)
-                ii.fill(self.n)
-                for j in range(len(hits)):
-                    dd[j], ii[j] = hits[j]
-                return dd, ii
-            elif k is None:
-                return [d for (d,i) in hits], [i for (d,i) in hits]
-            else:
-                raise ValueError("Requested %s nearest neighbors; acceptable numbers are integers greater than or equal to one, or None")
-
-
-    def __query_ball_point(self, x, r, p=2., eps=0):
-        R = Rectangle(self.maxes, self.mins)
-
-        def traverse_checking(node, rect):
-            if rect.min_distance_point(x,p)>=r/(1.+eps):
-                return []
-            elif rect.max_distance_point(x,p)<r*(1.+eps):
-                return traverse_no_checking(node)
-            elif isinstance(node, KDTree.leafnode):
-                d = self.data[node.idx]
-                return node.idx[minkowski_distance(d,x,p)<=r].tolist()
-            else:
-                less, greater = rect.split(node.split_dim, node.split)
-                return traverse_checking(node.less, less)+traverse_checking(node.greater, greater)
-        def traverse_no_checking(node):
-            if isinstance(node, KDTree.leafnode):
-
-                return node.idx.tolist()
-            else:
-                return traverse_no_checking(node.less)+traverse_no_checking(node.greater)
-
-        return traverse_checking(self.tree, R)
-
-    def __query_range(self, query_rect):
-        R = Rectangle(self.maxes, self.mins)
-        def traverse(node, query_rect, rect):
-            if not query_rect:
-              return []
-            intersection = rect.intersect(query_rect)
-            if not intersection:
-                return []
-            elif isinstance(node, KDTree.leafnode):
-                d = self.data[node.idx]
-                return node.idx[query_rect.contains(d)].tolist()
-            else:
-                less, greater = rect.split(node.split_dim, node.split)
-                return traverse(node.less, query_rect.intersect(less), less)+traverse(node.greater, query_rect.intersect(greater), greater)
-        return traverse(self.tree, query_rect, R)
+                return dd[0,0], ii[0,0]
+            return dd[0], ii[0]
+        if k==1:
+            return dd.reshape(retshape), ii.reshape(retshape)
+        return dd.reshape(retshape+(k,)), ii.reshape(retshape+(k,))
 
     def query_range(self, rect):
         """Find all points in the hyperrectangle rect
@@ -475,17 +626,32 @@ class KDTree(object):
         Parameters
         ==========
 
-        x : array_like, shape tuple + (self.m,)
-            The point or points to search for neighbors of
         rect : a Rectangle instance
 
         Returns
         =======
 
-        results : list of indices of points contained in rect.
+        results : list of indices of points contained in rect, in
+            increasing order.
 
         """
-        return self.__query_range(rect)
+        if not rect:
+            return []
+        nodes = np.zeros(1, dtype=np.int64)
+        found = []
+        while len(nodes):
+            node_mins = self.node_mins[nodes]
+            node_maxes = self.node_maxes[nodes]
+            overlap = np.all(node_mins <= rect.maxes, 1) & np.all(node_maxes >= rect.mins, 1)
+            inside = overlap & np.all(node_mins >= rect.mins, 1) & np.all(node_maxes <= rect.maxes, 1)
+            leaf = overlap & ~inside & (self.node_lesser[nodes] < 0)
+            split = overlap & ~inside & ~leaf
+            owner, position = expand_ranges(self.node_start[nodes[inside]], self.node_end[nodes[inside]])
+            found.append(position)
+            owner, position = expand_ranges(self.node_start[nodes[leaf]], self.node_end[nodes[leaf]])
+            found.append(position[rect.contains(self.tree_data[position])])
+            nodes = np.concatenate((self.node_lesser[nodes[split]], self.node_greater[nodes[split]]))
+        return np.sort(self.indices[np.concatenate(found)]).tolist()
 
     def query_ball_point(self, x, r, p=2., eps=0):
         """Find all points within r of x
@@ -510,23 +676,108 @@ class KDTree(object):
         results : list or array of lists
             If x is a single point, returns a list of the indices of the neighbors
             of x. If x is an array of points, returns an object array of shape tuple
-            containing lists of neighbors.
-
-
-        Note: if you have many points whose neighbors you want to find, you may save
-        substantial amounts of time by putting them in a KDTree and using query_ball_tree.
+            containing lists of neighbors. The indices are in increasing order.
         """
         x = np.asarray(x)
         if x.shape[-1]!=self.m:
             raise ValueError("Searching for a %d-dimensional point in a %d-dimensional KDTree" % (x.shape[-1],self.m))
-        if len(x.shape)==1:
-            return self.__query_ball_point(x,r,p,eps)
-        else:
-            retshape = x.shape[:-1]
-            result = np.empty(retshape,dtype=np.object)
-            for c in np.ndindex(retshape):
-                result[c] = self.__query_ball_point(x[c], r, p=p, eps=eps)
-            return result
+        retshape = x.shape[:-1]
+        points = np.asarray(x, dtype=np.float).reshape(-1, self.m)
+        lists = []
+        for start in range(0, len(points), QUERY_CHUNK_SIZE):
+            chunk = points[start:start+QUERY_CHUNK_SIZE]
+            queries, positions, distances = self.__ball_pairs(
+                chunk, np.repeat(_distance_p(r, p), len(chunk)), p, eps)
+            indices = self.indices[positions]
+            order = np.lexsort((indices, queries))
+            bounds = _group_starts(queries[order], len(chunk) + 1)
+            indices = indices[order]
+            for j in range(len(chunk)):
+                lists.append(indices[bounds[j]:bounds[j+1]].tolist())
+        if len(retshape)==0:
+            return lists[0]
+        result = np.empty(retshape,dtype=np.object)
+        for j, c in enumerate(np.ndindex(retshape)):
+            result[c] = lists[j]
+        return result
+
+    def __traverse_trees(self, other, prune_p, inside_p, p):
+        """Walks both trees together, a frontier of (self node, other node)
+        pairs at a time. Returns the pairs that are completely within
+        inside_p and the leaf pairs that are neither within it nor further
+        than prune_p, as (inside_a, inside_b, leaf_a, leaf_b)."""
+        a = np.zeros(1, dtype=np.int64)
+        b = np.zeros(1, dtype=np.int64)
+        inside_a, inside_b, leaf_a, leaf_b = [a[:0]], [b[:0]], [a[:0]], [b[:0]]
+        while len(a):
+            nearest, farthest = _rect_rect_distances(
+                self.node_mins[a], self.node_maxes[a],
+                other.node_mins[b], other.node_maxes[b], p)
+            keep = nearest <= prune_p
+            inside = keep & (farthest <= inside_p)
+            a_leaf = self.node_lesser[a] < 0
+            b_leaf = other.node_lesser[b] < 0
+            leaf = keep & ~inside & a_leaf & b_leaf
+            inside_a.append(a[inside])
+            inside_b.append(b[inside])
+            leaf_a.append(a[leaf])
+            leaf_b.append(b[leaf])
+            split = keep & ~inside & ~leaf
+            a, b, parent = self.__split_pairs(other, a[split], b[split])
+        return (np.concatenate(inside_a), np.concatenate(inside_b),
+                np.concatenate(leaf_a), np.concatenate(leaf_b))
+
+    def __split_pairs(self, other, a, b):
+        """Replaces every node pair by the pairs of the children of its
+        larger inner node. Returns the new pairs and for every one the
+        position of the pair it came from."""
+        a_leaf = self.node_lesser[a] < 0
+        b_leaf = other.node_lesser[b] < 0
+        split_a = np.flatnonzero(~a_leaf & (b_leaf | (self.node_size[a] >= other.node_size[b])))
+        split_b = np.setdiff1d(np.arange(len(a)), split_a)
+        new_a = np.concatenate((
+            self.node_lesser[a[split_a]], self.node_greater[a[split_a]],
+            a[split_b], a[split_b]))
+        new_b = np.concatenate((
+            b[split_a], b[split_a],
+            other.node_lesser[b[split_b]], other.node_greater[b[split_b]]))
+        return new_a, new_b, np.concatenate((split_a, split_a, split_b, split_b))
+
+    def __pair_points(self, other, a, b):
+        """Expands node pairs (a, b) into all the pairs of their points.
+        Returns (owner, positions in self, positions in other)."""
+        owner, position_a = expand_ranges(self.node_start[a], self.node_end[a])
+        inner_owner, position_b = expand_ranges(other.node_start[b][owner], other.node_end[b][owner])
+        return owner[inner_owner], position_a[inner_owner], position_b
+
+    def __pair_blocks(self, other, a, b):
+        """Splits the node pairs (a, b) into blocks of at most MAX_PAIRS
+        point pairs."""
+        sizes = self.node_size[a] * other.node_size[b]
+        return range_blocks(sizes, MAX_PAIRS)
+
+    def __tree_pairs(self, other, r, p, eps=0):
+        """Finds all the pairs of points of self and other within distance
+        r of each other. Returns arrays of indices into self.data and
+        other.data, and the distances."""
+        r_p = _distance_p(r, p)
+        prune_p = _distance_p(r/(1.+eps), p)
+        inside_p = _distance_p(r*(1.+eps), p)
+        inside_a, inside_b, leaf_a, leaf_b = self.__traverse_trees(other, prune_p, inside_p, p)
+        owner, position_a, position_b = self.__pair_points(other, inside_a, inside_b)
+        first = [position_a]
+        second = [position_b]
+        distances = [minkowski_distance_p(self.tree_data[position_a], other.tree_data[position_b], p)]
+        for block_start, block_end in self.__pair_blocks(other, leaf_a, leaf_b):
+            owner, position_a, position_b = self.__pair_points(
+                other, leaf_a[block_start:block_end], leaf_b[block_start:block_end])
+            d = minkowski_distance_p(self.tree_data[position_a], other.tree_data[position_b], p)
+            within = d <= r_p
+            first.append(position_a[within])
+            second.append(position_b[within])
+            distances.append(d[within])
+        return (self.indices[np.concatenate(first)], other.indices[np.concatenate(second)],
+                _distance_root(np.concatenate(distances), p))
 
     def query_ball_tree(self, other, r, p=2., eps=0):
         """Find all pairs of points whose distance is at most r
@@ -550,50 +801,13 @@ class KDTree(object):
 
         results : list of lists
             For each element self.data[i] of this tree, results[i] is a list of the
-            indices of its neighbors in other.data.
+            indices of its neighbors in other.data, in increasing order.
         """
-        results = [[] for i in range(self.n)]
-        def traverse_checking(node1, rect1, node2, rect2):
-            if rect1.min_distance_rectangle(rect2, p)>r/(1.+eps):
-                return
-            elif rect1.max_distance_rectangle(rect2, p)<r*(1.+eps):
-                traverse_no_checking(node1, node2)
-            elif isinstance(node1, KDTree.leafnode):
-                if isinstance(node2, KDTree.leafnode):
-                    d = other.data[node2.idx]
-                    for i in node1.idx:
-                        results[i] += node2.idx[minkowski_distance(d,self.data[i],p)<=r].tolist()
-                else:
-                    less, greater = rect2.split(node2.split_dim, node2.split)
-                    traverse_checking(node1,rect1,node2.less,less)
-                    traverse_checking(node1,rect1,node2.greater,greater)
-            elif isinstance(node2, KDTree.leafnode):
-                less, greater = rect1.split(node1.split_dim, node1.split)
-                traverse_checking(node1.less,less,node2,rect2)
-                traverse_checking(node1.greater,greater,node2,rect2)
-            else:
-                less1, greater1 = rect1.split(node1.split_dim, node1.split)
-                less2, greater2 = rect2.split(node2.split_dim, node2.split)
-                traverse_checking(node1.less,less1,node2.less,less2)
-                traverse_checking(node1.less,less1,node2.greater,greater2)
-                traverse_checking(node1.greater,greater1,node2.less,less2)
-                traverse_checking(node1.greater,greater1,node2.greater,greater2)
-
-        def traverse_no_checking(node1, node2):
-            if isinstance(node1, KDTree.leafnode):
-                if isinstance(node2, KDTree.leafnode):
-                    for i in node1.idx:
-                        results[i] += node2.idx.tolist()
-                else:
-                    traverse_no_checking(node1, node2.less)
-                    traverse_no_checking(node1, node2.greater)
-            else:
-                traverse_no_checking(node1.less, node2)
-                traverse_no_checking(node1.greater, node2)
-
-        traverse_checking(self.tree, Rectangle(self.maxes, self.mins),
-                          other.tree, Rectangle(other.maxes, other.mins))
-        return results
+        first, second, distances = self.__tree_pairs(other, r, p, eps)
+        order = np.lexsort((second, first))
+        bounds = _group_starts(first[order], self.n + 1)
+        second = second[order]
+        return [second[bounds[i]:bounds[i+1]].tolist() for i in range(self.n)]
 
     def query_pairs(self, r, p=2., eps=0):
         """Find all pairs of points whose distance is at most r
@@ -618,80 +832,9 @@ class KDTree(object):
             close.
 
         """
-        results = set()
-        visited = set()
-        def test_set_visited(node1, node2):
-            i, j = sorted((id(node1),id(node2)))
-            if (i,j) in visited:
-                return True
-            else:
-                visited.add((i,j))
-                return False
-        def traverse_checking(node1, rect1, node2, rect2):
-            if test_set_visited(node1, node2):
-                return
-
-            if id(node2)<id(node1):
-                # This node pair will be visited in the other order
-                #return
-                pass
-            if rect1.min_distance_rectangle(rect2, p)>r/(1.+eps):
-                return
-            elif rect1.max_distance_rectangle(rect2, p)<r*(1.+eps):
-                traverse_no_checking(node1.less, node2)
-                traverse_no_checking(node1.greater, node2)
-            elif isinstance(node1, KDTree.leafnode):
-                if isinstance(node2, KDTree.leafnode):
-                    d = self.data[node2.idx]
-                    for i in node1.idx:
-                        for j in node2.idx[minkowski_distance(d,self.data[i],p)<=r]:
-                            if i<j:
-                                results.add((i,j))
-                            elif j<i:
-                                results.add((j,i))
-                else:
-                    less, greater = rect2.split(node2.split_dim, node2.split)
-                    traverse_checking(node1,rect1,node2.less,less)
-                    traverse_checking(node1,rect1,node2.greater,greater)
-            elif isinstance(node2, KDTree.leafnode):
-                less, greater = rect1.split(node1.split_dim, node1.split)
-                traverse_checking(node1.less,less,node2,rect2)
-                traverse_checking(node1.greater,greater,node2,rect2)
-            else:
-                less1, greater1 = rect1.split(node1.split_dim, node1.split)
-                less2, greater2 = rect2.split(node2.split_dim, node2.split)
-                traverse_checking(node1.less,less1,node2.less,less2)
-                traverse_checking(node1.less,less1,node2.greater,greater2)
-                traverse_checking(node1.greater,greater1,node2.less,less2)
-                traverse_checking(node1.greater,greater1,node2.greater,greater2)
-
-        def traverse_no_checking(node1, node2):
-            if test_set_visited(node1, node2):
-                return
-
-            if id(node2)<id(node1):
-                # This node pair will be visited in the other order
-                #return
-                pass
-            if isinstance(node1, KDTree.leafnode):
-                if isinstance(node2, KDTree.leafnode):
-                    for i in node1.idx:
-                        for j in node2.idx:
-                            if i<j:
-                                results.add((i,j))
-                            elif j<i:
-                                results.add((j,i))
-                else:
-                    traverse_no_checking(node1, node2.less)
-                    traverse_no_checking(node1, node2.greater)
-            else:
-                traverse_no_checking(node1.less, node2)
-                traverse_no_checking(node1.greater, node2)
-
-        traverse_checking(self.tree, Rectangle(self.maxes, self.mins),
-                          self.tree, Rectangle(self.maxes, self.mins))
-        return results
-
+        first, second, distances = self.__tree_pairs(self, r, p, eps)
+        ordered = first < second
+        return set(zip(first[ordered].tolist(), second[ordered].tolist()))
 
     def count_neighbors(self, other, r, p=2.):
         """Count how many nearby pairs can be formed.
@@ -720,54 +863,51 @@ class KDTree(object):
             The number of pairs. Note that this is internally stored in a numpy int,
             and so may overflow if very large (two billion).
         """
-
-        def traverse(node1, rect1, node2, rect2, idx):
-            min_r = rect1.min_distance_rectangle(rect2,p)
-            max_r = rect1.max_distance_rectangle(rect2,p)
-            c_greater = r[idx]>max_r
-            result[idx[c_greater]] += node1.children*node2.children
-            idx = idx[(min_r<=r[idx]) & (r[idx]<=max_r)]
-            if len(idx)==0:
-                return
-
-            if isinstance(node1,KDTree.leafnode):
-                if isinstance(node2,KDTree.leafnode):
-                    ds = minkowski_distance(self.data[node1.idx][:,np.newaxis,:],
-                                  other.data[node2.idx][np.newaxis,:,:],
-                                  p).ravel()
-                    ds.sort()
-                    result[idx] += np.searchsorted(ds,r[idx],side='right')
-                else:
-                    less, greater = rect2.split(node2.split_dim, node2.split)
-                    traverse(node1, rect1, node2.less, less, idx)
-                    traverse(node1, rect1, node2.greater, greater, idx)
-            else:
-                if isinstance(node2,KDTree.leafnode):
-                    less, greater = rect1.split(node1.split_dim, node1.split)
-                    traverse(node1.less, less, node2, rect2, idx)
-                    traverse(node1.greater, greater, node2, rect2, idx)
-                else:
-                    less1, greater1 = rect1.split(node1.split_dim, node1.split)
-                    less2, greater2 = rect2.split(node2.split_dim, node2.split)
-                    traverse(node1.less,less1,node2.less,less2,idx)
-                    traverse(node1.less,less1,node2.greater,greater2,idx)
-                    traverse(node1.greater,greater1,node2.less,less2,idx)
-                    traverse(node1.greater,greater1,node2.greater,greater2,idx)
-        R1 = Rectangle(self.maxes, self.mins)
-        R2 = Rectangle(other.maxes, other.mins)
         if np.shape(r) == ():
-            r = np.array([r])
-            result = np.zeros(1,dtype=int)
-            traverse(self.tree, R1, other.tree, R2, np.arange(1))
-            return result[0]
-        elif len(np.shape(r))==1:
-            r = np.asarray(r)
-            n, = r.shape
-            result = np.zeros(n,dtype=int)
-            traverse(self.tree, R1, other.tree, R2, np.arange(n))
-            return result
-        else:
+            return self.count_neighbors(other, np.array([r]), p)[0]
+        elif len(np.shape(r))!=1:
             raise ValueError("r must be either a single value or a one-dimensional array of values")
+        r = np.asarray(r)
+        sorted_r = np.argsort(r)
+        r_p = _distance_p(r[sorted_r], p)
+        # Every node pair is undecided for the radii lo..hi-1 only (radii are
+        # sorted). Counts are added to ranges of radii through a difference
+        # array: changes[j] is added to the count of every radius from j on.
+        changes = np.zeros(len(r)+1)
+        def add(start, end, weights):
+            changes[:] += np.bincount(start, weights=weights, minlength=len(r)+1)
+            changes[:] -= np.bincount(end, weights=weights, minlength=len(r)+1)
+        a = np.zeros(1, dtype=np.int64)
+        b = np.zeros(1, dtype=np.int64)
+        lo = np.zeros(1, dtype=np.int64)
+        hi = np.array([len(r)], dtype=np.int64)
+        while len(a):
+            nearest, farthest = _rect_rect_distances(
+                self.node_mins[a], self.node_maxes[a],
+                other.node_mins[b], other.node_maxes[b], p)
+            # all the pairs are closer than the radii above farthest.
+            all_start = np.maximum(lo, np.searchsorted(r_p, farthest, side='right'))
+            add(all_start, np.maximum(all_start, hi), 1. * self.node_size[a] * other.node_size[b])
+            lo = np.maximum(lo, np.searchsorted(r_p, nearest, side='left'))
+            hi = np.minimum(hi, all_start)
+            undecided = lo < hi
+            leaf = undecided & (self.node_lesser[a] < 0) & (other.node_lesser[b] < 0)
+            leaf_a, leaf_b, leaf_lo, leaf_hi = a[leaf], b[leaf], lo[leaf], hi[leaf]
+            for block_start, block_end in self.__pair_blocks(other, leaf_a, leaf_b):
+                owner, position_a, position_b = self.__pair_points(
+                    other, leaf_a[block_start:block_end], leaf_b[block_start:block_end])
+                d = minkowski_distance_p(self.tree_data[position_a], other.tree_data[position_b], p)
+                pair_lo = leaf_lo[block_start:block_end][owner]
+                pair_hi = leaf_hi[block_start:block_end][owner]
+                start = np.maximum(pair_lo, np.searchsorted(r_p, d, side='left'))
+                add(start, np.maximum(start, pair_hi), np.ones(len(d)))
+            split = undecided & ~leaf
+            a, b, parent = self.__split_pairs(other, a[split], b[split])
+            lo = lo[split][parent]
+            hi = hi[split][parent]
+        result = np.empty(len(r), dtype=int)
+        result[sorted_r] = np.round(np.cumsum(changes)[:-1]).astype(int)
+        return result
 
     def sparse_distance_matrix(self, other, max_distance, p=2.):
         """Compute a sparse distance matrix
@@ -788,37 +928,33 @@ class KDTree(object):
         result : dok_matrix
             Sparse matrix representing the results in "dictionary of keys" format.
         """
-        result = scipy.sparse.dok_matrix((self.n,other.n))
-
-        def traverse(node1, rect1, node2, rect2):
-            if rect1.min_distance_rectangle(rect2, p)>max_distance:
-                return
-            elif isinstance(node1, KDTree.leafnode):
-                if isinstance(node2, KDTree.leafnode):
-                    for i in node1.idx:
-                        for j in node2.idx:
-                            d = minkowski_distance(self.data[i],other.data[j],p)
-                            if d<=max_distance:
-                                result[i,j] = d
-                else:
-                    less, greater = rect2.split(node2.split_dim, node2.split)
-                    traverse(node1,rect1,node2.less,less)
-                    traverse(node1,rect1,node2.greater,greater)
-            elif isinstance(node2, KDTree.leafnode):
-                less, greater = rect1.split(node1.split_dim, node1.split)
-                traverse(node1.less,less,node2,rect2)
-                traverse(node1.greater,greater,node2,rect2)
-            else:
-                less1, greater1 = rect1.split(node1.split_dim, node1.split)
-                less2, greater2 = rect2.split(node2.split_dim, node2.split)
-                traverse(node1.less,less1,node2.less,less2)
-                traverse(node1.less,less1,node2.greater,greater2)
-                traverse(node1.greater,greater1,node2.less,less2)
-                traverse(node1.greater,greater1,node2.greater,greater2)
-        traverse(self.tree, Rectangle(self.maxes, self.mins),
-                 other.tree, Rectangle(other.maxes, other.mins))
+        first, second, distances = self.__tree_pairs(other, max_distance, p)
+        nonzero = distances != 0
+        return scipy.sparse.coo_matrix(
+            (distances[nonzero], (first[nonzero], second[nonzero])),
+            shape=(self.n, other.n)).todok()
 
-        return result
+
+def cached_tree(data, directory, key='', leafsize=10):
+    """Build a KDTree over data, or load the one saved for the same data.
+
+    The trees are saved in directory under the fingerprint of the data
+    and key (for example the dims the points were taken from), and loaded
+    with KDTree.load, so a tree is built once and shared by every process
+    that asks for it.
+    """
+    data = np.asarray(data)
+    fingerprint = hashlib.sha1()
+    fingerprint.update(np.ascontiguousarray(data).view(np.uint8))
+    fingerprint.update(repr((data.shape, data.dtype.str, key, leafsize)))
+    filename = os.path.join(directory, '%s.kdtree' % fingerprint.hexdigest())
+    if os.path.exists(filename):
+        return KDTree.load(filename, data)
+    tree = KDTree(data, leafsize)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    tree.save(filename)
+    return tree
 
 
 def distance_matrix(x,y,p=2,threshold=1000000):
@@ -1,16 +1,66 @@
 ﻿import numpy as np
-import numpy.random as rand
-import scipy.spatial as spatial
+from biology.kdtree import KDTree
 
-def unique_sample(points, n):
-  #for i in xrange(10):
-  print len(points)
-  sampled = rand.randint(0, len(points))
-  point = np.array([points[sampled]])
-  distances = spatial.distance.cdist(
-    np.array([points[sampled]]), points, metric='euclidean', p=1)
-  points = points[:,distances.T > 5]
-  print len(points)
-  #print np.sort(distances)
-  #print np.max(distances)
-  return distances
\ No newline at end of file
+# unique_sample bisects the radius at most this many times.
+RADIUS_ITERS = 20
+
+def poisson_disk_sample(points, radius, random_state=None):
+  """Returns indices of points such that no two are within radius of each
+  other (and every point is within 2 * radius of one of them).
+
+  Only the first point (in a random order) of every grid cell with a
+  diagonal of radius is a candidate, since a cell can hold one sample at
+  most. Candidates then join in rounds: a candidate that comes before all
+  its undecided neighbors joins, and its neighbors leave.
+  """
+  if random_state is None:
+    random_state = np.random
+  points = np.asarray(points, dtype=np.float)
+  if not len(points):
+    return np.zeros(0, dtype=int)
+  priority = random_state.permutation(len(points))
+  cells = np.floor((points - points.min(axis=0)) / (radius / np.sqrt(points.shape[1]))).astype(int)
+  order = np.lexsort((priority,) + tuple(cells.T))
+  cells = cells[order]
+  candidates = order[np.concatenate(([True], np.any(cells[1:] != cells[:-1], axis=1)))]
+  pairs = np.array(sorted(KDTree(points[candidates]).query_pairs(radius)), dtype=int).reshape(-1, 2)
+  first = np.concatenate((pairs[:, 0], pairs[:, 1]))
+  second = np.concatenate((pairs[:, 1], pairs[:, 0]))
+  candidate_priority = priority[candidates]
+  undecided = np.ones(len(candidates), dtype=bool)
+  selected = np.zeros(len(candidates), dtype=bool)
+  while np.any(undecided):
+    live = undecided[first] & undecided[second]
+    first = first[live]
+    second = second[live]
+    first_neighbor = np.empty(len(candidates), dtype=int)
+    first_neighbor.fill(len(points))
+    np.minimum.at(first_neighbor, first, candidate_priority[second])
+    joining = undecided & (candidate_priority < first_neighbor)
+    selected |= joining
+    undecided &= ~joining
+    undecided[second[joining[first]]] = False
+  return np.sort(candidates[selected])
+
+def unique_sample(points, n, random_state=None):
+  """Returns the indices of n points spread over the space covered by
+  points: a Poisson disk sample whose radius is bisected until it holds
+  at least n points, trimmed at random to n."""
+  if random_state is None:
+    random_state = np.random
+  points = np.asarray(points, dtype=np.float)
+  n = min(n, len(points))
+  low = 0.
+  high = np.sqrt(np.sum(points.ptp(axis=0) ** 2)) or 1.
+  best = np.arange(len(points))
+  for i in xrange(RADIUS_ITERS):
+    radius = (low + high) / 2
+    indices = poisson_disk_sample(points, radius, random_state)
+    if len(indices) >= n:
+      low = radius
+      best = indices
+      if len(indices) == n:
+        break
+    else:
+      high = radius
+  return np.sort(random_state.permutation(best)[:n])
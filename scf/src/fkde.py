@@ -1,9 +1,15 @@
 # partition Kai Zhang
 from numpy import atleast_2d, zeros, vstack, arange, mean, std, exp, power, dot
-from numpy import array, arange, pi, sqrt
+from numpy import array, arange, pi, sqrt, floor, lexsort, flatnonzero, bincount
+from numpy import any as np_any, concatenate, empty, cov
+from multiprocessing.pool import ThreadPool
 from scipy.optimize import fmin as fminc
-from scipy.stats import scoreatpercentile, cov
-from scipy.linalg import det, inv
+from scipy.stats import scoreatpercentile
+from scipy.linalg import det, inv, cholesky
+
+# Upper bound on the number of (point, cluster) pairs evaluated at once.
+MAX_PAIRS = 2000000
+
 class fkde:
     """Fast Kernel Density Estimation, 
     a nonparametric method to evaluate the probability distribution function (pdf) of a sample.
@@ -24,14 +30,16 @@ class fkde:
     ----------------
     n_clusters: the number of clusters
     C         : the cluster centers    
+    n         : the number of points in each cluster
+    labels    : the cluster of every point
     bandwidth : the bandwidth specifying the covariance of the kernel
     r         : the cluster radius
     
     Class Methods
     -------------
-    evaluate(points, bandwidth='silverman') : Evaluates the pdf at the given points. 
-    The bandwidth key can be used to pass the covariance matrix directly, or to select
-    it using one of two methods, silverman or scotts.
+    evaluate(points, bandwidth='silverman', num_threads=None) : Evaluates the pdf at the
+    given points. The bandwidth key can be used to pass the covariance matrix directly, or
+    to select it using one of two methods, silverman or scotts.
     
     References
     ----------
@@ -40,15 +48,19 @@ class fkde:
     
     Notes
     -----
-    A lot of work is done during during class instantiation, where the data
-    is clustered. Hence, if the kde is to be evaluated < 50 times, 
-    gaussian_kde will be faster then fkde. On the other hand, when the kde
-    is evaluated many times, the improvement is radical. 
+    The clustering is leader clustering on a grid hash: the space is cut into
+    cubes whose diagonal is 2 * radius, and the points of every non empty cube
+    form a cluster, so every point is within radius of the cube center. Each
+    cluster is then replaced by the mean of its points.
+    
+    The evaluation is a single kernel matrix product between the evaluation
+    points and the clusters, chunked over the points (and optionally run on
+    several threads). The whitened cluster centers are kept per bandwidth, so
+    repeated evaluations only pay for the points.
     
     I have not yet found a critical evaluation of the algorithm, so please double check results 
     before using it seriously.
 
-    To do : Improve the clustering algorithm.
     License : See Scipy License. 
     Address questions and comments to david.huard@gmail.com, May 2006.
     """
@@ -64,68 +76,54 @@ class fkde:
             self.x = x
             self.N, self.dim = N, dim
         self.r = radius
-        self.C = self.x[0]
-        self.index = zeros(self.N)
-        
-        # Recursive clustering
-        self.Iterations = 4
-        self.rC = {}
-        self.rI = {}
-        r0 = array(self.x.ptp()).max()/3.
-        f = (r0/radius)**(1./(self.Iterations-1))
-        r = r0/f**arange(self.Iterations)
-  
-        self.rI[0] = [range(self.N)]
-        for it in range(1, self.Iterations):
-            self.rC[it] = []
-            self.rI[it] = []
-            for indices in self.rI[it-1]:
-                self._cluster(indices, r[it-1], it)
-            
-
-        self.C = self.rC[it]
-        self.index = self.rI[it]
+        self._cluster(radius)
         self._averaging()
+        self._summaries = {}
         
-        #r = max(x.ptp())/4.
-        #self.kernels = {'gaussian': lambda x: exp(x)} # normalized ? 
-
-    def _cluster(self, indices, r, it):
-        """Partitions the dataset into clusters. The number of clusters is inversely proportional to the radius.
-        Clustering is the computational bottleneck of the algorithm. Selecting a radius that is too small slows the computations significatively."""        
-        m = 0
-        cC = [self.x[indices[0]]]
-        index = [[]]
-        for i in indices:
-            e = atleast_2d((self.x[i] - cC)**2)
-            d = e.sum( axis = 1)
-
-            if (min(d) <= r**2):
-                index[d.argmin()].append(i)
-            else:
-                cC.append(self.x[i])
-                index.append([])
-                m += 1
-                index[m].append(i)
-        
-        
-        self.rC[it].extend(cC)
-        self.rI[it].extend(index)
+    def _cluster(self, r):
+        """Partitions the dataset into clusters of radius r. The number of clusters is
+        inversely proportional to the radius."""
+        side = 2. * r / sqrt(self.dim)
+        cells = floor((self.x - self.x.min(axis=0)) / side).astype(int)
+        # sort the points by cell, a new cluster starts wherever the cell changes
+        order = lexsort(cells.T[::-1])
+        cells = cells[order]
+        new_cell = concatenate(([True], np_any(cells[1:] != cells[:-1], axis=1)))
+        self.labels = empty(self.N, dtype=int)
+        self.labels[order] = new_cell.cumsum() - 1
+        starts = flatnonzero(new_cell)
+        self.index = [
+            order[start:end] for start, end in zip(starts, concatenate((starts[1:], [self.N])))]
         
     def _averaging(self):
+        """Replaces every cluster with the mean of its points."""
+        self.n_clusters = len(self.index)
+        self.n = bincount(self.labels, minlength=self.n_clusters)
+        self.C = empty((self.n_clusters, self.dim))
+        for d in range(self.dim):
+            self.C[:, d] = bincount(self.labels, weights=self.x[:, d], minlength=self.n_clusters)
+        self.C /= self.n[:, None]
         
-        j = 0
-        self.n = []    # Number of points in each cluster
-        for i in self.index:
-            self.n.append(len(i))
-            self.C[j] = mean(self.x[i])  # Averaging of each cluster
-            j += 1
-        self.n_clusters = j        
+    def _cluster_summary(self):
+        """Returns the shift, the whitening matrix, the whitened centers, their squared
+        norms and the normalization for the current bandwidth. They are
+        computed once per bandwidth."""
+        key = self.bandwidth.tostring()
+        if key not in self._summaries:
+            # inv(bandwidth) = w * w.T, so the energy is |diff * w|^2 / 2.
+            # the centers are shifted to their mean to keep the dot products accurate.
+            shift = self.C.mean(axis=0)
+            w = cholesky(inv(self.bandwidth), lower=True)
+            centers = dot(self.C - shift, w)
+            norms = (centers * centers).sum(axis=1)
+            normalization = sqrt(det(2*pi*self.bandwidth))*self.N
+            self._summaries[key] = (shift, w, centers, norms, normalization)
+        return self._summaries[key]
             
-
-    def evaluate(self, points, bandwidth = 'silverman', shape = 'gaussian'):
+    def evaluate(self, points, bandwidth = 'silverman', shape = 'gaussian', num_threads = None):
         """Evaluates the density at points.
-        The bandwidth can be optimized using the bandwidth_selection method."""
+        The bandwidth can be optimized using the bandwidth_selection method.
+        num_threads - the evaluation points are split between this many threads."""
         if bandwidth in ['silverman', 'scotts']:
             self._bandwidth_selection(bandwidth)
         else:
@@ -142,21 +140,26 @@ class fkde:
         else:
             msg = 'The dimension of the evaluation points is inconsistent with the dataset.'
             raise ValueError(msg)
-        #kernel = self.kernels[shape]     
-        result = zeros(points.shape[1])
+        shift, w, centers, norms, normalization = self._cluster_summary()
+        result = zeros(len(self.points))
+        chunk_size = max(1, MAX_PAIRS // max(1, self.n_clusters))
         
-        for j in range(self.n_clusters):
-         #   z= ((self.points - self.C[j])/h)**2
-         #   f += kernel(-z.sum(axis = 1))*self.n[j]
-            diff = self.points - atleast_2d(self.C[j])
+        def evaluate_chunk(start):
+            p = dot(self.points[start:start + chunk_size] - shift, w)
+            energy = ((p * p).sum(axis=1)[:, None] + norms - 2 * dot(p, centers.T)) / 2.0
+            result[start:start + chunk_size] = dot(exp(-energy), self.n)
             
-            tdiff = dot(diff, self._inv_band)
-            energy = (diff*tdiff).sum(axis=1)/2.0
-            result += exp(-energy)*self.n[j]
-            det_cov = det(2*pi*self.bandwidth)
-        result /= sqrt(det_cov)*self.N
-        
-        #f /= self.N * prod(h) *pi**(self.dim/2.)
+        starts = range(0, len(self.points), chunk_size)
+        if num_threads and num_threads > 1 and len(starts) > 1:
+            pool = ThreadPool(num_threads)
+            try:
+                pool.map(evaluate_chunk, starts)
+            finally:
+                pool.close()
+        else:
+            for start in starts:
+                evaluate_chunk(start)
+        result /= normalization
         return result
         
         
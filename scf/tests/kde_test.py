@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+import unittest
+from biology.kde import evaluate_sums
+from biology.kde import kde2d_grid
+from biology.kde import create_gaussian_kernel
+import numpy as np
+
+class TestKde(unittest.TestCase):
+
+    def setUp(self):
+      random_state = np.random.RandomState(0)
+      self.data = np.vstack((
+          random_state.randn(3000, 2),
+          random_state.randn(2000, 2) * 0.5 + [2, 1]))
+      self.bandwidth = 0.3
+      self.kernel = create_gaussian_kernel(self.bandwidth)
+
+    def exact_sums(self, points):
+      return np.array([
+          np.sum(self.kernel(np.sqrt(np.sum((self.data - p) ** 2, axis=1))))
+          for p in points])
+
+    def test_evaluate_sums(self):
+      points = np.random.RandomState(1).rand(200, 2) * 6 - 2
+      values, errors = evaluate_sums(points, self.kernel, self.data)
+      self.assertTrue(np.all(np.abs(values - self.exact_sums(points)) <= errors + 1e-9))
+      values, errors = evaluate_sums(points, self.kernel, self.data, 0, 0)
+      self.assertTrue(np.allclose(values, self.exact_sums(points)))
+
+    def test_kde2d_grid(self):
+      values, errors = kde2d_grid(self.data, self.bandwidth, [-1, -1], [3, 2], (40, 30))
+      self.assertEqual(values.shape, (40, 30))
+      x = np.linspace(-1, 3, 40)
+      y = np.linspace(-1, 2, 30)
+      grid = np.column_stack((np.repeat(x, len(y)), np.tile(y, len(x))))
+      exact = self.exact_sums(grid).reshape((40, 30))
+      self.assertTrue(np.all(np.abs(values - exact) <= errors + 1e-9))
@@ -5,6 +5,10 @@ from script import Script
 import parameterchanger
 from parameterchanger import ParameterChangerManager
 from biology.kdtree import Rectangle
+from biology.kdtree import KDTree
+import numpy as np
+import os
+import tempfile
 
 class TestKDTree(unittest.TestCase):
 
@@ -30,6 +34,42 @@ class TestKDTree(unittest.TestCase):
       self.assertEqual(tuple(r1.contains([point2])), (False,))
       self.assertEqual(tuple(r1.contains((point1, point2))), (True, False))
 
+    def test_query(self):
+      points = np.random.RandomState(0).rand(500, 3)
+      tree = KDTree(points)
+      queries = np.random.RandomState(1).rand(50, 3)
+      dist, indices = tree.query(queries, 3)
+      brute = np.sqrt(np.sum((queries[:, np.newaxis, :] - points[np.newaxis, :, :]) ** 2, axis=2))
+      self.assertTrue(np.allclose(dist, np.sort(brute, axis=1)[:, :3]))
+      self.assertTrue(np.allclose(brute[np.arange(50)[:, np.newaxis], indices], dist))
+      dist, indices = tree.query(queries[0], 1)
+      self.assertEqual(indices, np.argmin(brute[0]))
+
+    def test_query_range(self):
+      points = np.random.RandomState(0).rand(500, 3)
+      tree = KDTree(points)
+      rect = Rectangle([0.2, 0.3, 0.1], [0.6, 0.5, 0.9])
+      self.assertEqual(tree.query_range(rect), list(np.flatnonzero(rect.contains(points))))
+
+    def test_query_ball_point(self):
+      points = np.random.RandomState(0).rand(500, 2)
+      tree = KDTree(points)
+      dist = np.sqrt(np.sum((points - [0.5, 0.5]) ** 2, axis=1))
+      self.assertEqual(tree.query_ball_point([0.5, 0.5], 0.1), list(np.flatnonzero(dist <= 0.1)))
+      self.assertEqual(tree.count_neighbors(KDTree([[0.5, 0.5]]), 0.1), np.sum(dist <= 0.1))
+
+    def test_save_load(self):
+      points = np.random.RandomState(0).rand(500, 3)
+      tree = KDTree(points)
+      filename = os.path.join(tempfile.mkdtemp(), 'tree.kdtree')
+      tree.save(filename)
+      loaded = KDTree.load(filename)
+      queries = np.random.RandomState(1).rand(50, 3)
+      self.assertTrue(np.all(tree.query(queries, 2)[1] == loaded.query(queries, 2)[1]))
+      rect = Rectangle([0.2, 0.3, 0.1], [0.6, 0.5, 0.9])
+      self.assertEqual(tree.query_range(rect), loaded.query_range(rect))
+      os.remove(filename)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
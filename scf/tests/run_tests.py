@@ -8,6 +8,7 @@ fix_path()
 from parameterchanger_test import TestParameterChanger
 from script_test import TestScript
 from kdtree_test import TestKDTree
+from kde_test import TestKde
 from depends_test import TestDepends
 
 if __name__ == '__main__':